@@ -0,0 +1,467 @@
+"""
+Офлайн-бенчмарк бота.
+
+Поднимает локальные заглушки Telegram Bot API и всех вебхуков WEBHOOK_*,
+наполняет базу синтетическими данными (преподаватели, уроки, ученики,
+фотоальбом) и прогоняет сценарии через диспетчер и задачи планировщика:
+
+- nightly_sync  — ночная синхронизация расписания (send_post_request)
+- roster_t10    — загрузка списков учеников за 10 минут до урока
+- attendance    — нажатия на учеников в клавиатуре посещаемости
+- photo_export  — выгрузка фото урока в ZIP
+
+Для каждого сценария выводится пропускная способность и задержки p50/p99.
+
+Запуск:
+    python benchmark.py
+    python benchmark.py --teachers 500 --lessons 3000 --photos 50000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+BENCH_TOKEN = "123456:BENCHMARK"
+
+# Имена вебхуков из config.py и короткие пути на заглушке
+WEBHOOK_PATHS = {
+    "WEBHOOK_URL": "schedule",
+    "NEW_WEBHOOK_URL": "schedule",
+    "WEBHOOK_USERS_URL": "users",
+    "WEBHOOK_COLUMN_URL": "column",
+    "WEBHOOK_STUDENTS_URL": "students",
+    "WEBHOOK_ATTENDANCE_URL": "attendance",
+    "WEBHOOK_NEW_STUDENTS_URL": "new_students",
+    "WEBHOOK_COUNT_URL": "count",
+    "WEBHOOK_LESSONS_EDIT_URL": "lessons_edit",
+    "WEBHOOK_ADMIN_VERIFY_URL": "admin_verify",
+    "WEBHOOK_CHECK_NEW_TEACHER_URL": "new_teacher",
+    "WEBHOOK_ASSISTANT_URL": "assistant",
+}
+
+POINTS = ["Солнышко", "Ромашка", "Берёзка", "Теремок", "Радуга", "Звёздочка", "Колокольчик", "Улыбка"]
+
+
+# ============================================================================
+# СИНТЕТИЧЕСКИЕ ДАННЫЕ
+# ============================================================================
+
+class Dataset:
+    """Синтетические данные бенчмарка: расписание, ученики, фото"""
+
+    def __init__(self, args, now):
+        self.rng = random.Random(args.seed)
+        self.now = now
+        self.args = args
+        self.teachers = [(1000000 + i, f"Преподаватель {i:04d}") for i in range(args.teachers)]
+        self.admins = [(900000 + i, f"Админ {i}") for i in range(3)]
+        self.schedule = self._build_schedule()
+
+    def _build_schedule(self):
+        """Уроки на сегодня: часть ровно через 10 минут (для сценария T-10), остальные в течение дня"""
+        date_ll = self.now.strftime("%Y-%m-%d")
+        roster_time = (self.now + timedelta(minutes=10)).strftime("%H:%M")
+        items = []
+        for i in range(self.args.lessons):
+            if i < self.args.roster_lessons:
+                time_l = roster_time
+            else:
+                minutes = self.rng.randrange(8 * 60, 19 * 60, 5)
+                time_l = f"{minutes // 60:02d}:{minutes % 60:02d}"
+            teacher = self.teachers[i % len(self.teachers)][1]
+            assist = self.teachers[(i * 7 + 3) % len(self.teachers)][1] if i % 4 == 0 else ""
+            items.append({
+                "Date_L": self.now.strftime("%d.%m.%Y"),
+                "Time_L": time_l,
+                "Point": POINTS[i % len(POINTS)],
+                "Groupp": f"G{i:05d}",
+                "Teacher": teacher,
+                "Assist": assist,
+                "Adress": f"ул. Тестовая, {i % 200 + 1}",
+                "Modul": "Бенчмарк",
+                "Theme": f"Тема {i % 40}",
+                "DateLL": date_ll,
+                "Counter_p": "",
+                "Comment": "",
+                "Present": "",
+                "Detail": "",
+                "Insra": "",
+            })
+        return items
+
+    def students_for(self, point, groupp):
+        """Ответ вебхука учеников для группы"""
+        return [
+            {"point": point, "groupp": groupp, "name_s": f"Ученик {groupp}-{n:02d}", "idrow": f"{groupp}{n:02d}"}
+            for n in range(self.args.roster_size)
+        ]
+
+
+# ============================================================================
+# ЗАГЛУШКИ TELEGRAM BOT API И ВЕБХУКОВ
+# ============================================================================
+
+class FakeServers:
+    """Заглушки Bot API и вебхуков в отдельном потоке со своим event loop
+
+    Отдельный поток нужен, потому что бот обращается к вебхукам через
+    синхронный requests.post и блокирует свой event loop на время запроса.
+    """
+
+    def __init__(self, dataset, file_size):
+        self.dataset = dataset
+        self.file_payload = os.urandom(file_size)
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+        self.message_id = 0
+        self.loop = None
+        self.base_url = None
+        self._ready = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="bench-fake-servers", daemon=True)
+        thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _count(self, name):
+        with self.calls_lock:
+            self.calls[name] += 1
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_bot_api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        app.router.add_post("/hook/{name}", self.handle_webhook)
+        runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        self._ready.set()
+        self.loop.run_forever()
+
+    def _message(self, chat_id, text=""):
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 1), "type": "private"},
+            "text": text or "",
+        }
+
+    async def handle_bot_api(self, request):
+        method = request.match_info["method"]
+        self._count(f"bot.{method}")
+        fields = await request.post()
+        chat_id = fields.get("chat_id")
+
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            result = self._message(chat_id, fields.get("text"))
+        elif method == "sendDocument":
+            # Как в Bot API: отправленный документ возвращается с file_id
+            result = self._message(chat_id, fields.get("caption"))
+            result["document"] = {"file_id": f"doc-{self.message_id}", "file_unique_id": f"doc-{self.message_id}"}
+        elif method in ("sendPhoto", "sendVideo"):
+            result = self._message(chat_id, fields.get("caption"))
+        elif method == "sendMediaGroup":
+            media = json.loads(fields.get("media", "[]"))
+            result = [self._message(chat_id) for _ in media]
+        elif method == "getFile":
+            file_id = fields.get("file_id", "")
+            result = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.file_payload),
+                "file_path": f"photos/{file_id}.jpg",
+            }
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getChat":
+            result = {"id": int(chat_id or 1), "type": "private"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request):
+        self._count("file.download")
+        return web.Response(body=self.file_payload, content_type="application/octet-stream")
+
+    async def handle_webhook(self, request):
+        name = request.match_info["name"]
+        self._count(f"hook.{name}")
+        body = await request.read()
+        payload = json.loads(body) if body else {}
+
+        if name == "schedule":
+            return web.json_response(self.dataset.schedule)
+        if name == "students":
+            return web.json_response(self.dataset.students_for(payload.get("Point"), payload.get("Groupp")))
+        if name == "column":
+            return web.json_response("F")
+        if name == "users":
+            return web.json_response([])
+        return web.json_response({"ok": True})
+
+
+# ============================================================================
+# ПОДГОТОВКА БОТА
+# ============================================================================
+
+def install_config(base_url, db_path):
+    """Подменяет модуль config до импорта versia"""
+    config = types.ModuleType("config")
+    config.TOKEN = BENCH_TOKEN
+    config.ADMIN_PASSWORD = "bench"
+    config.ACCOUNT_PASSWORD = "bench"
+    config.DB_PATH = db_path
+    config.METRICS_PORT = 0
+    for attr, path in WEBHOOK_PATHS.items():
+        setattr(config, attr, f"{base_url}/hook/{path}")
+    sys.modules["config"] = config
+
+
+def load_bot(base_url):
+    """Импортирует бота и направляет его сессию на заглушку Bot API"""
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    import versia
+
+    versia.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(base_url))
+    return versia
+
+
+def seed_database(versia, dataset, args):
+    """Наполняет базу пользователями, фотоальбомом и уроками на выгрузку"""
+    versia.create_db()
+    conn = versia.get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.executemany(
+        "INSERT OR IGNORE INTO users (telegram_id, name, status, nik_name, work) VALUES (?, ?, ?, ?, '')",
+        [(tid, name, "Teacher", f"@t{tid}") for tid, name in dataset.teachers]
+        + [(tid, name, "DoubleA", f"@a{tid}") for tid, name in dataset.admins],
+    )
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS column (column_d TEXT)")
+    cursor.execute("DELETE FROM column")
+    cursor.execute("INSERT INTO column (column_d) VALUES ('F')")
+
+    # Фотоальбом: фото распределены по урокам расписания, у каждого урока своя запись export_lessons
+    export_ids = []
+    photos_left = args.photos
+    for lesson in dataset.schedule:
+        if photos_left <= 0:
+            break
+        count = min(photos_left, args.photos_per_lesson)
+        cursor.executemany("""
+            INSERT INTO fotoalbum (kindergarten, groupp, teacher, date, time, file_id, file_unique_id, file_size, file_type)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'photo')
+        """, [
+            (lesson["Point"], lesson["Groupp"], lesson["Teacher"], lesson["DateLL"], lesson["Time_L"],
+             f"F{lesson['Groupp']}_{n}", f"U{lesson['Groupp']}_{n}", args.file_kb * 1024)
+            for n in range(count)
+        ])
+        photos_left -= count
+        cursor.execute("""
+            INSERT INTO export_lessons (point, groupp, time_l, date_ll, modul, theme)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (lesson["Point"], lesson["Groupp"], lesson["Time_L"], lesson["DateLL"], lesson["Modul"], lesson["Theme"]))
+        export_ids.append(cursor.lastrowid)
+
+    conn.commit()
+    conn.close()
+    return export_ids
+
+
+def reset_idempotency_keys(versia, pattern):
+    """Удаляет ключи идемпотентности, чтобы задачу можно было прогнать повторно"""
+    conn = versia.get_db_connection()
+    conn.execute("DELETE FROM job_runs WHERE key LIKE ?", (pattern,))
+    conn.commit()
+    conn.close()
+
+
+# ============================================================================
+# ПРОГОН СЦЕНАРИЕВ
+# ============================================================================
+
+class UpdateFactory:
+    """Собирает апдейты Telegram для передачи в dp.feed_update"""
+
+    def __init__(self):
+        self.update_id = 0
+
+    def callback(self, user_id, data, message_id=1):
+        from aiogram.types import Update
+
+        self.update_id += 1
+        user = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+        return Update.model_validate({
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": user,
+                "chat_instance": "bench",
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": 123456, "is_bot": True, "first_name": "Bench"},
+                    "text": "bench",
+                },
+            },
+        })
+
+
+def percentile(samples, p):
+    """Перцентиль по методу ближайшего ранга"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+async def drain_tasks():
+    """Дожидается фоновых задач, созданных через asyncio.create_task"""
+    current = asyncio.current_task()
+    while True:
+        pending = [t for t in asyncio.all_tasks() if t is not current and not t.done()]
+        if not pending:
+            return
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def measure(name, operations, results):
+    """Выполняет операции последовательно и собирает задержки"""
+    samples = []
+    started = time.perf_counter()
+    for operation in operations:
+        t0 = time.perf_counter()
+        await operation()
+        samples.append(time.perf_counter() - t0)
+    await drain_tasks()
+    total = time.perf_counter() - started
+    results.append((name, len(samples), total, samples))
+
+
+async def run_benchmark(args):
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-"), "userreg.db")
+
+    # Время бота — Asia/Ho_Chi_Minh, расписание строим в нём же
+    from pytz import timezone
+
+    tz_now = datetime.now(timezone("Asia/Ho_Chi_Minh"))
+
+    dataset = Dataset(args, tz_now)
+    servers = FakeServers(dataset, args.file_kb * 1024)
+    servers.start()
+    install_config(servers.base_url, db_path)
+    versia = load_bot(servers.base_url)
+
+    print(f"[BENCH] База: {db_path}")
+    print(f"[BENCH] Заглушки: {servers.base_url}")
+    export_ids = seed_database(versia, dataset, args)
+    # Первичное заполнение schedule без рассылки
+    versia.update_schedule_table(dataset.schedule, notify=False)
+    await drain_tasks()
+
+    results = []
+    updates = UpdateFactory()
+
+    # Ночная синхронизация расписания (у каждого повтора свой ключ идемпотентности)
+    await measure(
+        "nightly_sync",
+        [lambda i=i: versia.run_timed_job("send_post_request", run_key=f"bench-{i}") for i in range(args.repeat)],
+        results,
+    )
+
+    # Загрузка списков за 10 минут до урока; ключи уроков сбрасываются, иначе повтор ничего не загрузит
+    async def roster_run(i):
+        reset_idempotency_keys(versia, "roster:%")
+        await versia.run_timed_job("check_lessons_10min_before", run_key=f"bench-{i}")
+
+    await measure(
+        "roster_t10",
+        [lambda i=i: roster_run(i) for i in range(args.repeat)],
+        results,
+    )
+
+    # Нажатия на учеников: ученики берутся из загруженных списков
+    conn = versia.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, groupp FROM lessons ORDER BY id LIMIT ?", (args.taps,))
+    student_rows = cursor.fetchall()
+    conn.close()
+    owner = {lesson["Groupp"]: dataset.teachers[i % len(dataset.teachers)][0] for i, lesson in enumerate(dataset.schedule)}
+    taps = [
+        updates.callback(owner.get(groupp, dataset.teachers[0][0]), f"primary_student:{student_id}:0")
+        for student_id, groupp in student_rows
+    ]
+    await measure(
+        "attendance",
+        [lambda u=u: versia.dp.feed_update(versia.bot, u) for u in taps],
+        results,
+    )
+
+    # Выгрузка фото урока
+    admin_id = dataset.admins[0][0]
+    exports = [updates.callback(admin_id, f"export_photos:{export_ids[i % len(export_ids)]}") for i in range(args.exports)] if export_ids else []
+    await measure(
+        "photo_export",
+        [lambda u=u: versia.dp.feed_update(versia.bot, u) for u in exports],
+        results,
+    )
+
+    await versia.bot.session.close()
+    servers.stop()
+
+    print()
+    print(f"{'сценарий':<14} {'операций':>9} {'оп/с':>9} {'p50, мс':>10} {'p99, мс':>10}")
+    for name, count, total, samples in results:
+        throughput = count / total if total else 0.0
+        print(f"{name:<14} {count:>9} {throughput:>9.2f} {percentile(samples, 50) * 1000:>10.1f} {percentile(samples, 99) * 1000:>10.1f}")
+    print()
+    print("[BENCH] Вызовы заглушек:")
+    for name, count in sorted(servers.calls.items()):
+        print(f"  {name}: {count}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота")
+    parser.add_argument("--db", help="путь к базе (по умолчанию временный файл)")
+    parser.add_argument("--teachers", type=int, default=300, help="количество преподавателей")
+    parser.add_argument("--lessons", type=int, default=2000, help="уроков в расписании")
+    parser.add_argument("--roster-lessons", type=int, default=40, help="уроков ровно через 10 минут")
+    parser.add_argument("--roster-size", type=int, default=25, help="учеников в группе")
+    parser.add_argument("--photos", type=int, default=20000, help="строк в fotoalbum")
+    parser.add_argument("--photos-per-lesson", type=int, default=40, help="фото на урок")
+    parser.add_argument("--file-kb", type=int, default=200, help="размер файла фото на заглушке, КБ")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов для задач планировщика")
+    parser.add_argument("--taps", type=int, default=500, help="нажатий на учеников")
+    parser.add_argument("--exports", type=int, default=5, help="выгрузок фото")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_benchmark(parse_args()))
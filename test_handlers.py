@@ -0,0 +1,255 @@
+"""
+Проверки обработчиков бота через диспетчер.
+
+Бот работает против заглушек Telegram Bot API и вебхуков из benchmark.py,
+база - временный файл. Запуск:
+    python -m unittest test_handlers
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+import types
+import unittest
+from datetime import datetime
+
+from pytz import timezone
+
+import benchmark
+
+
+class RecordingServers(benchmark.FakeServers):
+    """Заглушки, которые запоминают вызовы Bot API с их полями"""
+
+    def __init__(self, dataset, file_size):
+        super().__init__(dataset, file_size)
+        self.requests = []
+
+    async def handle_bot_api(self, request):
+        fields = await request.post()
+        self.requests.append((request.match_info["method"], dict(fields)))
+        return await super().handle_bot_api(request)
+
+    def calls_of(self, method):
+        return [fields for name, fields in self.requests if name == method]
+
+
+class HandlerTestCase(unittest.TestCase):
+    """Один бот и одна база на все тесты модуля (versia импортируется один раз)"""
+
+    @classmethod
+    def setUpClass(cls):
+        args = types.SimpleNamespace(teachers=3, lessons=3, roster_lessons=0, roster_size=3, seed=1)
+        dataset = benchmark.Dataset(args, datetime.now(timezone("Asia/Ho_Chi_Minh")))
+        cls.servers = RecordingServers(dataset, 1024)
+        cls.servers.start()
+        benchmark.install_config(cls.servers.base_url, os.path.join(tempfile.mkdtemp(prefix="test-"), "userreg.db"))
+        cls.versia = benchmark.load_bot(cls.servers.base_url)
+        cls.versia.create_db()
+        cls.admin_id = dataset.admins[0][0]
+        cls.updates = benchmark.UpdateFactory()
+        cls.loop = asyncio.new_event_loop()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.run_until_complete(cls.versia.bot.session.close())
+        cls.loop.close()
+        cls.servers.stop()
+
+    def setUp(self):
+        self.servers.requests.clear()
+
+    def feed_callback(self, user_id, data):
+        update = self.updates.callback(user_id, data)
+        self.loop.run_until_complete(self.versia.dp.feed_update(self.versia.bot, update))
+
+    def feed_album_photo(self, user_id, media_group_id, file_unique_id):
+        from aiogram.types import Update
+
+        self.updates.update_id += 1
+        photo = {"file_id": f"id-{file_unique_id}", "file_unique_id": file_unique_id,
+                 "width": 10, "height": 10, "file_size": 100}
+        update = Update.model_validate({
+            "update_id": self.updates.update_id,
+            "message": {
+                "message_id": self.updates.update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+                "media_group_id": media_group_id,
+                "photo": [photo],
+            },
+        })
+        self.loop.run_until_complete(self.versia.dp.feed_update(self.versia.bot, update))
+
+
+class AdminVerificationTest(HandlerTestCase):
+    """admin_verify: переключение постоянный/временный у новых учеников урока"""
+
+    def setUp(self):
+        super().setUp()
+        conn = self.versia.get_db_connection()
+        cursor = conn.cursor()
+        lesson_id = self.versia.upsert_lesson(cursor, "Солнышко", "G1", "10:00", lesson_code="VERIF00001")
+        # Ученики без rowid - новые, их и проверяет администратор
+        self.attendance_ids = [
+            self.versia.add_attendance(cursor, lesson_id, name) for name in ("Аня", "Боря")
+        ]
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        conn = self.versia.get_db_connection()
+        conn.execute("DELETE FROM attendance")
+        conn.execute("DELETE FROM lesson")
+        conn.commit()
+        conn.close()
+
+    def is_permanent(self, attendance_id):
+        conn = self.versia.get_db_connection()
+        try:
+            return conn.execute("SELECT is_permanent FROM attendance WHERE id = ?", (attendance_id,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_toggle_updates_status_and_redraws_keyboard(self):
+        self.feed_callback(self.admin_id, "admin_verify:VERIF00001:1")
+
+        self.assertEqual(self.is_permanent(self.attendance_ids[0]), 0)
+        self.assertEqual(self.is_permanent(self.attendance_ids[1]), 1)
+
+        answers = [fields.get("text") for fields in self.servers.calls_of("answerCallbackQuery")]
+        self.assertEqual(answers, ["Статус изменен на постоянный"])
+
+        markups = self.servers.calls_of("editMessageReplyMarkup")
+        self.assertEqual(len(markups), 1)
+        buttons = [row[0] for row in json.loads(markups[0]["reply_markup"])["inline_keyboard"]]
+        self.assertEqual(
+            [(button["text"], button["callback_data"]) for button in buttons],
+            [("❌ Аня", "admin_verify:VERIF00001:0"),
+             ("✅ Боря", "admin_verify:VERIF00001:1"),
+             ("Отправить учеников", "admin_send:VERIF00001")]
+        )
+
+    def test_toggle_twice_restores_status(self):
+        self.feed_callback(self.admin_id, "admin_verify:VERIF00001:0")
+        self.feed_callback(self.admin_id, "admin_verify:VERIF00001:0")
+
+        self.assertEqual(self.is_permanent(self.attendance_ids[0]), 0)
+        answers = [fields.get("text") for fields in self.servers.calls_of("answerCallbackQuery")]
+        self.assertEqual(answers, ["Статус изменен на постоянный", "Статус изменен на временный"])
+
+
+class RosterPageTest(HandlerTestCase):
+    """fetch_roster_page: алфавитный порядок и листание по ключу (имя, id отметки)"""
+
+    def setUp(self):
+        super().setUp()
+        self.conn = self.versia.get_db_connection()
+        self.cursor = self.conn.cursor()
+        self.lesson_id = self.versia.upsert_lesson(self.cursor, "Ромашка", "G2", "11:00", lesson_code="ROSTER0001")
+        # Одинаковые имена попадают на границу страницы, порядок добавления - не алфавитный
+        names = ["Яна"] * 3 + ["Вика"] * 12 + ["Алиса"] * 2
+        for name in names:
+            self.versia.add_attendance(self.cursor, self.lesson_id, name)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.cursor.execute("DELETE FROM attendance")
+        self.cursor.execute("DELETE FROM lesson")
+        self.conn.commit()
+        self.conn.close()
+
+    def test_pages_follow_names(self):
+        first = self.versia.fetch_roster_page(self.cursor, self.lesson_id)
+        second = self.versia.fetch_roster_page(self.cursor, self.lesson_id, 1, after_id=first.rows[-1][0])
+        rows = first.rows + second.rows
+
+        self.assertEqual(len(rows), 17)
+        self.assertEqual(len({row[0] for row in rows}), 17)
+        self.assertEqual([row[1] for row in rows], sorted(row[1] for row in rows))
+
+        back = self.versia.fetch_roster_page(self.cursor, self.lesson_id, 0, before_id=second.rows[0][0])
+        self.assertEqual(back.rows, first.rows)
+
+
+class PhotoAlbumTest(HandlerTestCase):
+    """Альбомы фото: сохранение одной пачкой, очистка служебных словарей, ошибки фоновой задачи"""
+
+    def setUp(self):
+        super().setUp()
+        self.user_id = self.admin_id
+        self.window = self.versia.PHOTO_ALBUM_WINDOW
+        self.versia.PHOTO_ALBUM_WINDOW = 0.05
+        state = self.versia.dp.fsm.get_context(self.versia.bot, chat_id=self.user_id, user_id=self.user_id)
+        self.loop.run_until_complete(state.set_state(self.versia.PhotoUpload.waiting_for_photos))
+        self.loop.run_until_complete(state.set_data(
+            {"point": "Ромашка", "groupp": "G3", "time_l": "12:00", "date_ll": "01.01.2026"}))
+
+    def tearDown(self):
+        self.versia.PHOTO_ALBUM_WINDOW = self.window
+        conn = self.versia.get_db_connection()
+        conn.execute("DELETE FROM fotoalbum")
+        conn.commit()
+        conn.close()
+
+    def upload_album(self, media_group_id, count):
+        for index in range(count):
+            self.feed_album_photo(self.user_id, media_group_id, f"{media_group_id}-{index}")
+        self.loop.run_until_complete(self.versia.wait_pending_photo_albums(self.user_id))
+
+    def test_album_saved_once_and_bookkeeping_released(self):
+        self.upload_album("album-1", 3)
+
+        texts = [fields.get("text") for fields in self.servers.calls_of("sendMessage")]
+        self.assertEqual(texts, ["✅ Сохранено файлов: 3 (всего по уроку: 3)"])
+        self.assertEqual(self.versia.pending_photo_albums, {})
+        self.assertEqual(self.versia.photo_upload_locks, {})
+
+    def test_album_failure_is_reported(self):
+        original = self.versia.save_uploaded_files
+
+        async def failing_save(message, state, files):
+            raise RuntimeError("диск заполнен")
+
+        self.versia.save_uploaded_files = failing_save
+        try:
+            self.upload_album("album-2", 2)
+        finally:
+            self.versia.save_uploaded_files = original
+
+        texts = [fields.get("text") for fields in self.servers.calls_of("sendMessage")]
+        self.assertEqual(texts, ["❌ Ошибка при сохранении альбома: диск заполнен"])
+        self.assertEqual(self.versia.pending_photo_albums, {})
+
+
+class SendZipPartsTest(HandlerTestCase):
+    """send_zip_parts: отправленная часть засчитывается и удаляется, даже если отметка не записалась"""
+
+    def make_part(self):
+        handle, path = tempfile.mkstemp(suffix=".zip")
+        os.close(handle)
+        return path
+
+    def test_checkpoint_failure_keeps_part_sent(self):
+        paths = [self.make_part(), self.make_part()]
+        parts = [(path, f"a_{number}.zip", number, 2) for number, path in enumerate(paths, 1)]
+        recorded = []
+
+        def on_sent(path, message):
+            recorded.append(message.document.file_id)
+            if path == paths[0]:
+                raise RuntimeError("база заблокирована")
+
+        sent = self.loop.run_until_complete(
+            self.versia.send_zip_parts(self.admin_id, parts, "Архив", on_sent=on_sent))
+
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(recorded), 2)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,25 +4,43 @@
 
 import asyncio
 from aiogram import Bot, Dispatcher
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, BaseFilter
 from aiogram.filters.state import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, BufferedInputFile
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, FSInputFile
+from aiogram.types import InputMediaPhoto, InputMediaVideo
+from aiogram.exceptions import TelegramRetryAfter
 import sqlite3
 import logging
 import requests
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from pytz import timezone
 from datetime import datetime, timedelta, date
 from config import ADMIN_PASSWORD, ACCOUNT_PASSWORD
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 import zipfile
 import io
+import json
 import os
-
+import re
+import secrets
+import tempfile
+import socket
+import ssl
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import namedtuple
+from types import MappingProxyType
+
+import config
 from config import TOKEN
 from config import WEBHOOK_URL, NEW_WEBHOOK_URL, WEBHOOK_USERS_URL, WEBHOOK_COLUMN_URL, WEBHOOK_STUDENTS_URL, WEBHOOK_ATTENDANCE_URL, WEBHOOK_NEW_STUDENTS_URL, WEBHOOK_COUNT_URL
 from config import WEBHOOK_LESSONS_EDIT_URL, WEBHOOK_ADMIN_VERIFY_URL, WEBHOOK_CHECK_NEW_TEACHER_URL, WEBHOOK_ASSISTANT_URL
@@ -30,14 +48,310 @@ from config import WEBHOOK_LESSONS_EDIT_URL, WEBHOOK_ADMIN_VERIFY_URL, WEBHOOK_C
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
+# Локальный Bot API сервер (telegram-bot-api --local): файлы до 2 GB в обе стороны,
+# скачанные файлы лежат на диске сервера. Если бот видит этот каталог по другому
+# пути (другой контейнер), задаются оба каталога
+TELEGRAM_API_URL = getattr(config, "TELEGRAM_API_URL", "")
+TELEGRAM_API_SERVER_DIR = getattr(config, "TELEGRAM_API_SERVER_DIR", "")
+TELEGRAM_API_LOCAL_DIR = getattr(config, "TELEGRAM_API_LOCAL_DIR", "")
+
 # Инициализация бота и диспетчера
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+if TELEGRAM_API_URL:
+    from pathlib import Path
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer, SimpleFilesPathWrapper, BareFilesPathWrapper
+    if TELEGRAM_API_SERVER_DIR and TELEGRAM_API_LOCAL_DIR:
+        files_path_wrapper = SimpleFilesPathWrapper(Path(TELEGRAM_API_SERVER_DIR), Path(TELEGRAM_API_LOCAL_DIR))
+    else:
+        files_path_wrapper = BareFilesPathWrapper()
+    bot = Bot(token=TOKEN, session=AiohttpSession(
+        api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=True, wrap_local_file=files_path_wrapper)
+    ))
+else:
+    bot = Bot(token=TOKEN)
+
+# Хранилище FSM: Redis, если задан REDIS_URL (общее для нескольких воркеров), иначе память процесса
+REDIS_URL = getattr(config, "REDIS_URL", "")
+if REDIS_URL:
+    from aiogram.fsm.storage.redis import RedisStorage
+    storage = RedisStorage.from_url(REDIS_URL)
+else:
+    storage = MemoryStorage()
+dp = Dispatcher(storage=storage)
 
 # Глобальные переменные
-lessons_data = []  # Данные уроков в команде /lessons
 current_edit_mode = False  # Флаг для определения режима редактирования
-lessons_data_photo = {}  # Словарь для хранения уроков каждого пользователя при загрузке фото
+
+# ============================================================================
+# МЕТРИКИ И ИНСТРУМЕНТАЦИЯ
+# ============================================================================
+
+# Путь к базе данных SQLite
+DB_PATH = getattr(config, "DB_PATH", "/data/userreg.db")
+
+# Адрес локального HTTP-эндпоинта /metrics (METRICS_PORT = 0 отключает сервер)
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9108)
+
+# Границы бакетов гистограмм задержек (в секундах)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS_HELP = {
+    "bot_handler_duration_seconds": "Время обработки апдейта хендлером",
+    "bot_handler_errors_total": "Количество исключений в хендлерах",
+    "bot_db_query_duration_seconds": "Время выполнения SQL-запросов к SQLite",
+    "bot_webhook_duration_seconds": "Время ответа внешних вебхуков",
+    "bot_webhook_requests_total": "Количество запросов к вебхукам по статусу ответа",
+    "bot_scheduler_job_duration_seconds": "Время выполнения задач планировщика",
+    "bot_scheduler_job_errors_total": "Количество упавших запусков задач планировщика",
+    "bot_scheduler_job_missed_total": "Количество пропущенных запусков задач планировщика",
+    "bot_scheduler_job_skipped_total": "Запуски, пропущенные из-за уже работающего экземпляра задачи",
+    "bot_job_stage_seconds": "Время отдельных этапов задач планировщика",
+}
+
+metrics_lock = threading.Lock()
+metrics_histograms = {}  # (метрика, метки) -> [накопленные счетчики бакетов, сумма, количество]
+metrics_counters = {}    # (метрика, метки) -> значение
+
+
+def observe_latency(metric, seconds, **labels):
+    """Добавляет наблюдение в гистограмму задержек"""
+    key = (metric, tuple(sorted(labels.items())))
+    with metrics_lock:
+        entry = metrics_histograms.get(key)
+        if entry is None:
+            entry = metrics_histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                entry[0][i] += 1
+        entry[1] += seconds
+        entry[2] += 1
+
+
+def inc_counter(metric, value=1, **labels):
+    """Увеличивает счетчик"""
+    key = (metric, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics_counters[key] = metrics_counters.get(key, 0) + value
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    escaped = []
+    for name, value in items:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_metrics():
+    """Формирует текст метрик в формате Prometheus exposition"""
+    with metrics_lock:
+        histograms = {key: (list(v[0]), v[1], v[2]) for key, v in metrics_histograms.items()}
+        counters = dict(metrics_counters)
+
+    lines = []
+    for metric in sorted({key[0] for key in histograms}):
+        lines.append(f"# HELP {metric} {METRICS_HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {metric} histogram")
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            if name != metric:
+                continue
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{metric}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+    for metric in sorted({key[0] for key in counters}):
+        lines.append(f"# HELP {metric} {METRICS_HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {metric} counter")
+        for (name, labels), value in sorted(counters.items()):
+            if name == metric:
+                lines.append(f"{metric}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Middleware диспетчера: время работы каждого хендлера
+async def handler_timing_middleware(handler, event, data):
+    handler_object = data.get("handler")
+    handler_name = handler_object.callback.__name__ if handler_object else "unknown"
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        inc_counter("bot_handler_errors_total", handler=handler_name)
+        raise
+    finally:
+        observe_latency("bot_handler_duration_seconds", time.perf_counter() - started, handler=handler_name)
+
+dp.message.middleware(handler_timing_middleware)
+dp.callback_query.middleware(handler_timing_middleware)
+
+
+_SQL_OPERATION_RE = re.compile(r"^\s*(\w+)")
+_SQL_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)", re.IGNORECASE)
+
+
+def describe_sql(sql):
+    """Короткая метка запроса для метрик: операция + первая таблица"""
+    operation = _SQL_OPERATION_RE.match(sql)
+    operation = operation.group(1).upper() if operation else "SQL"
+    table = _SQL_TABLE_RE.search(sql)
+    return f"{operation} {table.group(1)}" if table else operation
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор SQLite, замеряющий время выполнения запросов"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe_latency("bot_db_query_duration_seconds", time.perf_counter() - started, query=describe_sql(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe_latency("bot_db_query_duration_seconds", time.perf_counter() - started, query=describe_sql(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение SQLite, выдающее TimedCursor и замеряющее COMMIT"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            observe_latency("bot_db_query_duration_seconds", time.perf_counter() - started, query="COMMIT")
+
+
+def post_webhook(url, **kwargs):
+    """requests.post с замером времени ответа вебхука"""
+    webhook_name = WEBHOOK_NAMES.get(url, "other")
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = requests.post(url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        observe_latency("bot_webhook_duration_seconds", time.perf_counter() - started, webhook=webhook_name)
+        inc_counter("bot_webhook_requests_total", webhook=webhook_name, status=status)
+
+# Человекочитаемые имена вебхуков для меток метрик (вебхуки ссылок выгрузки
+# добавляются рядом с EXPORT_MODUL_WEBHOOKS, остальные URL попадают в "other")
+WEBHOOK_NAMES = {
+    WEBHOOK_URL: "schedule_tomorrow",
+    NEW_WEBHOOK_URL: "schedule_today",
+    WEBHOOK_USERS_URL: "users",
+    WEBHOOK_COLUMN_URL: "column",
+    WEBHOOK_STUDENTS_URL: "students",
+    WEBHOOK_ATTENDANCE_URL: "attendance",
+    WEBHOOK_NEW_STUDENTS_URL: "new_students",
+    WEBHOOK_COUNT_URL: "count",
+    WEBHOOK_LESSONS_EDIT_URL: "lessons_edit",
+    WEBHOOK_ADMIN_VERIFY_URL: "admin_verify",
+    WEBHOOK_CHECK_NEW_TEACHER_URL: "new_teacher",
+    WEBHOOK_ASSISTANT_URL: "assistant",
+}
+
+
+async def handle_metrics_request(request):
+    return web.Response(
+        body=render_metrics().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+async def start_metrics_server():
+    """Запускает локальный HTTP-сервер с эндпоинтом /metrics"""
+    if not METRICS_PORT:
+        print("[METRICS] Сервер метрик отключен (METRICS_PORT = 0)")
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics_request)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, METRICS_HOST, METRICS_PORT)
+    try:
+        await site.start()
+    except OSError as e:
+        # Порт уже занят другим воркером на этом хосте - работаем без своего /metrics
+        print(f"[METRICS] Не удалось занять порт {METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return None
+    print(f"[METRICS] Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# ============================================================================
+# ВРЕМЯ УРОКОВ
+# ============================================================================
+
+LESSON_TIMEZONE = timezone("Asia/Ho_Chi_Minh")
+LESSON_DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y", "%d.%m.%y", "%d/%m/%Y")
+LESSON_SCAN_WINDOW = 5 * 60  # Шаг запуска задач по урокам, секунды
+
+
+def parse_lesson_date(value):
+    """Дата урока из текстового поля вебхука или None"""
+    value = (value or "").strip()
+    for fmt in LESSON_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def lesson_starts_at(date_ll, date_l, time_l):
+    """
+    Время начала урока в epoch-секундах по текстовым DateLL/Date_L и Time_L из вебхука
+
+    Возвращает None, если дату или время разобрать не удалось: такой урок
+    не попадет в выборки задач по диапазону времени.
+    """
+    try:
+        hours, minutes = (int(part) for part in (time_l or "").strip().split(":")[:2])
+        lesson_date = parse_lesson_date(date_ll) or parse_lesson_date(date_l)
+        if lesson_date is None:
+            return None
+        start = LESSON_TIMEZONE.localize(datetime(lesson_date.year, lesson_date.month, lesson_date.day, hours, minutes))
+    except ValueError:
+        return None
+    return int(start.timestamp())
+
+
+def schedule_item_starts_at(item):
+    """starts_at для строки расписания из JSON вебхука"""
+    starts_at = lesson_starts_at(item.get("DateLL", ""), item.get("Date_L", ""), item.get("Time_L", ""))
+    if starts_at is None:
+        print(f"[SCHEDULE] Не удалось определить время урока: DateLL={item.get('DateLL')!r}, "
+              f"Date_L={item.get('Date_L')!r}, Time_L={item.get('Time_L')!r}")
+    return starts_at
+
+
+def lesson_window(kaz_time, offset_minutes):
+    """
+    Полуинтервал (начало, конец] epoch-секунд для уроков, начинающихся через offset_minutes
+
+    Ширина окна равна шагу запуска задачи, поэтому соседние запуски покрывают время без
+    пропусков, даже если урок не попадает в 5-минутную сетку.
+    """
+    upper = int(kaz_time.timestamp()) + offset_minutes * 60
+    return upper - LESSON_SCAN_WINDOW, upper
+
 
 # ============================================================================
 # БАЗА ДАННЫХ - ПОДКЛЮЧЕНИЕ И СОЗДАНИЕ
@@ -45,7 +359,7 @@ lessons_data_photo = {}  # Словарь для хранения уроков 
 
 # Создаем базу данных, если она не существует
 def create_db():
-    conn = sqlite3.connect('/data/userreg.db', timeout=30)
+    conn = sqlite3.connect(DB_PATH, timeout=30, factory=TimedConnection)
     conn.execute('PRAGMA journal_mode=WAL;')
     cursor = conn.cursor()
     cursor.execute("""
@@ -78,7 +392,8 @@ def create_db():
             Detail TEXT,
             Insra TEXT,
             foto TEXT,
-            lesson_code TEXT
+            lesson_code TEXT,
+            starts_at INTEGER
         )
     """)
     cursor.execute("""
@@ -96,21 +411,14 @@ def create_db():
             upload_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS lessons (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            point TEXT,
-            groupp TEXT,
-            name_s TEXT,
-            student_rowid TEXT,
-            column_d TEXT,
-            present TEXT DEFAULT '',
-            free TEXT DEFAULT '',
-            is_permanent INTEGER DEFAULT 0,
-            lesson_code TEXT,
-            is_send INTEGER DEFAULT 0
-        )
-    """)
+    try:
+        cursor.execute(FOTOALBUM_UNIQUE_INDEX_SQL)
+    except sqlite3.IntegrityError:
+        # В старой базе есть дубли: их удалит dedup_fotoalbum, затем создаст индекс
+        print("[DB] В fotoalbum есть дубли файлов, уникальный индекс будет создан после очистки")
+    # Диапазон дат для /export_bulk (уникальный индекс начинается с kindergarten)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fotoalbum_date ON fotoalbum (date)")
+    ensure_lessons_schema(cursor)
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS export_lessons (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -123,28 +431,468 @@ def create_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    # Перцептивные хеши фото (dHash, hex) для отбора похожих кадров при выгрузке
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS photo_hashes (
+            file_unique_id TEXT PRIMARY KEY,
+            dhash TEXT NOT NULL,
+            width INTEGER,
+            height INTEGER
+        )
+    """)
+    # Контрольные точки выгрузок: план файлов и части архива (см. run_export_job)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_key TEXT UNIQUE NOT NULL,
+            chat_id INTEGER,
+            archive_name TEXT,
+            status TEXT DEFAULT 'running',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS export_files (
+            job_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            arcname TEXT,
+            file_id TEXT,
+            file_size INTEGER,
+            file_type TEXT,
+            state TEXT DEFAULT 'pending',
+            part_number INTEGER,
+            PRIMARY KEY (job_id, position)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS export_parts (
+            job_id INTEGER NOT NULL,
+            part_number INTEGER NOT NULL,
+            path TEXT,
+            state TEXT DEFAULT 'sealed',
+            document_id TEXT,
+            PRIMARY KEY (job_id, part_number)
+        )
+    """)
+    # Старые базы могли создать schedule без этих колонок
+    cursor.execute("PRAGMA table_info(schedule)")
+    schedule_columns = {row[1] for row in cursor.fetchall()}
+    for column in ("Counter_p", "foto", "lesson_code"):
+        if column not in schedule_columns:
+            cursor.execute(f"ALTER TABLE schedule ADD COLUMN {column} TEXT")
+    if "starts_at" not in schedule_columns:
+        cursor.execute("ALTER TABLE schedule ADD COLUMN starts_at INTEGER")
+
+    # Заполняем starts_at для строк, загруженных до появления колонки
+    cursor.execute("SELECT rowid, DateLL, Date_L, Time_L FROM schedule WHERE starts_at IS NULL")
+    backfill = [
+        (starts_at, rowid)
+        for rowid, date_ll, date_l, time_l in cursor.fetchall()
+        if (starts_at := lesson_starts_at(date_ll, date_l, time_l)) is not None
+    ]
+    cursor.executemany("UPDATE schedule SET starts_at = ? WHERE rowid = ?", backfill)
+
+    # Индексы для поиска уроков по времени и по человеку в садике
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_time ON schedule (Time_L)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_starts_at ON schedule (starts_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_teacher_point ON schedule (Teacher, Point, Time_L)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_assist_point ON schedule (Assist, Point, Time_L)")
+
+    # Версии кэшируемых таблиц: по ним воркеры понимают, что снимок расписания или
+    # справочник пользователей устарел. users меняется редко - версию поднимают триггеры.
+    # schedule - только загрузчики расписания (bump_table_version): статусы уроков
+    # (Teacher_w, Assist_w, foto) меняются каждую минуту и в снимок не входят
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+    for table in ("schedule", "users"):
+        cursor.execute("INSERT OR IGNORE INTO table_versions (name, version) VALUES (?, 0)", (table,))
+    for action in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS users_version_{action.lower()}
+            AFTER {action} ON users
+            BEGIN
+                UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+            END
+        """)
+        cursor.execute(f"DROP TRIGGER IF EXISTS schedule_version_{action.lower()}")
+    if backfill:
+        bump_table_version(cursor, "schedule")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS job_runs (
+            key TEXT PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Состояние напоминаний о фото: сколько напоминаний ушло и когда следующее (epoch, UTC)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS photo_reminders (
+            point TEXT NOT NULL,
+            groupp TEXT NOT NULL,
+            time_l TEXT NOT NULL,
+            date_ll TEXT NOT NULL,
+            teacher TEXT,
+            sent_count INTEGER NOT NULL DEFAULT 0,
+            next_due_at REAL NOT NULL,
+            PRIMARY KEY (point, groupp, time_l, date_ll)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_photo_reminders_due ON photo_reminders (next_due_at)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS scheduler_lease (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
     conn.commit()
     conn.close()
 
 # Подключение к базе данных
 def get_db_connection():
-    conn = sqlite3.connect('/data/userreg.db', timeout=30)
+    conn = sqlite3.connect(DB_PATH, timeout=30, factory=TimedConnection)
     conn.execute('PRAGMA journal_mode=WAL;')
     return conn
 
+
+def claim_idempotency_key(key, conn=None):
+    """
+    Записывает ключ идемпотентности в job_runs.
+
+    Возвращает True, если ключ записан впервые (побочные эффекты можно выполнять),
+    и False, если такой запуск уже был. conn - соединение вызывающей функции,
+    чтобы не ждать блокировку записи от собственной незакрытой транзакции; ключ
+    тогда становится частью ее транзакции, коммитит вызывающий.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        cursor = conn.execute("INSERT OR IGNORE INTO job_runs (key) VALUES (?)", (key,))
+        if own_conn:
+            conn.commit()
+        return cursor.rowcount == 1
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def release_idempotency_key(key, conn=None):
+    """Удаляет ключ запуска, который не удался, чтобы его можно было повторить (conn - как в claim)"""
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        conn.execute("DELETE FROM job_runs WHERE key = ?", (key,))
+        if own_conn:
+            conn.commit()
+    finally:
+        if own_conn:
+            conn.close()
+
+
+# ============================================================================
+# СНИМОК РАСПИСАНИЯ
+# ============================================================================
+
+# Строка расписания (поля как в таблице schedule + rowid). Статусы уроков
+# (Teacher_w, Assist_w, foto) читаются из базы: снимок меняется только при загрузке расписания
+ScheduleLesson = namedtuple("ScheduleLesson", [
+    "rowid", "Date_L", "Time_L", "Point", "Groupp", "Teacher", "Assist", "Adress", "Modul",
+    "Theme", "DateLL", "Counter_p", "Comment", "Present", "Detail",
+    "Insra", "lesson_code", "starts_at"
+])
+
+
+def _freeze_index(index):
+    """Превращает словарь списков в неизменяемое отображение кортежей"""
+    return MappingProxyType({key: tuple(values) for key, values in index.items()})
+
+
+class ScheduleSnapshot:
+    """
+    Неизменяемый снимок таблицы schedule с индексами.
+
+    Снимок не меняется после создания: при изменении расписания строится новый
+    и целиком заменяет старый, поэтому читатели всегда видят согласованные данные.
+    """
+
+    def __init__(self, version, lessons):
+        self.version = version
+        self.lessons = tuple(lessons)
+        by_rowid = {}
+        by_time = {}
+        by_person = {}
+        by_point = {}
+        by_identity = {}
+        for lesson in self.lessons:
+            by_rowid[lesson.rowid] = lesson
+            by_time.setdefault(lesson.Time_L, []).append(lesson)
+            by_point.setdefault(lesson.Point, []).append(lesson)
+            by_identity.setdefault((lesson.Point, lesson.Groupp, lesson.Time_L, lesson.DateLL), []).append(lesson)
+            by_person.setdefault(lesson.Teacher, []).append(lesson)
+            if lesson.Assist and lesson.Assist != lesson.Teacher:
+                by_person.setdefault(lesson.Assist, []).append(lesson)
+        self.by_rowid = MappingProxyType(by_rowid)
+        self.by_time = _freeze_index(by_time)
+        self.by_person = _freeze_index(by_person)
+        self.by_point = _freeze_index(by_point)
+        self.by_identity = _freeze_index(by_identity)
+        # Уроки с известным временем начала, отсортированные по starts_at, для выборок по диапазону
+        self.by_start = tuple(sorted(
+            (lesson for lesson in self.lessons if lesson.starts_at is not None),
+            key=lambda lesson: (lesson.starts_at, lesson.rowid)
+        ))
+        self.start_keys = tuple(lesson.starts_at for lesson in self.by_start)
+
+    def get(self, rowid):
+        """Урок по rowid (rowid может прийти строкой из callback_data)"""
+        try:
+            return self.by_rowid.get(int(rowid))
+        except (TypeError, ValueError):
+            return None
+
+    def at_time(self, time_l):
+        """Уроки, начинающиеся в time_l (формат HH:MM)"""
+        return self.by_time.get(time_l, ())
+
+    def starting_between(self, lower, upper):
+        """Уроки, начинающиеся в полуинтервале (lower, upper] epoch-секунд"""
+        return self.by_start[bisect_right(self.start_keys, lower):bisect_right(self.start_keys, upper)]
+
+    def for_person(self, name):
+        """Уроки, где name - преподаватель или ассистент"""
+        return self.by_person.get(name, ())
+
+    def at_point(self, point):
+        """Уроки в садике point"""
+        return self.by_point.get(point, ())
+
+    def find(self, point, groupp, time_l, date_ll):
+        """Первый урок с указанными садиком, группой, временем и датой"""
+        lessons = self.by_identity.get((point, groupp, time_l, date_ll), ())
+        return lessons[0] if lessons else None
+
+
+# Как часто (секунды) воркер сверяет версии кэшей с базой, чтобы увидеть изменения,
+# сделанные другим воркером; свои изменения воркер применяет сразу
+CACHE_VERSION_CHECK_INTERVAL = getattr(config, "CACHE_VERSION_CHECK_INTERVAL", 30)
+
+schedule_snapshot = None  # Текущий снимок расписания
+schedule_snapshot_checked_at = 0.0  # Когда версия снимка последний раз сверялась с базой (monotonic)
+table_version_conn = None  # Постоянное соединение для проверки версий таблиц
+
+
+def bump_table_version(cursor, table):
+    """Отмечает изменение кэшируемой таблицы (в транзакции загрузчика)"""
+    cursor.execute("UPDATE table_versions SET version = version + 1 WHERE name = ?", (table,))
+
+
+def read_table_version(table):
+    """Текущая версия таблицы в базе (поиск по первичному ключу)"""
+    global table_version_conn
+    if table_version_conn is None:
+        table_version_conn = get_db_connection()
+    row = table_version_conn.execute("SELECT version FROM table_versions WHERE name = ?", (table,)).fetchone()
+    return row[0] if row else 0
+
+
+def refresh_schedule_snapshot():
+    """Перечитывает schedule и атомарно заменяет снимок"""
+    global schedule_snapshot, schedule_snapshot_checked_at
+    conn = get_db_connection()
+    try:
+        # Версия и строки читаются в одной транзакции, чтобы снимок соответствовал версии
+        conn.execute("BEGIN")
+        row = conn.execute("SELECT version FROM table_versions WHERE name = 'schedule'").fetchone()
+        rows = conn.execute(f"SELECT rowid, {', '.join(ScheduleLesson._fields[1:])} FROM schedule ORDER BY rowid").fetchall()
+        conn.rollback()
+    finally:
+        conn.close()
+    schedule_snapshot = ScheduleSnapshot(row[0] if row else 0, [ScheduleLesson(*r) for r in rows])
+    schedule_snapshot_checked_at = time.monotonic()
+    print(f"[SCHEDULE] Снимок расписания обновлен: версия {schedule_snapshot.version}, уроков {len(schedule_snapshot.lessons)}")
+    return schedule_snapshot
+
+
+def get_schedule_snapshot():
+    """
+    Возвращает актуальный снимок расписания.
+
+    Загрузчики расписания этого воркера перестраивают снимок сами; изменения,
+    сделанные другим воркером, видны после сверки версии с базой, которая
+    выполняется не чаще раза в CACHE_VERSION_CHECK_INTERVAL секунд.
+    """
+    global schedule_snapshot_checked_at
+    if schedule_snapshot is None:
+        return refresh_schedule_snapshot()
+    now = time.monotonic()
+    if now - schedule_snapshot_checked_at >= CACHE_VERSION_CHECK_INTERVAL:
+        schedule_snapshot_checked_at = now
+        if schedule_snapshot.version != read_table_version("schedule"):
+            return refresh_schedule_snapshot()
+    return schedule_snapshot
+
+
+# ============================================================================
+# СПРАВОЧНИК ПОЛЬЗОВАТЕЛЕЙ
+# ============================================================================
+
+# Запись пользователя (telegram_id первым, как в большинстве запросов к users)
+UserRecord = namedtuple("UserRecord", ["telegram_id", "name", "status", "nik_name", "work", "id"])
+
+# Роли, которым уходят служебные уведомления
+ADMIN_ROLES = ("Admin", "DoubleA")
+
+
+class UserDirectory:
+    """Неизменяемый справочник пользователей с индексами по telegram_id, имени и роли"""
+
+    def __init__(self, version, users):
+        self.version = version
+        self.users = tuple(users)
+        by_id = {}
+        by_name = {}
+        by_role = {}
+        for user in self.users:
+            by_id[user.telegram_id] = user
+            # Как и SELECT ... WHERE name = ? LIMIT 1 - берем первую по id запись
+            by_name.setdefault(user.name, user)
+            by_role.setdefault(user.status, []).append(user)
+        self.by_id = MappingProxyType(by_id)
+        self.by_name = MappingProxyType(by_name)
+        self.by_role = _freeze_index(by_role)
+
+    def get(self, telegram_id):
+        """Пользователь по telegram_id или None"""
+        try:
+            return self.by_id.get(int(telegram_id))
+        except (TypeError, ValueError):
+            return None
+
+    def find_by_name(self, name):
+        """Пользователь по имени или None"""
+        return self.by_name.get(name)
+
+    def fields(self, telegram_id, *columns):
+        """Кортеж полей пользователя по telegram_id (как fetchone()) или None"""
+        user = self.get(telegram_id)
+        return tuple(getattr(user, column) for column in columns) if user else None
+
+    def fields_by_name(self, name, *columns):
+        """Кортеж полей пользователя по имени (как fetchone()) или None"""
+        user = self.find_by_name(name)
+        return tuple(getattr(user, column) for column in columns) if user else None
+
+    def status_of(self, telegram_id):
+        """Роль пользователя или None"""
+        user = self.get(telegram_id)
+        return user.status if user else None
+
+    def with_roles(self, *roles):
+        """Пользователи с указанными ролями"""
+        return tuple(user for role in roles for user in self.by_role.get(role, ()))
+
+    def with_work(self, work):
+        """Пользователи с указанным статусом work"""
+        return tuple(user for user in self.users if user.work == work)
+
+
+user_directory = None  # Текущий справочник пользователей
+user_directory_checked_at = 0.0  # Когда версия справочника последний раз сверялась с базой (monotonic)
+
+
+def refresh_user_directory():
+    """Перечитывает users и атомарно заменяет справочник"""
+    global user_directory, user_directory_checked_at
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN")
+        row = conn.execute("SELECT version FROM table_versions WHERE name = 'users'").fetchone()
+        rows = conn.execute("SELECT telegram_id, name, status, nik_name, work, id FROM users ORDER BY id").fetchall()
+        conn.rollback()
+    finally:
+        conn.close()
+    user_directory = UserDirectory(row[0] if row else 0, [UserRecord(*r) for r in rows])
+    user_directory_checked_at = time.monotonic()
+    return user_directory
+
+
+def invalidate_user_directory():
+    """
+    Сбрасывает справочник, следующий вызов get_user_directory перечитает users
+
+    Вызывается после каждого изменения users в этом воркере.
+    """
+    global user_directory
+    user_directory = None
+
+
+def get_user_directory():
+    """
+    Возвращает актуальный справочник пользователей
+
+    Вызывается на каждое обновление (user_context_middleware), поэтому в базу не ходит:
+    свои изменения воркер сбрасывает через invalidate_user_directory, а изменения
+    другого воркера видны после сверки версии - не чаще раза в CACHE_VERSION_CHECK_INTERVAL секунд.
+    """
+    global user_directory_checked_at
+    if user_directory is None:
+        return refresh_user_directory()
+    now = time.monotonic()
+    if now - user_directory_checked_at >= CACHE_VERSION_CHECK_INTERVAL:
+        user_directory_checked_at = now
+        if user_directory.version != read_table_version("users"):
+            return refresh_user_directory()
+    return user_directory
+
+
+def get_admin_ids():
+    """telegram_id администраторов и DoubleA для рассылки уведомлений"""
+    return [user.telegram_id for user in get_user_directory().with_roles(*ADMIN_ROLES)]
+
+
+async def user_context_middleware(handler, event, data):
+    """
+    Один раз на обновление находит пользователя в справочнике и передает
+    его в фильтры и обработчики как аргумент user_record (None - не зарегистрирован)
+    """
+    from_user = data.get("event_from_user")
+    data["user_record"] = get_user_directory().get(from_user.id) if from_user else None
+    return await handler(event, data)
+
+
+dp.update.outer_middleware(user_context_middleware)
+
+
+class RoleFilter(BaseFilter):
+    """Пропускает только пользователей с одной из указанных ролей"""
+
+    def __init__(self, *roles):
+        self.roles = roles
+
+    async def __call__(self, event, user_record=None):
+        return user_record is not None and user_record.status in self.roles
+
 def add_is_send_column():
-    """Добавляет колонку is_send в существующую таблицу lessons"""
+    """
+    Приводит схему уроков к актуальной
+
+    Колонка is_send теперь хранится в attendance; функция оставлена для команды
+    /add_is_send_column и просто переносит старую таблицу lessons, если она еще есть.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute('ALTER TABLE lessons ADD COLUMN is_send INTEGER DEFAULT 0')
+        ensure_lessons_schema(cursor)
         conn.commit()
-        print("[DEBUG] Колонка is_send добавлена в таблицу lessons")
+        print("[DEBUG] Схема уроков проверена, is_send хранится в attendance")
     except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            print("[DEBUG] Колонка is_send уже существует")
-        else:
-            print(f"[ERROR] Ошибка добавления колонки is_send: {e}")
+        print(f"[ERROR] Ошибка проверки схемы уроков: {e}")
     finally:
         conn.close()
 
@@ -170,7 +918,7 @@ def generate_lesson_code():
         # Проверяем уникальность в базе
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM lessons WHERE lesson_code = ?", (code,))
+        cursor.execute("SELECT COUNT(*) FROM lesson WHERE lesson_code = ?", (code,))
         count = cursor.fetchone()[0]
         conn.close()
         
@@ -185,9 +933,8 @@ def get_lesson_by_code(lesson_code):
     try:
         cursor.execute("""
             SELECT point, groupp, free 
-            FROM lessons 
-            WHERE lesson_code = ? 
-            LIMIT 1
+            FROM lesson 
+            WHERE lesson_code = ?
         """, (lesson_code,))
         
         result = cursor.fetchone()
@@ -201,6 +948,366 @@ def get_lesson_by_code(lesson_code):
     finally:
         conn.close()
 
+# ============================================================================
+# БАЗА ДАННЫХ - УРОКИ И ПОСЕЩАЕМОСТЬ
+# ============================================================================
+
+# Урок (садик, группа, время) хранится один раз в lesson, ученик - в student,
+# отметки - в attendance(lesson_id, student_id). Представление lessons повторяет
+# колонки старой таблицы для чтения; все изменения идут в нормализованные таблицы.
+LessonRow = namedtuple("LessonRow", ["id", "point", "groupp", "free", "column_d", "lesson_code"])
+
+# Сколько учеников показывается на одной странице клавиатуры отметок
+STUDENTS_PER_PAGE = 10
+
+# Страница списка учеников: rows - (id отметки, имя, присутствие)
+RosterPage = namedtuple("RosterPage", ["rows", "page", "total_pages", "total_count", "present_count"])
+
+# Счетчики учеников урока (lesson.total_count/present_count) ведут триггеры,
+# чтобы кнопка "Отправить данные" и число страниц не требовали подсчета по attendance
+ATTENDANCE_COUNT_TRIGGERS = {
+    "attendance_count_insert": """
+        AFTER INSERT ON attendance
+        BEGIN
+            UPDATE lesson SET total_count = total_count + 1, present_count = present_count + NEW.present
+            WHERE id = NEW.lesson_id;
+        END
+    """,
+    "attendance_count_delete": """
+        AFTER DELETE ON attendance
+        BEGIN
+            UPDATE lesson SET total_count = total_count - 1, present_count = present_count - OLD.present
+            WHERE id = OLD.lesson_id;
+        END
+    """,
+    "attendance_count_update": """
+        AFTER UPDATE OF lesson_id, present ON attendance
+        BEGIN
+            UPDATE lesson SET total_count = total_count - 1, present_count = present_count - OLD.present
+            WHERE id = OLD.lesson_id;
+            UPDATE lesson SET total_count = total_count + 1, present_count = present_count + NEW.present
+            WHERE id = NEW.lesson_id;
+        END
+    """,
+}
+
+ATTENDANCE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS attendance (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        lesson_id INTEGER NOT NULL REFERENCES lesson (id) ON DELETE CASCADE,
+        student_id INTEGER NOT NULL REFERENCES student (id),
+        name_s TEXT,  -- копия student.name_s: по ней упорядочены страницы клавиатур
+        present INTEGER NOT NULL DEFAULT 0 CHECK (present IN (0, 1)),
+        is_permanent INTEGER NOT NULL DEFAULT 0,
+        is_send INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+
+def ensure_lessons_schema(cursor):
+    """Создает таблицы lesson/student/attendance и переносит данные из старых форматов"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS lesson (
+            id INTEGER PRIMARY KEY,
+            schedule_rowid INTEGER,  -- rowid строки schedule на момент загрузки списка
+            point TEXT NOT NULL,
+            groupp TEXT NOT NULL,
+            free TEXT NOT NULL,
+            column_d TEXT,
+            lesson_code TEXT UNIQUE,
+            total_count INTEGER NOT NULL DEFAULT 0,
+            present_count INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (point, groupp, free)
+        )
+    """)
+    cursor.execute("PRAGMA table_info(lesson)")
+    lesson_columns = {r[1] for r in cursor.fetchall()}
+    for column in ("total_count", "present_count"):
+        if column not in lesson_columns:
+            cursor.execute(f"ALTER TABLE lesson ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    # is_new: ученика нет в таблице учеников (нет rowid строки), вычисляется SQLite
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS student (
+            id INTEGER PRIMARY KEY,
+            name_s TEXT NOT NULL,
+            student_rowid TEXT,
+            is_new INTEGER GENERATED ALWAYS AS (COALESCE(student_rowid, '') = '') VIRTUAL
+        )
+    """)
+    cursor.execute("PRAGMA table_xinfo(student)")
+    if "is_new" not in {r[1] for r in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE student ADD COLUMN is_new INTEGER GENERATED ALWAYS AS (COALESCE(student_rowid, '') = '') VIRTUAL")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_student_identity ON student (name_s, COALESCE(student_rowid, ''))")
+
+    # Представление пересоздается ниже, чтобы его определение всегда было актуальным
+    # (старая таблица lessons с тем же именем переносится и удаляется отдельно)
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = 'lessons'")
+    if (cursor.fetchone() or (None,))[0] == 'view':
+        cursor.execute("DROP VIEW lessons")
+
+    # attendance с present TEXT ('1'/'') переводим на целочисленные флаги
+    cursor.execute("PRAGMA table_info(attendance)")
+    present_type = {r[1]: r[2] for r in cursor.fetchall()}.get("present")
+    if present_type and present_type.upper() != "INTEGER":
+        cursor.execute("ALTER TABLE attendance RENAME TO attendance_text")
+        cursor.execute(ATTENDANCE_TABLE_SQL)
+        cursor.execute("""
+            INSERT INTO attendance (id, lesson_id, student_id, present, is_permanent, is_send)
+            SELECT id, lesson_id, student_id, present = '1', COALESCE(is_permanent, 0) = 1, COALESCE(is_send, 0) = 1
+            FROM attendance_text
+        """)
+        cursor.execute("DROP TABLE attendance_text")
+        print(f"[DB] attendance переведена на целочисленные флаги")
+    cursor.execute(ATTENDANCE_TABLE_SQL)
+    cursor.execute("PRAGMA table_info(attendance)")
+    if "name_s" not in {r[1] for r in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE attendance ADD COLUMN name_s TEXT")
+    for name, body in ATTENDANCE_COUNT_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+    # Покрывающий индекс списка учеников урока по алфавиту (по нему листаются
+    # страницы клавиатур, id отметки различает одинаковые имена); частичные -
+    # для подсчета присутствующих и поиска еще не отправленных новых учеников
+    cursor.execute("DROP INDEX IF EXISTS idx_attendance_lesson")
+    cursor.execute("DROP INDEX IF EXISTS idx_attendance_roster")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attendance_roster_name ON attendance (lesson_id, name_s, id, present)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attendance_present ON attendance (lesson_id) WHERE present = 1")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attendance_unsent ON attendance (lesson_id) WHERE is_send = 0")
+
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = 'lessons'")
+    row = cursor.fetchone()
+    if row and row[0] == 'table':
+        # Переносим старую таблицу: id строк сохраняются, чтобы кнопки в уже отправленных сообщениях работали
+        cursor.execute("PRAGMA table_info(lessons)")
+        legacy_columns = {r[1] for r in cursor.fetchall()}
+
+        def legacy(column, default):
+            return column if column in legacy_columns else default
+
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO lesson (point, groupp, free, column_d, lesson_code)
+            SELECT COALESCE(point, ''), COALESCE(groupp, ''), COALESCE(free, ''),
+                   MAX(NULLIF(column_d, '')), MAX({legacy('lesson_code', 'NULL')})
+            FROM lessons
+            GROUP BY COALESCE(point, ''), COALESCE(groupp, ''), COALESCE(free, '')
+        """)
+        cursor.execute("""
+            INSERT OR IGNORE INTO student (name_s, student_rowid)
+            SELECT DISTINCT COALESCE(name_s, ''), NULLIF(student_rowid, '')
+            FROM lessons
+        """)
+        cursor.execute(f"""
+            INSERT INTO attendance (id, lesson_id, student_id, present, is_permanent, is_send)
+            SELECT o.id, l.id, s.id, o.present = '1',
+                   COALESCE({legacy('o.is_permanent', '0')}, 0) = 1, COALESCE({legacy('o.is_send', '0')}, 0) = 1
+            FROM lessons o
+            JOIN lesson l ON l.point = COALESCE(o.point, '') AND l.groupp = COALESCE(o.groupp, '')
+                         AND l.free = COALESCE(o.free, '')
+            JOIN student s ON s.name_s = COALESCE(o.name_s, '')
+                          AND COALESCE(s.student_rowid, '') = COALESCE(o.student_rowid, '')
+        """)
+        print(f"[DB] Перенесено в attendance записей из старой таблицы lessons: {cursor.rowcount}")
+        cursor.execute("DROP TABLE lessons")
+
+    # Имя в attendance: для перенесенных записей и баз, созданных до колонки name_s
+    cursor.execute("""
+        UPDATE attendance SET name_s = (SELECT s.name_s FROM student s WHERE s.id = attendance.student_id)
+        WHERE name_s IS NULL
+    """)
+
+    # Пересчет счетчиков: после переноса данных и для баз, созданных до триггеров
+    cursor.execute("""
+        UPDATE lesson SET
+            total_count = (SELECT COUNT(*) FROM attendance a WHERE a.lesson_id = lesson.id),
+            present_count = (SELECT COUNT(*) FROM attendance a WHERE a.lesson_id = lesson.id AND a.present = 1)
+    """)
+
+    # Ученик "новый", если его нет в таблице учеников или у урока нет колонки посещаемости
+    cursor.execute("""
+        CREATE VIEW lessons AS
+        SELECT
+            a.id,
+            l.point,
+            l.groupp,
+            s.name_s,
+            s.student_rowid,
+            CASE WHEN s.is_new THEN NULL ELSE l.column_d END AS column_d,
+            a.present,
+            l.free,
+            a.is_permanent,
+            l.lesson_code,
+            a.is_send,
+            a.lesson_id,
+            a.student_id,
+            (s.is_new OR COALESCE(l.column_d, '') = '') AS is_new
+        FROM attendance a
+        JOIN lesson l ON l.id = a.lesson_id
+        JOIN student s ON s.id = a.student_id
+    """)
+
+
+def find_lesson(cursor, point, groupp, free):
+    """Урок по садику, группе и времени (LessonRow или None)"""
+    cursor.execute("""
+        SELECT id, point, groupp, free, column_d, lesson_code
+        FROM lesson
+        WHERE point = ? AND groupp = ? AND free = ?
+    """, (point, groupp, free))
+    row = cursor.fetchone()
+    return LessonRow(*row) if row else None
+
+
+def find_lesson_by_id(cursor, lesson_id):
+    """Урок по id (LessonRow или None)"""
+    cursor.execute("""
+        SELECT id, point, groupp, free, column_d, lesson_code
+        FROM lesson
+        WHERE id = ?
+    """, (lesson_id,))
+    row = cursor.fetchone()
+    return LessonRow(*row) if row else None
+
+
+def find_lesson_of_attendance(cursor, attendance_id):
+    """Урок, к которому относится отметка attendance_id (LessonRow или None)"""
+    cursor.execute("""
+        SELECT l.id, l.point, l.groupp, l.free, l.column_d, l.lesson_code
+        FROM attendance a
+        JOIN lesson l ON l.id = a.lesson_id
+        WHERE a.id = ?
+    """, (attendance_id,))
+    row = cursor.fetchone()
+    return LessonRow(*row) if row else None
+
+
+def upsert_lesson(cursor, point, groupp, free, column_d=None, lesson_code=None, schedule_rowid=None):
+    """Возвращает id урока, создавая его при необходимости; переданные поля обновляются"""
+    cursor.execute("""
+        INSERT INTO lesson (point, groupp, free, column_d, lesson_code, schedule_rowid)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (point, groupp, free) DO UPDATE SET
+            column_d = COALESCE(excluded.column_d, column_d),
+            lesson_code = COALESCE(excluded.lesson_code, lesson_code),
+            schedule_rowid = COALESCE(excluded.schedule_rowid, schedule_rowid)
+    """, (point, groupp, free, column_d, lesson_code, schedule_rowid))
+    return find_lesson(cursor, point, groupp, free).id
+
+
+def add_attendance(cursor, lesson_id, name_s, student_rowid=None, present=0, is_permanent=0):
+    """Добавляет ученика на урок и возвращает id отметки"""
+    student_rowid = student_rowid or None
+    cursor.execute("INSERT OR IGNORE INTO student (name_s, student_rowid) VALUES (?, ?)", (name_s, student_rowid))
+    cursor.execute("""
+        SELECT id FROM student
+        WHERE name_s = ? AND COALESCE(student_rowid, '') = COALESCE(?, '')
+    """, (name_s, student_rowid))
+    student_id = cursor.fetchone()[0]
+    cursor.execute("""
+        INSERT INTO attendance (lesson_id, student_id, name_s, present, is_permanent)
+        VALUES (?, ?, ?, ?, ?)
+    """, (lesson_id, student_id, name_s, present, is_permanent))
+    return cursor.lastrowid
+
+
+def lesson_attendance_counts(cursor, lesson_id):
+    """(всего учеников, присутствующих) на уроке"""
+    cursor.execute("SELECT total_count, present_count FROM lesson WHERE id = ?", (lesson_id,))
+    return cursor.fetchone() or (0, 0)
+
+
+ROSTER_PAGE_SQL = """
+    SELECT a.id, a.name_s, a.present
+    FROM attendance a
+    WHERE a.lesson_id = ? {condition}
+    ORDER BY a.name_s {order}, a.id {order}
+    LIMIT ? {offset}
+"""
+
+# Граница страницы задается id отметки, ключ листания - (имя, id) этой отметки
+ROSTER_AFTER = "AND (a.name_s, a.id) > (SELECT name_s, id FROM attendance WHERE id = ?)"
+ROSTER_BEFORE = "AND (a.name_s, a.id) < (SELECT name_s, id FROM attendance WHERE id = ?)"
+
+
+def fetch_roster_page(cursor, lesson_id, page=0, after_id=None, before_id=None):
+    """
+    Одна страница учеников урока (RosterPage)
+
+    Ученики идут по алфавиту, листание - по ключу (lesson_id, name_s, id):
+    after_id - последняя отметка предыдущей страницы, before_id - первая
+    отметка следующей. Без ключа (первый показ, перерисовка после отметки)
+    страница берется по номеру.
+    """
+    total_count, present_count = lesson_attendance_counts(cursor, lesson_id)
+    total_pages = max(1, (total_count + STUDENTS_PER_PAGE - 1) // STUDENTS_PER_PAGE)
+    page = min(max(page, 0), total_pages - 1)
+
+    rows = []
+    if after_id is not None:
+        cursor.execute(ROSTER_PAGE_SQL.format(condition=ROSTER_AFTER, order="", offset=""),
+                       (lesson_id, after_id, STUDENTS_PER_PAGE))
+        rows = cursor.fetchall()
+    elif before_id is not None:
+        cursor.execute(ROSTER_PAGE_SQL.format(condition=ROSTER_BEFORE, order="DESC", offset=""),
+                       (lesson_id, before_id, STUDENTS_PER_PAGE))
+        rows = cursor.fetchall()[::-1]
+    if not rows:
+        # Без ключа или если ученики на границе страницы уже удалены
+        cursor.execute(ROSTER_PAGE_SQL.format(condition="", order="", offset="OFFSET ?"),
+                       (lesson_id, STUDENTS_PER_PAGE, page * STUDENTS_PER_PAGE))
+        rows = cursor.fetchall()
+    return RosterPage(rows, page, total_pages, total_count, present_count)
+
+
+def roster_page_callback(prefix, lesson_id, direction, page, boundary_id):
+    """callback_data кнопки листания: <prefix>:<lesson_id>:<prev|next>:<страница>:<id отметки на границе>"""
+    return f"{prefix}:{lesson_id}:{direction}:{page}:{boundary_id}"
+
+
+def parse_roster_page_callback(data):
+    """(lesson_id, direction, page, boundary_id) из кнопки листания; None для старых форматов"""
+    parts = data.split(':')
+    if (len(parts) != 5 or parts[2] not in ("prev", "next")
+            or not all(part.isdigit() for part in (parts[1], parts[3], parts[4]))):
+        return None
+    return int(parts[1]), parts[2], int(parts[3]), int(parts[4])
+
+
+def split_lesson_students(cursor, lesson_id, only_present=False, skip_sent_new=False):
+    """
+    Ученики урока, уже разделенные в SQL на обычных и новых
+
+    Returns:
+        (regular, new): regular - (point, groupp, name_s, column_d, present),
+        new - (point, groupp, name_s, is_permanent)
+    """
+    present_filter = "AND present = 1" if only_present else ""
+    cursor.execute(f"""
+        SELECT point, groupp, name_s, column_d, present
+        FROM lessons
+        WHERE lesson_id = ? AND NOT is_new {present_filter}
+        ORDER BY id
+    """, (lesson_id,))
+    regular = cursor.fetchall()
+    sent_filter = "AND is_send = 0" if skip_sent_new else ""
+    cursor.execute(f"""
+        SELECT point, groupp, name_s, is_permanent
+        FROM lessons
+        WHERE lesson_id = ? AND is_new {present_filter} {sent_filter}
+        ORDER BY id
+    """, (lesson_id,))
+    return regular, cursor.fetchall()
+
+
+def delete_lessons(cursor, where="1", params=()):
+    """Удаляет уроки (условие по колонкам lesson) вместе с отметками; возвращает число удаленных отметок"""
+    cursor.execute(f"""
+        DELETE FROM attendance
+        WHERE lesson_id IN (SELECT id FROM lesson WHERE {where})
+    """, params)
+    deleted = cursor.rowcount
+    cursor.execute(f"DELETE FROM lesson WHERE {where}", params)
+    return deleted
+
+
 # ============================================================================
 # БАЗА ДАННЫХ - ОПЕРАЦИИ С РАСПИСАНИЕМ
 # ============================================================================
@@ -239,7 +1346,9 @@ def update_schedule_table(data, notify=True):
             Present TEXT,
             Detail TEXT,
             Insra TEXT,
-            foto TEXT
+            foto TEXT,
+            lesson_code TEXT,
+            starts_at INTEGER
         )
     """)
 
@@ -253,8 +1362,8 @@ def update_schedule_table(data, notify=True):
             INSERT INTO schedule (
                 Date_L, Time_L, Point, Groupp, Teacher, Assist, 
                 Adress, Modul, Theme, DateLL, Teacher_w, Assist_w, Counter_p,
-                Comment, Present, Detail, Insra
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                Comment, Present, Detail, Insra, starts_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (
             item.get("Date_L", ""),
             item.get("Time_L", ""),
@@ -272,20 +1381,21 @@ def update_schedule_table(data, notify=True):
             item.get("Comment", ""),
             item.get("Present", ""),
             item.get("Detail", ""),
-            item.get("Insra", "")
+            item.get("Insra", ""),
+            schedule_item_starts_at(item)
         ))
         added_count += 1
 
+    bump_table_version(cursor, "schedule")
     conn.commit()
+    refresh_schedule_snapshot()
 
     # Уведомление администраторам и DoubleA
     try:
-        cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-        admins = cursor.fetchall()
         message = f"Расписание обновлено!\n"
         message += f"Добавлено уроков: {added_count}"
-        for admin in admins:
-            asyncio.create_task(bot.send_message(chat_id=admin[0], text=message))
+        for admin_id in get_admin_ids():
+            asyncio.create_task(bot.send_message(chat_id=admin_id, text=message))
     except Exception as e:
         print(f"Ошибка при отправке уведомления администраторам: {e}")
 
@@ -301,7 +1411,7 @@ def update_schedule_table(data, notify=True):
 # Функция для отправки POST-запроса на вебхук
 async def send_post_request():
     try:
-        response = requests.post(WEBHOOK_URL)
+        response = post_webhook(WEBHOOK_URL)
         print("Запрос отправлен.")
 
         if response.status_code == 200:
@@ -315,24 +1425,13 @@ async def send_post_request():
 
 # Асинхронная функция для очистки lessons и обновления column в 00:00
 async def clear_lessons_and_update_column():
-    # Создаём таблицу lessons, если её нет
+    # Создаём таблицы уроков, если их нет
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS lessons (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            point TEXT,
-            groupp TEXT,
-            name_s TEXT,
-            student_rowid TEXT,
-            column_d TEXT,
-            present TEXT DEFAULT '',
-            free TEXT DEFAULT ''
-        )
-    """)
-    # Очищаем таблицу lessons
-    cursor.execute("DELETE FROM lessons")
-    lessons_deleted = cursor.rowcount
+    ensure_lessons_schema(cursor)
+    # Очищаем уроки и отметки; ученики без отметок больше не нужны
+    lessons_deleted = delete_lessons(cursor)
+    cursor.execute("DELETE FROM student WHERE id NOT IN (SELECT student_id FROM attendance)")
     print(f"[00:00] Удалено записей из lessons: {lessons_deleted}")
     conn.commit()
     # Обновляем таблицу column
@@ -356,6 +1455,7 @@ async def cleanup_old_data_friday():
         # 1. Очищаем таблицу schedule полностью
         cursor.execute("DELETE FROM schedule")
         schedule_deleted = cursor.rowcount
+        bump_table_version(cursor, "schedule")
         print(f"[FRIDAY CLEANUP] Удалено записей из schedule: {schedule_deleted}")
         
         # 2. Удаляем старые записи из fotoalbum (до прошлой субботы)
@@ -368,7 +1468,38 @@ async def cleanup_old_data_friday():
         export_deleted = cursor.rowcount
         print(f"[FRIDAY CLEANUP] Удалено записей из export_lessons: {export_deleted}")
         
+        # 4. Удаляем старые ключи идемпотентности
+        cursor.execute("DELETE FROM job_runs WHERE created_at < datetime('now', '-7 days')")
+        print(f"[FRIDAY CLEANUP] Удалено ключей из job_runs: {cursor.rowcount}")
+
+        # 5. Напоминания о фото относятся к урокам из очищенного расписания
+        cursor.execute("DELETE FROM photo_reminders")
+        print(f"[FRIDAY CLEANUP] Удалено напоминаний о фото: {cursor.rowcount}")
+
+        # 6. Хеши фото, которых больше нет в fotoalbum
+        cursor.execute("""
+            DELETE FROM photo_hashes
+            WHERE file_unique_id NOT IN (SELECT file_unique_id FROM fotoalbum WHERE file_unique_id IS NOT NULL)
+        """)
+        print(f"[FRIDAY CLEANUP] Удалено хешей фото: {cursor.rowcount}")
+
+        # 7. Брошенные выгрузки: временные файлы частей и контрольные точки
+        cursor.execute("SELECT id FROM export_jobs WHERE updated_at < datetime('now', '-7 days')")
+        stale_jobs = [row[0] for row in cursor.fetchall()]
+        if stale_jobs:
+            stale_ids = json.dumps(stale_jobs)
+            cursor.execute(
+                "SELECT path FROM export_parts WHERE path IS NOT NULL AND job_id IN (SELECT value FROM json_each(?))",
+                (stale_ids,)
+            )
+            remove_export_files(row[0] for row in cursor.fetchall())
+            for table in ("export_parts", "export_files"):
+                cursor.execute(f"DELETE FROM {table} WHERE job_id IN (SELECT value FROM json_each(?))", (stale_ids,))
+            cursor.execute("DELETE FROM export_jobs WHERE id IN (SELECT value FROM json_each(?))", (stale_ids,))
+        print(f"[FRIDAY CLEANUP] Удалено выгрузок: {len(stale_jobs)}")
+        
         conn.commit()
+        refresh_schedule_snapshot()
         print(f"[FRIDAY CLEANUP] Очистка завершена успешно!")
         print(f"[FRIDAY CLEANUP] Итого удалено: schedule={schedule_deleted}, fotoalbum={foto_deleted}, export_lessons={export_deleted}")
         
@@ -381,33 +1512,28 @@ async def cleanup_old_data_friday():
 
 # Функция для получения списка подтверждений от преподавателей (ассиситентов) в конце дня
 async def send_info_report():
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
         # Получаем всех администраторов и DoubleA
-        cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-        admins = cursor.fetchall()
+        directory = get_user_directory()
+        admins = directory.with_roles(*ADMIN_ROLES)
 
         # Формируем списки пользователей с никнеймами
         # Подтвержденные
-        cursor.execute("SELECT name, nik_name FROM users WHERE work = 'accept'")
         accepted_users = [
-            f"{user[0]} ({user[1]})" if user[1] else user[0]
-            for user in cursor.fetchall()
+            f"{user.name} ({user.nik_name})" if user.nik_name else user.name
+            for user in directory.with_work('accept')
         ]
 
         # Ожидающие
-        cursor.execute("SELECT name, nik_name FROM users WHERE work = 'wait'")
         waiting_users = [
-            f"{user[0]} ({user[1]})" if user[1] else user[0]
-            for user in cursor.fetchall()
+            f"{user.name} ({user.nik_name})" if user.nik_name else user.name
+            for user in directory.with_work('wait')
         ]
 
         # Отказы
-        cursor.execute("SELECT name, nik_name FROM users WHERE work = 'cancel'")
         canceled_users = [
-            f"{user[0]} ({user[1]})" if user[1] else user[0]
-            for user in cursor.fetchall()
+            f"{user.name} ({user.nik_name})" if user.nik_name else user.name
+            for user in directory.with_work('cancel')
         ]
 
         # Создаем сообщение
@@ -424,8 +1550,6 @@ async def send_info_report():
 
     except Exception as e:
         print(f"Ошибка при отправке автоматического отчета: {e}")
-    finally:
-        conn.close()
 
 
 # ============================================================================
@@ -433,6 +1557,77 @@ async def send_info_report():
 # ============================================================================
 
 # Функция для запуска планировщика задач
+# Сколько секунд после пропущенного времени запуска задачу еще можно догнать.
+# Ежедневные задачи догоняются после перезапуска, 5-минутные - только при небольшой задержке,
+# потому что они ищут уроки относительно текущего времени.
+MISFIRE_GRACE_DAILY = getattr(config, "SCHEDULER_MISFIRE_GRACE_DAILY", 3 * 60 * 60)
+MISFIRE_GRACE_FREQUENT = getattr(config, "SCHEDULER_MISFIRE_GRACE_FREQUENT", 60)
+# Хранилище задач планировщика: "sqlite" - таблица apscheduler_jobs в той же базе,
+# задачи и время их последнего запуска переживают перезапуск (нужен пакет SQLAlchemy:
+# pip install SQLAlchemy); "memory" - память процесса, пропущенные при простое
+# запуски не догоняются
+SCHEDULER_JOBSTORE = getattr(config, "SCHEDULER_JOBSTORE", "sqlite")
+
+
+def create_job_stores():
+    """Хранилища задач по SCHEDULER_JOBSTORE; без SQLAlchemy постоянное хранилище не запускается"""
+    if SCHEDULER_JOBSTORE == "memory":
+        print("[SCHEDULER] Задачи хранятся в памяти (SCHEDULER_JOBSTORE = 'memory')")
+        return {}
+    try:
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    except ImportError:
+        raise RuntimeError("Для SCHEDULER_JOBSTORE = 'sqlite' нужен пакет SQLAlchemy (pip install SQLAlchemy); "
+                           "чтобы хранить задачи в памяти, задайте SCHEDULER_JOBSTORE = 'memory'")
+    return {"default": SQLAlchemyJobStore(url=f"sqlite:///{DB_PATH}", tablename="apscheduler_jobs")}
+
+
+# Триггеры задач по имени: по ним run_timed_job восстанавливает плановое время запуска
+SCHEDULED_TRIGGERS = {}
+
+
+def scheduled_run_time(job_name, now):
+    """
+    Плановое время текущего запуска задачи: последнее срабатывание триггера не позже now
+
+    Запуск с опозданием (misfire) или склеенный из нескольких пропущенных (coalesce)
+    APScheduler выполняет за последнее плановое время, поэтому ключ запуска у всех
+    воркеров одинаковый. None, если задача не из планировщика или срабатывания не найдено.
+    """
+    if job_name not in SCHEDULED_TRIGGERS:
+        return None
+    trigger, misfire_grace_time = SCHEDULED_TRIGGERS[job_name]
+    # Запуск не опаздывает больше чем на misfire_grace_time (плюс минута на очередь)
+    fire_time = trigger.get_next_fire_time(None, now - timedelta(seconds=misfire_grace_time + 60))
+    last_fire_time = None
+    while fire_time is not None and fire_time <= now:
+        last_fire_time = fire_time
+        fire_time = trigger.get_next_fire_time(fire_time, fire_time + timedelta(microseconds=1))
+    return last_fire_time
+
+
+def add_scheduled_job(scheduler, job_name, trigger, misfire_grace_time):
+    """
+    Добавляет задачу в планировщик, не сбрасывая уже сохраненную.
+
+    Если задача с тем же расписанием уже есть в хранилище, оставляем ее как есть:
+    сохраненное next_run_time позволяет догнать запуск, пропущенный во время простоя.
+    """
+    SCHEDULED_TRIGGERS[job_name] = (trigger, misfire_grace_time)
+    existing = scheduler.get_job(job_name)
+    if (existing is not None and str(existing.trigger) == str(trigger)
+            and existing.misfire_grace_time == misfire_grace_time):
+        return existing
+    return scheduler.add_job(
+        run_timed_job,
+        trigger,
+        args=[job_name],
+        id=job_name,
+        misfire_grace_time=misfire_grace_time,
+        replace_existing=True
+    )
+
+
 async def start_scheduler():
     """
     Запускает планировщик задач с различными расписаниями:
@@ -443,150 +1638,312 @@ async def start_scheduler():
     - Каждые 5 минут - проверка уроков и напоминания
     
     Все время указано по часовому поясу Казахстана (Asia/Ho_Chi_Minh)
+
+    Планировщик стартует на паузе: задачи выполняет только воркер,
+    владеющий арендой scheduler_lease (см. run_scheduler_election)
+
+    Пропущенные запуски догоняются один раз (coalesce), одна задача не
+    выполняется параллельно сама с собой (max_instances=1)
     """
-    scheduler = AsyncIOScheduler()
+    scheduler = AsyncIOScheduler(
+        jobstores=create_job_stores(),
+        job_defaults={
+            "coalesce": True,
+            "max_instances": 1,
+            "misfire_grace_time": MISFIRE_GRACE_FREQUENT
+        }
+    )
     kazakhstan_timezone = timezone("Asia/Ho_Chi_Minh")  # Часовой пояс Казахстана
 
-    # Добавляем задачу в планировщика (каждый день в 19:00 по времени Казахстана)
-    scheduler.add_job(
-        send_post_request,
-        CronTrigger(hour=19, minute=0, timezone=kazakhstan_timezone)
-    )
-    # Новая задача для ежедневного отчета в 20:00 (только отчет, без очистки lessons и update_column_table)
-    scheduler.add_job(
-        send_info_report,
-        CronTrigger(hour=20, minute=00, timezone=kazakhstan_timezone)
-    )
-    # Новая задача для очистки lessons и обновления column в 00:00
-    scheduler.add_job(
-        clear_lessons_and_update_column,
-        CronTrigger(hour=0, minute=0, timezone=kazakhstan_timezone)
-    )
-    # Новая задача для проверки уроков каждые 5 минут
-    scheduler.add_job(
-        check_upcoming_lessons,
-        CronTrigger(
-            minute='4,9,14,19,24,29,34,39,44,49,54,59',  # 4, 9, 14, 19, 24, 29, 34, 39, 44, 49, 54, 59
-            timezone=kazakhstan_timezone)
-    )
-    scheduler.add_job(
-        check_pending_lessons,
-        CronTrigger(
-            minute='*/5',  # Каждые 5 минут
-            timezone=kazakhstan_timezone)
-    )
-    scheduler.add_job(
-        check_lessons_10min_before,
-        trigger='cron',
-        minute='*/5',  # Каждые 5 минут (0,5,10,15...)
-        timezone=kazakhstan_timezone
-    )
+    # Счетчики пропущенных запусков
+    scheduler.add_listener(on_scheduler_event, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+
+    # Стартуем до добавления задач, чтобы видеть задачи из постоянного хранилища
+    scheduler.start(paused=True)
+
+    # Задачи запускаются через run_timed_job, который замеряет время выполнения
+    # Добавляем задачу в планировщика (каждый день в 19:00 по времени Казахстана)
+    add_scheduled_job(
+        scheduler, "send_post_request",
+        CronTrigger(hour=19, minute=0, timezone=kazakhstan_timezone),
+        MISFIRE_GRACE_DAILY
+    )
+    # Новая задача для ежедневного отчета в 20:00 (только отчет, без очистки lessons и update_column_table)
+    add_scheduled_job(
+        scheduler, "send_info_report",
+        CronTrigger(hour=20, minute=00, timezone=kazakhstan_timezone),
+        MISFIRE_GRACE_DAILY
+    )
+    # Новая задача для очистки lessons и обновления column в 00:00
+    add_scheduled_job(
+        scheduler, "clear_lessons_and_update_column",
+        CronTrigger(hour=0, minute=0, timezone=kazakhstan_timezone),
+        MISFIRE_GRACE_DAILY
+    )
+    # Новая задача для проверки уроков каждые 5 минут
+    add_scheduled_job(
+        scheduler, "check_upcoming_lessons",
+        CronTrigger(
+            minute='4,9,14,19,24,29,34,39,44,49,54,59',  # 4, 9, 14, 19, 24, 29, 34, 39, 44, 49, 54, 59
+            timezone=kazakhstan_timezone),
+        MISFIRE_GRACE_FREQUENT
+    )
+    add_scheduled_job(
+        scheduler, "check_pending_lessons",
+        CronTrigger(
+            minute='*/5',  # Каждые 5 минут
+            timezone=kazakhstan_timezone),
+        MISFIRE_GRACE_FREQUENT
+    )
+    add_scheduled_job(
+        scheduler, "check_lessons_10min_before",
+        CronTrigger(
+            minute='*/5',  # Каждые 5 минут (0,5,10,15...)
+            timezone=kazakhstan_timezone),
+        MISFIRE_GRACE_FREQUENT
+    )
+
+    # Планировщик для напоминаний о фотографиях каждые 5 минут
+    add_scheduled_job(
+        scheduler, "check_photo_reminders",
+        CronTrigger(
+            minute='*/5',  # Каждые 5 минут
+            timezone=kazakhstan_timezone),
+        MISFIRE_GRACE_FREQUENT
+    )
+
+    # Новая задача для очистки старых данных каждую субботу в 23:57 по времени Казахстана
+    add_scheduled_job(
+        scheduler, "cleanup_old_data_friday",
+        CronTrigger(day_of_week='sat', hour=23, minute=57, timezone=kazakhstan_timezone),
+        MISFIRE_GRACE_DAILY
+    )
+
+    print("Планировщик запущен (ожидает лидерства).")
+    return scheduler
+
+
+async def run_timed_job(job_name, run_key=None):
+    """
+    Запускает задачу планировщика по имени и замеряет время ее выполнения
+
+    run_key - ключ идемпотентности запуска; по умолчанию плановое время запуска
+    (scheduled_run_time), так что один плановый запуск (например, при смене лидера или
+    догоняющем запуске после простоя) выполняется один раз. Ключ неудачного запуска
+    удаляется, чтобы запуск можно было повторить.
+    """
+    job_func = SCHEDULED_JOBS[job_name]
+    # Проверяем аренду прямо перед запуском: лидер мог смениться между тиками выборов
+    if not try_acquire_scheduler_lease():
+        inc_counter("bot_scheduler_job_skipped_total", job=job_name)
+        print(f"[LEADER] Задача {job_name} пропущена: воркер {WORKER_ID} не лидер")
+        return
+    if run_key is None:
+        now = datetime.now(timezone("Asia/Ho_Chi_Minh"))
+        run_key = (scheduled_run_time(job_name, now) or now).strftime("%Y-%m-%d %H:%M")
+    job_key = f"job:{job_name}:{run_key}"
+    if not claim_idempotency_key(job_key):
+        inc_counter("bot_scheduler_job_skipped_total", job=job_name)
+        print(f"[SCHEDULER] Задача {job_name} ({run_key}) уже выполнялась, пропускаем")
+        return
+    started = time.perf_counter()
+    try:
+        await job_func()
+    except BaseException as e:
+        release_idempotency_key(job_key)
+        inc_counter("bot_scheduler_job_errors_total", job=job_name)
+        print(f"[ERROR SCHEDULER] Задача {job_name} завершилась с ошибкой: {e}")
+        raise
+    finally:
+        observe_latency("bot_scheduler_job_duration_seconds", time.perf_counter() - started, job=job_name)
+
+
+def on_scheduler_event(event):
+    """Слушатель событий APScheduler: пропуски запусков"""
+    if event.code == EVENT_JOB_MISSED:
+        inc_counter("bot_scheduler_job_missed_total", job=event.job_id)
+        print(f"[SCHEDULER] Пропущен запуск задачи {event.job_id} ({event.scheduled_run_time})")
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        inc_counter("bot_scheduler_job_skipped_total", job=event.job_id)
+        print(f"[SCHEDULER] Задача {event.job_id} еще выполняется, запуск пропущен")
+
+
+# ============================================================================
+# ВЫБОР ЛИДЕРА ПЛАНИРОВЩИКА
+# ============================================================================
+
+# Аренда хранится в таблице scheduler_lease. Лидер продлевает ее каждые
+# SCHEDULER_LEASE_RENEW секунд; если лидер упал, через SCHEDULER_LEASE_TTL
+# секунд аренду забирает другой воркер.
+SCHEDULER_LEASE_TTL = getattr(config, "SCHEDULER_LEASE_TTL", 30)
+SCHEDULER_LEASE_RENEW = getattr(config, "SCHEDULER_LEASE_RENEW", 10)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def try_acquire_scheduler_lease():
+    """Захватывает или продлевает аренду планировщика. Возвращает True, если лидер - этот воркер"""
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # Одна атомарная вставка: занимаем свободную/просроченную аренду или продлеваем свою
+        cursor.execute("""
+            INSERT INTO scheduler_lease (name, holder, expires_at)
+            VALUES ('scheduler', ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                holder = excluded.holder,
+                expires_at = excluded.expires_at
+            WHERE scheduler_lease.holder = excluded.holder
+               OR scheduler_lease.expires_at < ?
+        """, (WORKER_ID, now + SCHEDULER_LEASE_TTL, now))
+        conn.commit()
+        cursor.execute("SELECT holder FROM scheduler_lease WHERE name = 'scheduler'")
+        row = cursor.fetchone()
+        return bool(row) and row[0] == WORKER_ID
+    finally:
+        conn.close()
+
 
-    # Планировщик для напоминаний о фотографиях каждые 5 минут
-    scheduler.add_job(
-        check_photo_reminders,
-        CronTrigger(
-            minute='*/5',  # Каждые 5 минут
-            timezone=kazakhstan_timezone)
-    )
+def release_scheduler_lease():
+    """Освобождает аренду при остановке воркера, чтобы другой воркер не ждал TTL"""
+    conn = get_db_connection()
+    try:
+        conn.execute("DELETE FROM scheduler_lease WHERE name = 'scheduler' AND holder = ?", (WORKER_ID,))
+        conn.commit()
+    finally:
+        conn.close()
 
-    # Новая задача для очистки старых данных каждую субботу в 23:57 по времени Казахстана
-    scheduler.add_job(
-        cleanup_old_data_friday,
-        CronTrigger(day_of_week='sat', hour=23, minute=57, timezone=kazakhstan_timezone)
-    )
 
-    scheduler.start()
-    print("Планировщик запущен.")
+async def run_scheduler_election(scheduler):
+    """Периодически продлевает аренду и включает/ставит на паузу планировщик"""
+    is_leader = False
+    while True:
+        try:
+            leader = try_acquire_scheduler_lease()
+        except Exception as e:
+            # Без доступа к базе считаем себя не лидером - лучше пропустить тик, чем задвоить
+            print(f"[LEADER] Ошибка продления аренды: {e}")
+            leader = False
+
+        if leader and not is_leader:
+            scheduler.resume()
+            inc_counter("bot_scheduler_leader_changes_total")
+            print(f"[LEADER] Воркер {WORKER_ID} стал лидером, планировщик запущен")
+        elif not leader and is_leader:
+            scheduler.pause()
+            inc_counter("bot_scheduler_leader_changes_total")
+            print(f"[LEADER] Воркер {WORKER_ID} потерял лидерство, планировщик на паузе")
+        is_leader = leader
+
+        await asyncio.sleep(SCHEDULER_LEASE_RENEW)
 
 # ============================================================================
 # ОБРАБОТЧИКИ ФОТОГРАФИЙ
 # ============================================================================
 
+# Напоминания о фото: первое через 45 минут после начала урока, затем каждый час, всего 3
+PHOTO_REMINDER_FIRST = getattr(config, "PHOTO_REMINDER_FIRST", 45 * 60)
+PHOTO_REMINDER_INTERVAL = getattr(config, "PHOTO_REMINDER_INTERVAL", 60 * 60)
+PHOTO_REMINDER_COUNT = getattr(config, "PHOTO_REMINDER_COUNT", 3)
+
+
+def enroll_photo_reminders(cursor):
+    """
+    Заводит состояние напоминаний для уроков с foto = 'wait', которых еще нет в photo_reminders
+
+    Срок первого напоминания считается от starts_at урока. foto - статус урока,
+    его нет в снимке расписания, поэтому уроки выбираются из schedule.
+    """
+    cursor.execute("""
+        INSERT OR IGNORE INTO photo_reminders (point, groupp, time_l, date_ll, teacher, next_due_at)
+        SELECT Point, Groupp, Time_L, DateLL, Teacher, starts_at + ?
+        FROM schedule
+        WHERE foto = 'wait' AND starts_at IS NOT NULL
+        ORDER BY rowid
+    """, (PHOTO_REMINDER_FIRST,))
+    return cursor.rowcount
+
+
 # Функция для проверки напоминаний о фотографиях
 async def check_photo_reminders():
+    """
+    Рассылает преподавателям напоминания о загрузке фото
+
+    Состояние каждого урока (сколько напоминаний ушло, когда следующее) хранится в photo_reminders,
+    созревшие напоминания выбираются одним запросом по диапазону next_due_at, поэтому урок
+    не теряется, даже если его время не попадает в 5-минутную сетку запусков.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # Получаем текущее время в Казахстане
         kaz_time = datetime.now(timezone("Asia/Ho_Chi_Minh"))
-        print(f"[DEBUG PHOTO REMINDER] Текущее время в Казахстане: {kaz_time.strftime('%H:%M')}")
-        
-        # Проверяем уроки, которые закончились 45 минут, 1:45 и 2:45 назад
-        reminder_times = []
-        for hours in [0, 1, 2]:
-            for minutes in [45]:
-                reminder_time = kaz_time - timedelta(hours=hours, minutes=minutes)
-                reminder_times.append(reminder_time.strftime("%H:%M"))
-        
-        print(f"[DEBUG PHOTO REMINDER] Времена напоминаний: {reminder_times}")
-        
-        # Ищем уроки с foto = 'wait' и временем окончания в нужные моменты
+        now_ts = kaz_time.timestamp()
+
+        # Уроки, где фото уже загружены или которых больше нет в расписании, не напоминаем
+        cursor.execute("""
+            DELETE FROM photo_reminders
+            WHERE NOT EXISTS (
+                SELECT 1 FROM schedule s
+                WHERE s.Point = photo_reminders.point
+                  AND s.Groupp = photo_reminders.groupp
+                  AND s.Time_L = photo_reminders.time_l
+                  AND s.DateLL = photo_reminders.date_ll
+                  AND s.foto = 'wait'
+            )
+        """)
+        dropped = cursor.rowcount
+        enrolled = enroll_photo_reminders(cursor)
+        # Блокировка записи не должна держаться, пока идет рассылка
+        conn.commit()
+
+        cursor.execute("""
+            SELECT rowid, point, groupp, time_l, date_ll, teacher
+            FROM photo_reminders
+            WHERE next_due_at <= ? AND sent_count < ?
+            ORDER BY teacher, time_l, point, groupp
+        """, (now_ts, PHOTO_REMINDER_COUNT))
+        due = cursor.fetchall()
+
+        # Одно сообщение на преподавателя со всеми его уроками
         lessons_to_remind = {}
-        
-        for reminder_time in reminder_times:
-            print(f"[DEBUG PHOTO REMINDER] Ищем уроки для времени {reminder_time}")
-            
-            cursor.execute("""
-                SELECT Point, Groupp, Teacher, Time_L, DateLL
-                FROM schedule 
-                WHERE foto = 'wait' AND Time_L = ?
-            """, (reminder_time,))
-            
-            lessons = cursor.fetchall()
-            print(f"[DEBUG PHOTO REMINDER] Найдено уроков для {reminder_time}: {len(lessons)}")
-            
-            for lesson in lessons:
-                point, groupp, teacher, time_l, date_ll = lesson
-                print(f"[DEBUG PHOTO REMINDER] Урок: {point}, {groupp}, {teacher}, {time_l}, {date_ll}")
-                
-                if teacher not in lessons_to_remind:
-                    lessons_to_remind[teacher] = []
-                
-                lessons_to_remind[teacher].append({
-                    'point': point,
-                    'groupp': groupp,
-                    'time_l': time_l,
-                    'date_ll': date_ll
-                })
-        
-        print(f"[DEBUG PHOTO REMINDER] Всего преподавателей для напоминаний: {len(lessons_to_remind)}")
-        
-        # Отправляем напоминания преподавателям
+        for _, point, groupp, time_l, date_ll, teacher in due:
+            lessons_to_remind.setdefault(teacher, []).append((point, groupp, time_l))
+
+        directory = get_user_directory()
+        sent = 0
         for teacher_name, lessons in lessons_to_remind.items():
-            print(f"[DEBUG PHOTO REMINDER] Обрабатываем преподавателя: {teacher_name}")
-            
-            # Получаем telegram_id преподавателя
-            cursor.execute("SELECT telegram_id FROM users WHERE name = ?", (teacher_name,))
-            teacher_row = cursor.fetchone()
-            
-            if teacher_row:
-                teacher_id = teacher_row[0]
-                print(f"[DEBUG PHOTO REMINDER] Найден telegram_id: {teacher_id}")
-                
-                # Формируем сообщение с напоминанием
-                message = "📸 Отправьте фото и видео по урокам:\n\n"
-                
-                for lesson in lessons:
-                    message += f"• {lesson['point']}, {lesson['groupp']}, {lesson['time_l']}\n"
-                
-                message += "\nИспользуйте команду /foto для загрузки фото и видео."
-                
-                try:
-                    await bot.send_message(chat_id=teacher_id, text=message)
-                    print(f"[PHOTO REMINDER] Напоминание отправлено преподавателю {teacher_name}")
-                except Exception as e:
-                    print(f"[ERROR] Ошибка отправки напоминания преподавателю {teacher_name}: {e}")
-            else:
-                print(f"[DEBUG PHOTO REMINDER] Преподаватель {teacher_name} не найден в таблице users")
-        
-        # Дополнительная отладка: показываем все уроки с foto = 'wait'
-        cursor.execute("SELECT Point, Groupp, Teacher, Time_L, DateLL, foto FROM schedule WHERE foto = 'wait'")
-        all_wait_lessons = cursor.fetchall()
-        print(f"[DEBUG PHOTO REMINDER] Всего уроков с foto = 'wait': {len(all_wait_lessons)}")
-        for lesson in all_wait_lessons:
-            print(f"[DEBUG PHOTO REMINDER] Урок с foto = 'wait': {lesson}")
+            teacher_row = directory.fields_by_name(teacher_name, "telegram_id")
+            if not teacher_row:
+                print(f"[PHOTO REMINDER] Преподаватель {teacher_name} не найден в таблице users")
+                continue
+
+            message = "📸 Отправьте фото и видео по урокам:\n\n"
+            for point, groupp, time_l in lessons:
+                message += f"• {point}, {groupp}, {time_l}\n"
+            message += "\nИспользуйте команду /foto для загрузки фото и видео."
+
+            try:
+                await bot.send_message(chat_id=teacher_row[0], text=message)
+                sent += 1
+                print(f"[PHOTO REMINDER] Напоминание отправлено преподавателю {teacher_name}")
+            except Exception as e:
+                print(f"[ERROR] Ошибка отправки напоминания преподавателю {teacher_name}: {e}")
+
+        # Каждое напоминание - одна попытка, как и раньше. После простоя бота следующее
+        # напоминание переносится на интервал от текущего момента, а не шлется пачкой.
+        # Обновляются только выбранные выше строки, отдельной короткой транзакцией
+        if due:
+            cursor.execute("""
+                UPDATE photo_reminders
+                SET sent_count = sent_count + 1,
+                    next_due_at = MAX(next_due_at + ?, ? + ?)
+                WHERE rowid IN (SELECT value FROM json_each(?))
+            """, (PHOTO_REMINDER_INTERVAL, now_ts, PHOTO_REMINDER_INTERVAL, json.dumps([row[0] for row in due])))
+            conn.commit()
+
+        print(f"[PHOTO REMINDER] Новых уроков: {enrolled}, снято: {dropped}, "
+              f"к напоминанию: {len(due)}, сообщений: {sent}")
         
     except Exception as e:
         print(f"[ERROR] Ошибка в check_photo_reminders: {e}")
@@ -613,12 +1970,7 @@ def is_user_registered(telegram_id):
     Returns:
         bool: True если пользователь зарегистрирован, False иначе
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    return get_user_directory().get(telegram_id)
 
 # Добавляем пользователя в базу данных
 def register_user(telegram_id, name, status, nik_name):
@@ -627,6 +1979,7 @@ def register_user(telegram_id, name, status, nik_name):
     cursor.execute("INSERT INTO users (telegram_id, name, status, nik_name) VALUES (?, ?, ?, ?)", (telegram_id, name, status, nik_name))
     conn.commit()
     conn.close()
+    invalidate_user_directory()
     
     # Отправляем веб-хук для новых преподавателей
     if status == "Teacher":
@@ -636,7 +1989,7 @@ def register_user(telegram_id, name, status, nik_name):
 def send_new_teacher_webhook(teacher_name):
     try:
         payload = {"teacher_name": teacher_name}
-        response = requests.post(WEBHOOK_CHECK_NEW_TEACHER_URL, json=payload, timeout=10)
+        response = post_webhook(WEBHOOK_CHECK_NEW_TEACHER_URL, json=payload, timeout=10)
         # Логируем результат, но не показываем пользователю
         logging.info(f"Webhook sent for new teacher {teacher_name}: {response.status_code}")
     except Exception as e:
@@ -797,11 +2150,7 @@ async def set_name(message: Message, state: FSMContext):
 
     #ВСТАВКА
     # Проверяем, существует ли уже такое имя в базе
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE name = ?", (name,))
-    existing_user = cursor.fetchone()
-    conn.close()
+    existing_user = get_user_directory().find_by_name(name)
 
     if existing_user:
         # Если имя уже занято - выводим сообщение и сбрасываем состояние
@@ -837,6 +2186,13 @@ async def set_name(message: Message, state: FSMContext):
 
 #Обработка неподтвержденных уроков за 30 минут
 async def check_pending_lessons():
+    """
+    Отчет администраторам за 30 минут до урока: кто не подтвердил или отказался
+
+    Уроки и ники берутся одним запросом (schedule JOIN users), перевод wait -> waitold -
+    одним UPDATE по списку rowid. Время этапов пишется в метрику bot_job_stage_seconds.
+    """
+    started = time.perf_counter()
     conn = get_db_connection()
     cursor = conn.cursor()
 
@@ -846,21 +2202,35 @@ async def check_pending_lessons():
 
     # Время урока = текущее время + 30 минут
     lesson_time = (kaz_time + timedelta(minutes=30)).strftime("%H:%M")
+    window_start, window_end = lesson_window(kaz_time, 30)
 
-    # 1. Находим все подходящие уроки
+    # 1. Находим все уроки с неподтвержденными/отмененными статусами вместе с никами
+    # (staff.rn = 1 - как раньше, первый пользователь с таким именем)
     cursor.execute("""
-        SELECT 
-            rowid,
-            Time_L,
-            Point,
-            Teacher,
-            Assist,
-            Teacher_w,
-            Assist_w
-        FROM schedule
-        WHERE Time_L = ?
-    """, (lesson_time,))
+        WITH staff AS (
+            SELECT name, nik_name, ROW_NUMBER() OVER (PARTITION BY name ORDER BY id) AS rn
+            FROM users
+            WHERE status IN ('Teacher', 'Admin', 'DoubleA', 'Account')
+        )
+        SELECT
+            s.rowid,
+            s.Time_L,
+            s.Point,
+            s.Teacher,
+            s.Assist,
+            s.Teacher_w,
+            s.Assist_w,
+            COALESCE(t.nik_name, 'нет ника'),
+            COALESCE(a.nik_name, 'нет ника')
+        FROM schedule s
+        LEFT JOIN staff t ON t.name = s.Teacher AND t.rn = 1
+        LEFT JOIN staff a ON a.name = s.Assist AND a.rn = 1
+        WHERE s.starts_at > ? AND s.starts_at <= ?
+          AND (s.Teacher_w IN ('wait', 'cancel') OR s.Assist_w IN ('wait', 'cancel'))
+        ORDER BY s.starts_at, s.rowid
+    """, (window_start, window_end))
     lessons = cursor.fetchall()
+    queried = time.perf_counter()
 
     # 2. Собираем данные для отчета
     report = {
@@ -872,19 +2242,11 @@ async def check_pending_lessons():
     }
 
     for lesson in lessons:
-        rowid, time_l, point, teacher, assist, t_status, a_status = lesson
+        rowid, time_l, point, teacher, assist, t_status, a_status, t_nik, a_nik = lesson
 
         # Обработка преподавателей
         if t_status in ('wait', 'cancel'):
-            # Получаем ник преподавателя
-            cursor.execute("""
-                SELECT nik_name FROM users 
-                WHERE name = ? AND status IN ('Teacher', 'Admin', 'DoubleA', 'Account')
-            """, (teacher,))
-            nik = cursor.fetchone()
-            nik = nik[0] if nik else "нет ника"
-
-            entry = f"{time_l}, {teacher}, {nik}, {point}"
+            entry = f"{time_l}, {teacher}, {t_nik}, {point}"
 
             if t_status == 'wait':
                 report['teacher_wait'].append(entry)
@@ -894,15 +2256,7 @@ async def check_pending_lessons():
 
         # Обработка ассистентов
         if a_status in ('wait', 'cancel'):
-            # Получаем ник ассистента
-            cursor.execute("""
-                SELECT nik_name FROM users 
-                WHERE name = ? AND status IN ('Teacher', 'Admin', 'DoubleA', 'Account')
-            """, (assist,))
-            nik = cursor.fetchone()
-            nik = nik[0] if nik else "нет ника"
-
-            entry = f"{time_l}, {assist}, {nik}, {point}"
+            entry = f"{time_l}, {assist}, {a_nik}, {point}"
 
             if a_status == 'wait':
                 report['assist_wait'].append(entry)
@@ -927,12 +2281,12 @@ async def check_pending_lessons():
 
     full_message = "\n\n".join(message_parts)
 
-    # 4. Обновляем статусы wait -> waitold
+    # 4. Обновляем статусы wait -> waitold одним запросом
     if report['update_ids']:
         # Уникальные ID для обновления
-        unique_ids = list(set(report['update_ids']))
+        unique_ids = sorted(set(report['update_ids']))
 
-        cursor.executemany("""
+        cursor.execute("""
             UPDATE schedule
             SET
                 Teacher_w = CASE 
@@ -943,24 +2297,29 @@ async def check_pending_lessons():
                               WHEN Assist_w = 'wait' THEN 'waitold' 
                               ELSE Assist_w 
                            END
-            WHERE rowid = ?
-        """, [(row_id,) for row_id in unique_ids])
+            WHERE rowid IN (SELECT value FROM json_each(?))
+        """, (json.dumps(unique_ids),))
 
         conn.commit()
+    conn.close()
+    updated = time.perf_counter()
 
     # 5. Отправляем сообщение администраторам и DoubleA
     if full_message:
-        cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-        admins = cursor.fetchall()
-
-        for admin in admins:
+        for admin_id in get_admin_ids():
             await bot.send_message(
-                chat_id=admin[0],
+                chat_id=admin_id,
                 text=full_message,
                 parse_mode='HTML'
             )
+    finished = time.perf_counter()
 
-    conn.close()
+    observe_latency("bot_job_stage_seconds", queried - started, job="check_pending_lessons", stage="query")
+    observe_latency("bot_job_stage_seconds", updated - queried, job="check_pending_lessons", stage="update")
+    observe_latency("bot_job_stage_seconds", finished - updated, job="check_pending_lessons", stage="notify")
+    print(f"[PENDING] Уроков в {lesson_time}: {len(lessons)}, обновлено {len(report['update_ids'])}, "
+          f"запрос {(queried - started) * 1000:.1f} мс, обновление {(updated - queried) * 1000:.1f} мс, "
+          f"рассылка {(finished - updated) * 1000:.1f} мс")
 
 
 
@@ -982,10 +2341,10 @@ def process_schedule_and_notify():
     """
     conn = get_db_connection()
     cursor = conn.cursor()
+    snapshot = get_schedule_snapshot()
 
-    # Получаем всех пользователей из таблицы users
-    cursor.execute("SELECT telegram_id, name FROM users")
-    users = cursor.fetchall()
+    # Получаем всех пользователей из справочника
+    users = [(u.telegram_id, u.name) for u in get_user_directory().users]
 
     # Словарь для хранения сообщений для каждого пользователя
     messages = {}
@@ -994,13 +2353,11 @@ def process_schedule_and_notify():
     for user in users:
         telegram_id, name = user
 
-        # Ищем уроки, где пользователь Teacher ИЛИ Assist (изменение здесь)
-        cursor.execute("""
-            SELECT Time_L, Point, Adress, Theme, Modul, Insra, Detail, Present, Comment, datell
-            FROM schedule
-            WHERE Teacher = ? OR Assist = ?
-        """, (name, name))  # Добавлен второй параметр
-        lessons = cursor.fetchall()
+        # Ищем уроки, где пользователь Teacher ИЛИ Assist
+        lessons = [
+            (l.Time_L, l.Point, l.Adress, l.Theme, l.Modul, l.Insra, l.Detail, l.Present, l.Comment, l.DateLL)
+            for l in snapshot.for_person(name)
+        ]
 
         if lessons:
             # Если уроки найдены, формируем сообщение
@@ -1028,6 +2385,7 @@ def process_schedule_and_notify():
 
     # Сохраняем изменения в базе данных
     conn.commit()
+    invalidate_user_directory()
 
     # Отправляем сообщения пользователям
     for telegram_id, message in messages.items():
@@ -1054,32 +2412,24 @@ def process_schedule_and_notify():
 async def notify_assistants_for_trial_lessons():
     """Поиск пробных уроков без ассистента и отправка уведомлений преподавателям"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         # Ищем пробные уроки без ассистента
-        cursor.execute("""
-            SELECT Point, Adress, DateLL, Time_L, rowid
-            FROM schedule 
-            WHERE groupp = 'Пробное' 
-            AND (Assist IS NULL OR Assist = '' OR Assist = 'Нет')
-        """)
-        trial_lessons = cursor.fetchall()
+        trial_lessons = [
+            (l.Point, l.Adress, l.DateLL, l.Time_L, l.rowid)
+            for l in get_schedule_snapshot().lessons
+            if l.Groupp == 'Пробное' and l.Assist in (None, '', 'Нет')
+        ]
         
         if not trial_lessons:
             print("[ASSIST] Пробных уроков без ассистента не найдено")
-            conn.close()
             return
         
         print(f"[ASSIST] Найдено {len(trial_lessons)} пробных уроков без ассистента")
         
         # Получаем всех преподавателей
-        cursor.execute("SELECT telegram_id, name FROM users WHERE status = 'Teacher'")
-        teachers = cursor.fetchall()
+        teachers = [(u.telegram_id, u.name) for u in get_user_directory().with_roles('Teacher')]
         
         if not teachers:
             print("[ASSIST] Преподаватели не найдены")
-            conn.close()
             return
         
         # Отправляем уведомления о каждом пробном уроке
@@ -1108,8 +2458,6 @@ async def notify_assistants_for_trial_lessons():
                 except Exception as e:
                     print(f"[ERROR ASSIST] Ошибка отправки уведомления преподавателю {teacher_name}: {e}")
         
-        conn.close()
-        
     except Exception as e:
         print(f"[ERROR ASSIST] Ошибка в notify_assistants_for_trial_lessons: {e}")
         import traceback
@@ -1137,8 +2485,7 @@ async def handle_assist_accept(callback: CallbackQuery):
         cursor = conn.cursor()
         
         # Получаем имя пользователя
-        cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (user_id,))
-        user_data = cursor.fetchone()
+        user_data = get_user_directory().fields(user_id, "name")
         
         if not user_data:
             await callback.answer("Ошибка: пользователь не найден")
@@ -1147,15 +2494,14 @@ async def handle_assist_accept(callback: CallbackQuery):
         user_name = user_data[0]
         
         # Проверяем, не занят ли уже ассистент
-        cursor.execute("SELECT Assist FROM schedule WHERE rowid = ?", (lesson_id,))
-        assist_data = cursor.fetchone()
+        lesson = get_schedule_snapshot().get(lesson_id)
         
-        if not assist_data:
+        if not lesson:
             await callback.answer("Ошибка: урок не найден")
             conn.close()
             return
         
-        current_assist = assist_data[0]
+        current_assist = lesson.Assist
         
         if current_assist and current_assist.strip() and current_assist != 'Нет':
             # Ассистент уже назначен
@@ -1166,25 +2512,38 @@ async def handle_assist_accept(callback: CallbackQuery):
             conn.close()
             return
         
-        # Назначаем ассистента
-        cursor.execute("UPDATE schedule SET Assist = ? WHERE rowid = ?", (user_name, lesson_id))
+        # Назначаем ассистента (условие защищает от гонки, если снимок уже устарел)
+        cursor.execute("""
+            UPDATE schedule SET Assist = ?
+            WHERE rowid = ? AND (Assist IS NULL OR TRIM(Assist) = '' OR Assist = 'Нет')
+        """, (user_name, lesson_id))
+        assigned = cursor.rowcount
+        if assigned:
+            # Ассистент - часть состава урока, снимок должен его увидеть
+            bump_table_version(cursor, "schedule")
         conn.commit()
+        if assigned:
+            refresh_schedule_snapshot()
+        if assigned == 0:
+            await callback.message.edit_text(
+                callback.message.text + "\n\nАссистент на это занятие уже выбран."
+            )
+            await callback.answer("Ассистент уже выбран")
+            conn.close()
+            return
         
         # Получаем данные урока для webhook
-        cursor.execute("SELECT Point, Adress, DateLL, Time_L FROM schedule WHERE rowid = ?", (lesson_id,))
-        lesson_data = cursor.fetchone()
+        lesson_data = (lesson.Point, lesson.Adress, lesson.DateLL, lesson.Time_L)
         
         if lesson_data:
             point, adress, datell, time_l = lesson_data
             
             # Получаем ник ассистента
-            cursor.execute("SELECT nik_name FROM users WHERE name = ?", (user_name,))
-            nik_row = cursor.fetchone()
+            nik_row = get_user_directory().fields_by_name(user_name, "nik_name")
             nik_name = nik_row[0] if nik_row and nik_row[0] else "нет ника"
             
             # Уведомляем админов и DoubleA о найденном ассистенте
-            cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-            admins = cursor.fetchall()
+            admins = get_user_directory().with_roles(*ADMIN_ROLES)
             
             admin_message = f"На Пробное занятие в Садик: {point}, Дата: {datell}, Время: {time_l} найден ассистент: {user_name} ({nik_name})"
             
@@ -1200,7 +2559,7 @@ async def handle_assist_accept(callback: CallbackQuery):
             }
             
             try:
-                response = requests.post(WEBHOOK_ASSISTANT_URL, json=webhook_data, timeout=10)
+                response = post_webhook(WEBHOOK_ASSISTANT_URL, json=webhook_data, timeout=10)
                 print(f"[ASSIST WEBHOOK] Отправлен webhook: {response.status_code}")
             except Exception as e:
                 print(f"[ERROR ASSIST WEBHOOK] Ошибка отправки webhook: {e}")
@@ -1252,8 +2611,7 @@ async def handle_confirm_evening(callback: CallbackQuery):
     cursor.execute("UPDATE users SET work = 'accept' WHERE telegram_id = ?", (user_id,))
 
     #Получаем имя и ник пользователя
-    cursor.execute("SELECT name, nik_name FROM users WHERE telegram_id = ?", (user_id,))
-    user_data = cursor.fetchone()
+    user_data = get_user_directory().fields(user_id, "name", "nik_name")
     user_name, nik_name = user_data if user_data else ("Неизвестный", "")
 
     # Находим всех всех администраторов
@@ -1261,6 +2619,7 @@ async def handle_confirm_evening(callback: CallbackQuery):
     #admins = cursor.fetchall()
     conn.commit()
     conn.close()
+    invalidate_user_directory()
 
     # Формируем сообщение с ником
     #admin_message = f"{user_name}"
@@ -1284,18 +2643,16 @@ async def handle_cancel_evening(callback: CallbackQuery):
     cursor.execute("UPDATE users SET work = 'cancel' WHERE telegram_id = ?", (user_id,))
 
     # Получаем имя и ник пользователя
-    cursor.execute("SELECT name, nik_name FROM users WHERE telegram_id = ?", (user_id,))
-    user_data = cursor.fetchone()
+    user_data = get_user_directory().fields(user_id, "name", "nik_name")
     user_name, nik_name = user_data if user_data else ("Неизвестный", "")
 
     # Находим всех администраторов и DoubleA
-    cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-    admins = cursor.fetchall()
+    admins = get_user_directory().with_roles(*ADMIN_ROLES)
 
     # Пытаемся найти rowid урока, который отменяет преподаватель (ищем по Teacher и work='cancel', берем ближайший по времени)
-    cursor.execute("SELECT rowid, Time_L, Point, Groupp, Theme FROM schedule WHERE Teacher = ? ORDER BY Date_L DESC, Time_L DESC LIMIT 1", (user_name,))
-    lesson_row = cursor.fetchone()
-    rowid = lesson_row[0] if lesson_row else None
+    teacher_lessons = [l for l in get_schedule_snapshot().for_person(user_name) if l.Teacher == user_name]
+    lesson_row = max(teacher_lessons, key=lambda l: (l.Date_L or "", l.Time_L or ""), default=None)
+    rowid = lesson_row.rowid if lesson_row else None
 
     # Формируем сообщение с ником
     admin_message = f"🔴 {user_name}"
@@ -1316,6 +2673,7 @@ async def handle_cancel_evening(callback: CallbackQuery):
 
     conn.commit()
     conn.close()
+    invalidate_user_directory()
 
     await callback.answer()
     await callback.message.answer("Вы отказались от уроков")
@@ -1324,15 +2682,11 @@ async def handle_cancel_evening(callback: CallbackQuery):
 @dp.callback_query(lambda c: c.data.startswith('invite_teacher:'))
 async def handle_invite_teacher(callback: CallbackQuery):
     rowid = callback.data.split(':')[1]
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT Time_L, Point, Groupp, Theme FROM schedule WHERE rowid = ?", (rowid,))
-    lesson = cursor.fetchone()
+    lesson = get_schedule_snapshot().get(rowid)
     if not lesson:
         await callback.answer("Урок не найден", show_alert=True)
-        conn.close()
         return
-    time_l, point, groupp, theme = lesson
+    time_l, point, groupp, theme = lesson.Time_L, lesson.Point, lesson.Groupp, lesson.Theme
     # Формируем текст приглашения
     message = f"Ищем преподавателя на уроки:\nВремя: {time_l}\nСадик: {point}\nГруппа: {groupp}\nТема: {theme}"
     # Кнопка 'Принять'
@@ -1340,11 +2694,9 @@ async def handle_invite_teacher(callback: CallbackQuery):
         [InlineKeyboardButton(text="Принять", callback_data=f"accept_lesson:{rowid}")]
     ])
     # Получаем всех преподавателей
-    cursor.execute("SELECT telegram_id FROM users WHERE status = 'Teacher'")
-    teachers = cursor.fetchall()
+    teachers = get_user_directory().with_roles('Teacher')
     for teacher in teachers:
         await bot.send_message(chat_id=teacher[0], text=message, reply_markup=keyboard)
-    conn.close()
     await callback.answer("Приглашение отправлено преподавателям")
 
 # --- Новый обработчик: принятие урока преподавателем ---
@@ -1352,31 +2704,24 @@ async def handle_invite_teacher(callback: CallbackQuery):
 async def handle_accept_lesson(callback: CallbackQuery):
     rowid = callback.data.split(':')[1]
     user_id = callback.from_user.id
-    conn = get_db_connection()
-    cursor = conn.cursor()
     # Получаем имя и ник преподавателя
-    cursor.execute("SELECT name, nik_name FROM users WHERE telegram_id = ?", (user_id,))
-    user_data = cursor.fetchone()
+    user_data = get_user_directory().fields(user_id, "name", "nik_name")
     user_name, nik_name = user_data if user_data else ("Неизвестный", "")
     # Получаем параметры урока
-    cursor.execute("SELECT Time_L, Point, Groupp, Theme FROM schedule WHERE rowid = ?", (rowid,))
-    lesson = cursor.fetchone()
+    lesson = get_schedule_snapshot().get(rowid)
     if not lesson:
         await callback.answer("Урок не найден", show_alert=True)
-        conn.close()
         return
-    time_l, point, groupp, theme = lesson
+    time_l, point, groupp, theme = lesson.Time_L, lesson.Point, lesson.Groupp, lesson.Theme
     # Сообщение для админов
     admin_message = f"🟢 {user_name}"
     if nik_name:
         admin_message += f" ({nik_name})"
     admin_message += f" ПРИНЯЛ уроки:\nВремя: {time_l}\nСадик: {point}\nГруппа: {groupp}\nТема: {theme}"
     # Получаем всех админов и DoubleA
-    cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-    admins = cursor.fetchall()
+    admins = get_user_directory().with_roles(*ADMIN_ROLES)
     for admin in admins:
         await bot.send_message(chat_id=admin[0], text=admin_message)
-    conn.close()
     await callback.answer("Вы приняли урок! Информация отправлена администраторам.")
 
 
@@ -1393,8 +2738,7 @@ async def handle_confirm_upcoming(callback: CallbackQuery):
     cursor = conn.cursor()
 
     # Получаем имя пользователя по telegram_id
-    cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = cursor.fetchone()
+    row = get_user_directory().fields(telegram_id, "name")
     name = row[0] if row else None
     if not name:
         conn.close()
@@ -1440,8 +2784,7 @@ async def handle_cancel_upcoming(callback: CallbackQuery):
     cursor = conn.cursor()
 
     # Получаем имя пользователя по telegram_id
-    cursor.execute("SELECT name, nik_name FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = cursor.fetchone()
+    row = get_user_directory().fields(telegram_id, "name", "nik_name")
     name = row[0] if row else None
     nik_name = row[1] if row else ""
     if not name:
@@ -1477,8 +2820,7 @@ async def handle_cancel_upcoming(callback: CallbackQuery):
         admin_message += f" ({nik_name})"
     admin_message += " ОТКАЗАЛСЯ от урока."
 
-    cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-    admins = cursor.fetchall()
+    admins = get_user_directory().with_roles(*ADMIN_ROLES)
     for admin in admins:
         await bot.send_message(chat_id=admin[0], text=admin_message)
 
@@ -1498,6 +2840,7 @@ def delete_user(telegram_id):
     cursor.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
     conn.commit()
     conn.close()
+    invalidate_user_directory()
 
 ## Команда /delete
 @dp.message(Command("delete"))
@@ -1514,134 +2857,128 @@ async def delete_user_command(message: Message):
 
 #Рассылка за час до занятия
 async def check_upcoming_lessons():
+    """
+    Напоминание за час до первого урока каждого преподавателя/ассистента в садике
+
+    Первый урок человека в садике и список всех его уроков там считаются одним
+    запросом с оконными функциями; статусы обновляются одним UPDATE на весь тик.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
 
     kaz_time = datetime.now(timezone("Asia/Ho_Chi_Minh"))
     time_plus_1h = (kaz_time + timedelta(minutes=61)).strftime("%H:%M")
+    window_start, window_end = lesson_window(kaz_time, 61)
 
-    # Выбираем уроки с преподавателем и ассистентом
+    # Уроки преподавателей и ассистентов одним набором; для каждой пары (роль, человек, садик),
+    # у которой есть урок в окне (window_start, window_end], берем первый урок (rn = 1)
+    # и сводку по всем урокам в садике
     cursor.execute("""
-        SELECT rowid, Time_L, Point, Adress, Teacher, Assist
-        FROM schedule
-        WHERE Time_L = ?
-    """, (time_plus_1h,))
-
-    lessons = cursor.fetchall()
+        WITH person_lessons AS (
+            SELECT rowid AS lesson_rowid, 'Teacher' AS role, Teacher AS name, Point, Adress, Time_L, starts_at, Insra
+            FROM schedule
+            WHERE Teacher != ''
+            UNION ALL
+            SELECT rowid, 'Assist', Assist, Point, Adress, Time_L, starts_at, Insra
+            FROM schedule
+            WHERE Assist != ''
+        ),
+        due AS (
+            SELECT DISTINCT role, name, Point
+            FROM person_lessons
+            WHERE starts_at > ? AND starts_at <= ?
+        ),
+        ranked AS (
+            SELECT
+                p.lesson_rowid, p.role, p.name, p.Point, p.Adress, p.starts_at,
+                ROW_NUMBER() OVER person_point AS rn,
+                group_concat(p.Time_L, ', ') OVER whole_point AS all_times,
+                json_group_array(json_array(p.Time_L, p.Insra)) OVER whole_point AS scenarios,
+                json_group_array(p.lesson_rowid) OVER whole_point AS point_rowids
+            FROM person_lessons p
+            JOIN due d ON d.role = p.role AND d.name = p.name AND d.Point = p.Point
+            WINDOW person_point AS (
+                       PARTITION BY p.role, p.name, p.Point
+                       ORDER BY p.starts_at IS NULL, p.starts_at, p.Time_L, p.lesson_rowid
+                   ),
+                   whole_point AS (person_point ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+        )
+        SELECT lesson_rowid, role, name, Point, Adress, all_times, scenarios, point_rowids
+        FROM ranked
+        WHERE rn = 1 AND starts_at > ? AND starts_at <= ?
+    """, (window_start, window_end, window_start, window_end))
+
+    first_lessons = cursor.fetchall()
+
+    teacher_rowids = []  # Первые уроки, где Teacher_w -> 'wait'
+    assist_rowids = []  # Первые уроки, где Assist_w -> 'wait'
+    foto_rowids = []  # Все уроки уведомленных людей в этих садиках, где foto -> 'wait'
+    directory = get_user_directory()
+
+    for rowid, role, name, point, address, times_str, scenarios, point_rowids in first_lessons:
+        # Проверка регистрации в системе
+        user = directory.find_by_name(name)
+        if not user:
+            continue
 
-    for lesson in lessons:
-        rowid, time_l, point, address, teacher, assist = lesson
-
-        # Обрабатываем преподавателя и ассистента
-        for role, name, status_column in [
-            ('Teacher', teacher, 'Teacher_w'),
-            ('Assist', assist, 'Assist_w')
-        ]:
-            if not name:  # Пропускаем пустые значения
-                continue
+        # Формируем блок сценариев
+        scenario_block = ""
+        scenario_lines = []
+        for t, insra in json.loads(scenarios):
+            if insra and insra.strip():
+                scenario_lines.append(f"<b>{t}</b>: <a href=\"{insra}\">сценарий</a>")
+        if scenario_lines:
+            scenario_block = "\nНе забудьте до занятия прочитать сценарий:\n" + "\n".join(scenario_lines)
 
-            # Проверка регистрации в системе
-            cursor.execute("SELECT 1 FROM users WHERE name = ?", (name,))
-            if not cursor.fetchone():
-                continue
+        # Добавляем кнопки
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text="Подтвердить",
+                    callback_data=f"upcoming_confirm_{user.telegram_id}_{rowid}"
+                ),
+                InlineKeyboardButton(
+                    text="Отказаться",
+                    callback_data=f"upcoming_cancel_{user.telegram_id}_{rowid}"
+                )
+            ]
+        ])
 
-            # Проверка ранних уроков для роли
-            cursor.execute(f"""
-                SELECT 1 
-                FROM schedule 
-                WHERE {role} = ? 
-                AND Point = ? 
-                AND Time_L < ?
-                LIMIT 1
-            """, (name, point, time_l))
-
-            if cursor.fetchone():
-                continue  # Есть ранние уроки - пропускаем
-
-            # Сбор всех уроков для роли в точке (для сценариев)
-            cursor.execute(f'''
-                SELECT Time_L, Insra
-                FROM schedule
-                WHERE {role} = ? AND Point = ?
-                ORDER BY Time_L
-            ''', (name, point))
-            lessons_for_role = cursor.fetchall()
-            all_times = [row[0] for row in lessons_for_role]
-            times_str = ", ".join(all_times)
-
-            # Формируем блок сценариев
-            scenario_block = ""
-            scenario_lines = []
-            for t, insra in lessons_for_role:
-                if insra and insra.strip():
-                    scenario_lines.append(f"<b>{t}</b>: <a href=\"{insra}\">сценарий</a>")
-            if scenario_lines:
-                scenario_block = "\nНе забудьте до занятия прочитать сценарий:\n" + "\n".join(scenario_lines)
-
-            # Отправка уведомления
-            cursor.execute("SELECT telegram_id FROM users WHERE name = ?", (name,))
-            if user := cursor.fetchone():
-
-                # Добавляем кнопки
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [
-                        InlineKeyboardButton(
-                            text="Подтвердить",
-                            callback_data=f"upcoming_confirm_{user[0]}_{rowid}"
-                        ),
-                        InlineKeyboardButton(
-                            text="Отказаться",
-                            callback_data=f"upcoming_cancel_{user[0]}_{rowid}"
-                        )
-                    ]
-                ])
+        try:
+            await bot.send_message(
+                chat_id=user.telegram_id,
+                text=f"У вас через час уроки в садике {point}\nАдрес: {address}\nВремя: {times_str}{scenario_block}",
+                reply_markup=keyboard,
+                parse_mode='HTML',
+                disable_web_page_preview=True
+            )
+        except Exception as e:
+            print(f"[ERROR UPCOMING] Не удалось отправить напоминание {name}: {e}")
+            continue
 
-                await bot.send_message(
-                    chat_id=user[0],
-                    text=f"У вас через час уроки в садике {point}\nАдрес: {address}\nВремя: {times_str}{scenario_block}",
-                    reply_markup=keyboard,
-                    parse_mode='HTML',
-                    disable_web_page_preview=True
-                )
+        # Статус ставим только тем, кому напоминание ушло
+        (teacher_rowids if role == 'Teacher' else assist_rowids).append(rowid)
+        foto_rowids.extend(json.loads(point_rowids))
 
-                # Обновление статуса для первого урока
-                cursor.execute(f"""
-                    UPDATE schedule
-                    SET {status_column} = 'wait'
-                    WHERE rowid = (
-                        SELECT rowid
-                        FROM schedule
-                        WHERE {role} = ? AND Point = ?
-                        ORDER BY Time_L ASC
-                        LIMIT 1
-                    )
-                """, (name, point))
-                
-                # Обновление статуса foto для всех уроков преподавателя в этом детском саду
-                cursor.execute(f"""
-                    UPDATE schedule
-                    SET foto = 'wait'
-                    WHERE {role} = ? AND Point = ?
-                """, (name, point))
-                
-                conn.commit()
+    if foto_rowids:
+        # Все статусы одним UPDATE: wait для первого урока по роли и foto = 'wait' для всех уроков в садике
+        cursor.execute("""
+            UPDATE schedule
+            SET Teacher_w = CASE WHEN rowid IN (SELECT value FROM json_each(?)) THEN 'wait' ELSE Teacher_w END,
+                Assist_w = CASE WHEN rowid IN (SELECT value FROM json_each(?)) THEN 'wait' ELSE Assist_w END,
+                foto = 'wait'
+            WHERE rowid IN (SELECT value FROM json_each(?))
+        """, (json.dumps(teacher_rowids), json.dumps(assist_rowids), json.dumps(foto_rowids)))
+        conn.commit()
 
+    print(f"[UPCOMING] Уроков в {time_plus_1h}: напоминаний {len(teacher_rowids) + len(assist_rowids)} из {len(first_lessons)}")
     conn.close()
 
 # Функция для получения информации из таблицы users
 def get_help_info():
     try:
-        # Подключаемся к базе данных
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Выполняем SQL-запрос (пример: получаем данные из таблицы users)
-        cursor.execute("""
-            SELECT telegram_id, name, status, work, nik_name FROM users""")
-        result = cursor.fetchall()
-
-        # Закрываем соединение
-        conn.close()
+        # Берем пользователей из справочника
+        result = [(u.telegram_id, u.name, u.status, u.work, u.nik_name) for u in get_user_directory().users]
 
         # Формируем строку с информацией
         if result:
@@ -1659,20 +2996,10 @@ def get_help_info():
 # ============================================================================
 
 # Обработчик команды /help
-@dp.message(Command("help"))
+@dp.message(Command("help"), RoleFilter(*ADMIN_ROLES))
 async def send_help(message: Message):
-    # Проверяем, является ли пользователь администратором
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT status FROM users WHERE telegram_id = ?", (message.from_user.id,))
-    user = cursor.fetchone()
-    conn.close()
-
-    if user and user[0] in ('Admin', 'DoubleA'):
-        help_info = get_help_info()
-        await message.answer(help_info)
-    else:
-        await message.answer("У вас нет прав для выполнения этой команды")
+    help_info = get_help_info()
+    await message.answer(help_info)
 
 # Функция для получения информации из таблицы schedule
 def get_schedule_info():
@@ -1716,20 +3043,10 @@ async def info_command(message: Message):
 
 
 # Обработчик команды /helps
-@dp.message(Command("helps"))
+@dp.message(Command("helps"), RoleFilter(*ADMIN_ROLES))
 async def send_schedule(message: Message):
-    # Проверяем, является ли пользователь администратором
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT status FROM users WHERE telegram_id = ?", (message.from_user.id,))
-    user = cursor.fetchone()
-    conn.close()
-
-    if user and user[0] in ('Admin', 'DoubleA'):
-        schedule_info = get_schedule_info()
-        await message.answer(schedule_info)
-    else:
-        await message.answer("У вас нет прав для выполнения этой команды")
+    schedule_info = get_schedule_info()
+    await message.answer(schedule_info)
 
 @dp.message(Command(commands=["renamesss"]))
 async def renamesss_command(message: Message):
@@ -1737,7 +3054,7 @@ async def renamesss_command(message: Message):
     conn = None
     try:
         # Выполняем POST-запрос
-        response = requests.post(url)
+        response = post_webhook(url)
         if response.status_code != 200:
             await message.answer(f"Ошибка запроса: {response.status_code}")
             return
@@ -1765,6 +3082,7 @@ async def renamesss_command(message: Message):
             )
 
         conn.commit()
+        invalidate_user_directory()
         await message.answer("Таблица users успешно обновлена.")
 
     except Exception as e:
@@ -1774,40 +3092,19 @@ async def renamesss_command(message: Message):
         conn.close()
 
 
-@dp.message(Command("retable"))
+@dp.message(Command("retable"), RoleFilter(*ADMIN_ROLES))
 async def handle_retable(message: Message):
-    user_id = message.from_user.id
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT status FROM users WHERE telegram_id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-
-    if user and user[0] in ('Admin', 'DoubleA'):
-        # Кнопки выбора дня
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Сегодня", callback_data="retable_today"),
-                InlineKeyboardButton(text="Завтра", callback_data="retable_tomorrow")
-            ]
-        ])
-        await message.answer("На какой день обновить занятия?", reply_markup=keyboard)
-    else:
-        await message.answer("У вас нет прав для выполнения этой команды.")
+    # Кнопки выбора дня
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Сегодня", callback_data="retable_today"),
+            InlineKeyboardButton(text="Завтра", callback_data="retable_tomorrow")
+        ]
+    ])
+    await message.answer("На какой день обновить занятия?", reply_markup=keyboard)
 
-@dp.callback_query(lambda c: c.data in ["retable_today", "retable_tomorrow"])
+@dp.callback_query(lambda c: c.data in ["retable_today", "retable_tomorrow"], RoleFilter(*ADMIN_ROLES))
 async def handle_retable_choice(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT status FROM users WHERE telegram_id = ?", (user_id,))
-    user = cursor.fetchone()
-    if not (user and user[0] in ('Admin', 'DoubleA')):
-        await callback.answer("Нет прав", show_alert=True)
-        conn.close()
-        return
-    conn.close()
-
     # Выбор вебхука
     if callback.data == "retable_today":
         url = NEW_WEBHOOK_URL
@@ -1817,7 +3114,7 @@ async def handle_retable_choice(callback: CallbackQuery):
         day_text = "завтра"
 
     try:
-        response = requests.post(url)
+        response = post_webhook(url)
         if response.status_code != 200:
             await callback.message.answer(f"Ошибка при запросе: {response.status_code}")
             return
@@ -1844,8 +3141,8 @@ async def handle_retable_choice(callback: CallbackQuery):
                 INSERT INTO schedule (
                     Date_L, Time_L, Point, Groupp, Teacher, Assist, 
                     Adress, Modul, Theme, DateLL, Teacher_w, Assist_w, Counter_p,
-                    Comment, Present, Detail, Insra
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    Comment, Present, Detail, Insra, starts_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, (
                 item.get("Date_L", ""),
                 item.get("Time_L", ""),
@@ -1863,22 +3160,25 @@ async def handle_retable_choice(callback: CallbackQuery):
                 item.get("Comment", ""),
                 item.get("Present", ""),
                 item.get("Detail", ""),
-                item.get("Insra", "")
+                item.get("Insra", ""),
+                schedule_item_starts_at(item)
             ))
             notify_teachers.append((item.get("Teacher", ""), item))
             
             # Обновляем статус учителя в таблице users
             teacher_name = item.get("Teacher", "")
             if teacher_name:
-                cursor.execute("SELECT id FROM users WHERE name = ?", (teacher_name,))
-                teacher_user = cursor.fetchone()
+                teacher_user = get_user_directory().fields_by_name(teacher_name, "id")
                 if teacher_user:
                     cursor.execute("UPDATE users SET work = 'wait' WHERE name = ?", (teacher_name,))
     # Удаляем строки, которых нет в новом расписании
     to_delete = old_rows - new_rows
     for row in to_delete:
         cursor.execute("DELETE FROM schedule WHERE Date_L = ? AND Time_L = ? AND Teacher = ?", row)
+    bump_table_version(cursor, "schedule")
     conn.commit()
+    refresh_schedule_snapshot()
+    invalidate_user_directory()
 
     # Уведомляем преподавателей о новых занятиях (аналогично process_schedule_and_notify, но только для новых)
     # Группируем новые занятия по преподавателю
@@ -1889,8 +3189,7 @@ async def handle_retable_choice(callback: CallbackQuery):
         teacher_lessons.setdefault(teacher, []).append(item)
 
     for teacher, lessons in teacher_lessons.items():
-        cursor.execute("SELECT telegram_id FROM users WHERE name = ?", (teacher,))
-        user_row = cursor.fetchone()
+        user_row = get_user_directory().fields_by_name(teacher, "telegram_id")
         if not user_row:
             continue
         telegram_id = user_row[0]
@@ -1941,7 +3240,7 @@ def update_column_table():
 
     # Отправляем POST-запрос
     url = WEBHOOK_COLUMN_URL
-    response = requests.post(url, timeout=30)
+    response = post_webhook(url, timeout=30)
 
     # Проверяем успешность запроса
     if response.status_code != 200:
@@ -2015,14 +3314,11 @@ async def check_lessons_10min_before():
     column_d_value = row[0] if row else ""
     print(f"[DEBUG] Column_d value: '{column_d_value}'")
 
-    # Ищем подходящие уроки
-    cursor.execute("""
-        SELECT rowid, Point, Groupp, Teacher, Counter_p, Time_L
-        FROM schedule 
-        WHERE Time_L = ? 
-    """, (lesson_time,))
-
-    lessons = cursor.fetchall()
+    # Ищем уроки, начинающиеся в ближайшем окне перед T-10
+    lessons = [
+        (l.rowid, l.Point, l.Groupp, l.Teacher, l.Counter_p, l.Time_L)
+        for l in get_schedule_snapshot().starting_between(*lesson_window(kaz_time, 10))
+    ]
     print(f"[DEBUG] Найдено уроков: {len(lessons)}")
 
     if not lessons:
@@ -2036,11 +3332,19 @@ async def check_lessons_10min_before():
         print(f"  Counter_p: '{counter_p}'")
         print(f"  Time_L: '{time_l}'")
 
+        # Список урока загружается один раз, даже если проверки наложились друг на друга
+        roster_key = f"roster:{kaz_time.strftime('%Y-%m-%d')}:{point}:{groupp}:{time_l}"
+        claimed = claim_idempotency_key(roster_key, conn)
+        # Ключ фиксируется сразу: иначе блокировка записи держалась бы во время отправки сообщений
+        conn.commit()
+        if not claimed:
+            print(f"  [SKIP] Урок уже обработан ({roster_key})")
+            continue
+
         # Проверяем статус "не вносить"
         if counter_p and "не вносить" in counter_p.lower():
             print("  [SPECIAL] Запрос количества учеников у преподавателя - статус 'не вносить'")
-            cursor.execute("SELECT telegram_id FROM users WHERE name = ?", (teacher,))
-            teacher_data = cursor.fetchone()
+            teacher_data = get_user_directory().fields_by_name(teacher, "telegram_id")
             if not teacher_data:
                 print(f"  [SKIP] Учитель '{teacher}' не найден в системе")
                 continue
@@ -2058,8 +3362,7 @@ async def check_lessons_10min_before():
             continue
 
         # Проверяем наличие учителя в системе
-        cursor.execute("SELECT telegram_id FROM users WHERE name = ?", (teacher,))
-        teacher_data = cursor.fetchone()
+        teacher_data = get_user_directory().fields_by_name(teacher, "telegram_id")
 
         if not teacher_data:
             print(f"  [SKIP] Учитель '{teacher}' не найден в системе")
@@ -2069,11 +3372,8 @@ async def check_lessons_10min_before():
         print(f"  Учитель найден, Telegram ID: {teacher_id}")
 
         # Очищаем старые данные для этой группы и точки
-        cursor.execute("""
-            DELETE FROM lessons 
-            WHERE point = ? AND groupp = ? AND free = ?
-        """, (point, groupp, time_l))
-        print(f"  [DEBUG] Удалено старых записей: {cursor.rowcount}")
+        deleted = delete_lessons(cursor, "point = ? AND groupp = ? AND free = ?", (point, groupp, time_l))
+        print(f"  [DEBUG] Удалено старых записей: {deleted}")
         print(f"  [DEBUG] time_l из schedule: '{time_l}' (длина: {len(time_l)}, repr: {repr(time_l)})")
         conn.commit()
 
@@ -2083,12 +3383,15 @@ async def check_lessons_10min_before():
         print(f"  Отправка запроса учеников: {payload}")
 
         try:
-            response = requests.post(url, json=payload)
+            response = post_webhook(url, json=payload)
             print(f"  Статус ответа: {response.status_code}")
 
             if response.status_code != 200:
                 print(f"  [ERROR] Ошибка при запросе учеников: {response.status_code}")
                 print(f"  Содержимое ответа: {response.text[:200]}")
+                # Список не загружен - следующая проверка попробует еще раз
+                release_idempotency_key(roster_key, conn)
+                conn.commit()
                 continue
 
             # Безопасное получение JSON
@@ -2105,8 +3408,7 @@ async def check_lessons_10min_before():
                         lesson.get("idrow") is None):
                         # Садик не найден - отправляем уведомление админам и DoubleA
                         print(f"  [WARNING] Садик {point} не найден в системе")
-                        cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-                        admins = cursor.fetchall()
+                        admins = get_user_directory().with_roles(*ADMIN_ROLES)
                         admin_message = f"Садик {point} не найден"
                         for admin in admins:
                             await bot.send_message(chat_id=admin[0], text=admin_message)
@@ -2119,37 +3421,24 @@ async def check_lessons_10min_before():
 
 
 
-            # Создаем/проверяем таблицу lessons
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS lessons (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    point TEXT,
-                    groupp TEXT,
-                    name_s TEXT,
-                    student_rowid TEXT,
-                    column_d TEXT,
-                    present TEXT DEFAULT '',
-                    free TEXT DEFAULT ''
-                )
-            """)
-
             # Генерируем уникальный код для урока
             lesson_code = generate_lesson_code()
             print(f"  [DEBUG] Сгенерирован lesson_code: {lesson_code}")
-            
+
+            # Урок создается один раз, ученики ссылаются на него по lesson_id
+            lesson_id = upsert_lesson(
+                cursor, point, groupp, time_l,
+                column_d=column_d_value, lesson_code=lesson_code, schedule_rowid=rowid
+            )
+
             # Добавляем учеников
             added_count = 0
             for student in students:
-                point_val = student.get("point", "")
-                groupp_val = student.get("groupp", "")
-                name_s_val = student.get("name_s", "")
+                name_s_val = student.get("name_s") or ""
                 idrow_val = student.get("idrow", "")
 
                 try:
-                    cursor.execute("""
-                        INSERT INTO lessons (point, groupp, name_s, student_rowid, column_d, free, lesson_code)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    """, (point_val, groupp_val, name_s_val, idrow_val, column_d_value, time_l, lesson_code))
+                    add_attendance(cursor, lesson_id, name_s_val, idrow_val)
                     added_count += 1
                 except Exception as e:
                     print(f"  [ERROR] Ошибка добавления ученика: {e}")
@@ -2169,6 +3458,9 @@ async def check_lessons_10min_before():
             print(f"  [ERROR] Ошибка при обработке урока: {e}")
             import traceback
             traceback.print_exc()
+            conn.rollback()
+            release_idempotency_key(roster_key, conn)
+            conn.commit()
 
     conn.close()
     print("[DEBUG] Проверка завершена\n")
@@ -2448,8 +3740,7 @@ async def send_students_list(teacher_id, point, groupp, free, page=0, message_id
     print(f"  lesson_code: {lesson_code}")
     
     # Проверяем, что teacher_id существует в базе
-    cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (teacher_id,))
-    teacher_row = cursor.fetchone()
+    teacher_row = get_user_directory().fields(teacher_id, "name")
     if teacher_row:
         print(f"  Преподаватель найден в базе: {teacher_row[0]}")
     else:
@@ -2461,40 +3752,25 @@ async def send_students_list(teacher_id, point, groupp, free, page=0, message_id
     caller = stack[1].function if len(stack) > 1 else "unknown"
     print(f"  Вызвана из функции: {caller}")
     
-    # Проверяем данные в базе lessons
-    cursor.execute("""
-        SELECT COUNT(*) FROM lessons 
-        WHERE point = ? AND groupp = ? AND free = ?
-    """, (point, groupp, free))
-    count = cursor.fetchone()[0]
-    print(f"  Записей в lessons для этого урока: {count}")
-    
-    # Получаем всех учеников В ИСХОДНОМ ПОРЯДКЕ (без сортировки)
-    cursor.execute("""
-        SELECT id, name_s, present 
-        FROM lessons 
-        WHERE point = ? AND groupp = ? AND free = ?
-        ORDER BY id
-    """, (point, groupp, free))
-    all_students = cursor.fetchall()
-    print(f"[DEBUG] Всего учеников: {len(all_students)}")
-    print("[DEBUG] Список учеников:")
-    for student in all_students:
-        print(f"  ID: {student[0]}, Имя: {student[1]}, Присутствие: {student[2]}")
+    # Урок ищется один раз, дальше ученики выбираются по lesson_id
+    lesson = find_lesson(cursor, point, groupp, free)
+    if lesson and not lesson_code:
+        lesson_code = lesson.lesson_code
 
-    if not all_students:
+    # Читаем только текущую страницу учеников в исходном порядке (по id отметки)
+    roster = fetch_roster_page(cursor, lesson.id, page) if lesson else None
+    if not roster or not roster.rows:
         print("[DEBUG] Нет учеников для отображения")
         return
 
-    # Разбиваем на страницы
-    total_pages = (len(all_students) + STUDENTS_PER_PAGE - 1) // STUDENTS_PER_PAGE
-    start_index = page * STUDENTS_PER_PAGE
-    end_index = min(start_index + STUDENTS_PER_PAGE, len(all_students))
-    students_page = all_students[start_index:end_index]
-
-    # Считаем присутствующих
-    present_count = sum(1 for s in all_students if s[2] == "1")
-    total_count = len(all_students)
+    page = roster.page
+    students_page = roster.rows
+    total_pages = roster.total_pages
+    total_count, present_count = roster.total_count, roster.present_count
+    print(f"[DEBUG] Всего учеников: {total_count}")
+    print("[DEBUG] Ученики страницы:")
+    for student in students_page:
+        print(f"  ID: {student[0]}, Имя: {student[1]}, Присутствие: {student[2]}")
 
     # Создаем клавиатуру
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
@@ -2502,7 +3778,7 @@ async def send_students_list(teacher_id, point, groupp, free, page=0, message_id
     # Добавляем учеников текущей страницы (сохраняем текущую страницу в callback_data)
     for student in students_page:
         student_id, name_s, present = student
-        is_present = present == "1"
+        is_present = present == 1
         
         callback_data = f"t:{student_id}:{page}"
         print(f"[DEBUG BUTTON] Кнопка ученика '{name_s}':")
@@ -2525,14 +3801,11 @@ async def send_students_list(teacher_id, point, groupp, free, page=0, message_id
             print(f"[ERROR BUTTON] Проблемный callback_data: '{callback_data}'")
 
     # Добавляем кнопки навигации
-    print(f"[DEBUG] Формирование кнопок пагинации: prev={page > 0}, next={end_index < len(all_students)}")
+    print(f"[DEBUG] Формирование кнопок пагинации: prev={page > 0}, next={page < total_pages - 1}")
     navigation_buttons = []
 
     if page > 0:
-        if lesson_code:
-            callback_data = f"page:{lesson_code}:prev:{page}"
-        else:
-            callback_data = f"page:{point}:{groupp}:{free}:prev:{page}"
+        callback_data = roster_page_callback("page", lesson.id, "prev", page, students_page[0][0])
         print(f"[DEBUG BUTTON] Кнопка 'Назад':")
         print(f"  - callback_data: '{callback_data}'")
         print(f"  - длина: {len(callback_data)} байт")
@@ -2552,11 +3825,8 @@ async def send_students_list(teacher_id, point, groupp, free, page=0, message_id
             print(f"[ERROR BUTTON] ❌ Ошибка при создании кнопки 'Назад': {e}")
             print(f"[ERROR BUTTON] Проблемный callback_data: '{callback_data}'")
 
-    if end_index < len(all_students):
-        if lesson_code:
-            callback_data = f"page:{lesson_code}:next:{page}"
-        else:
-            callback_data = f"page:{point}:{groupp}:{free}:next:{page}"
+    if page < total_pages - 1:
+        callback_data = roster_page_callback("page", lesson.id, "next", page, students_page[-1][0])
         print(f"[DEBUG BUTTON] Кнопка 'Вперед':")
         print(f"  - callback_data: '{callback_data}'")
         print(f"  - длина: {len(callback_data)} байт")
@@ -2763,36 +4033,19 @@ async def toggle_presence(callback: CallbackQuery):
     student_id = int(parts[1])
     page = int(parts[2])
 
-    # Получаем данные урока
-    cursor.execute("""
-        SELECT point, groupp, free FROM lessons WHERE id = ?
-    """, (student_id,))
-    lesson_data = cursor.fetchone()
+    # Получаем данные урока (вместе с lesson_code) по id отметки
+    lesson = find_lesson_of_attendance(cursor, student_id)
 
-    if not lesson_data:
+    if not lesson:
         await callback.answer("Урок не найден!")
         return
 
-    point, groupp, free = lesson_data
-
-    # Получаем lesson_code для этого урока
-    lesson_code = None
-    try:
-        cursor.execute("""
-            SELECT lesson_code FROM lessons 
-            WHERE point = ? AND groupp = ? AND free = ? 
-            LIMIT 1
-        """, (point, groupp, free))
-        result = cursor.fetchone()
-        if result and result[0]:
-            lesson_code = result[0]
-    except Exception as e:
-        pass
+    point, groupp, free, lesson_code = lesson.point, lesson.groupp, lesson.free, lesson.lesson_code
 
     # Переключаем статус присутствия
     cursor.execute("""
-        UPDATE lessons
-        SET present = CASE WHEN present = '1' THEN '' ELSE '1' END
+        UPDATE attendance
+        SET present = 1 - present
         WHERE id = ?
     """, (student_id,))
     conn.commit()
@@ -2884,111 +4137,23 @@ async def send_attendance_data(callback: CallbackQuery):
     # Логируем полученные параметры для отладки
     print(f"[DEBUG] Отправка данных: point={point}, groupp={groupp}, free={free}, is_edit={is_edit}")
 
-    # Показываем всех учеников для этого урока с их present
-    cursor.execute(f"""
-        SELECT id, name_s, present FROM lessons 
-        WHERE point = ? AND groupp = ? AND free = ?
-        ORDER BY id
-    """, (point, groupp, free))
-    all_students_debug = cursor.fetchall()
-    print(f"[DEBUG] Все ученики для этого урока:")
-    for s in all_students_debug:
-        print(f"  id={s[0]}, name={s[1]}, present={s[2]}")
-
-        # Получаем учеников в зависимости от режима
-    if is_edit:
-        # При редактировании - всех учеников
-        sql_query = f"""
-            SELECT point, groupp, name_s, student_rowid, column_d, is_permanent, present 
-            FROM lessons 
-            WHERE point = '{point}' 
-            AND groupp = '{groupp}' 
-            AND free = '{free}'
-        """
-        print(f"[DEBUG] SQL запрос (режим редактирования): {sql_query}")
-        cursor.execute(sql_query)
-        all_present_students = cursor.fetchall()
-        print(f"[DEBUG] Режим редактирования - найдено всех учеников: {len(all_present_students)}")
-    else:
-        # При первичной отправке - только присутствующих
-        sql_query = f"""
-            SELECT point, groupp, name_s, student_rowid, column_d, is_permanent, present 
-        FROM lessons 
-        WHERE point = '{point}' 
-        AND groupp = '{groupp}' 
-        AND free = '{free}' 
-        AND present = '1'
-    """
-        print(f"[DEBUG] SQL запрос (первичная отправка): {sql_query}")
-        cursor.execute(sql_query)
-        all_present_students = cursor.fetchall()
-        print(f"[DEBUG] Первичная отправка - найдено присутствующих: {len(all_present_students)}")
-
-    # Разделяем на обычных и новых учеников
-    regular_students = []
-    new_students = []
-    
-    print(f"[DEBUG] === РАЗДЕЛЕНИЕ УЧЕНИКОВ ===")
-    print(f"[DEBUG] Всего учеников для обработки: {len(all_present_students)}")
-
-    for student in all_present_students:
-        point_val, groupp_val, name_s, student_rowid, column_d, is_permanent, present = student
-
-        # Логируем данные ученика
-        print(f"[DEBUG] Ученик: {name_s}, rowid={student_rowid}, column_d={column_d}, is_permanent={is_permanent}, present={present}")
+    # Ученики урока: при редактировании все, при первичной отправке только присутствующие;
+    # разделение на обычных и новых делает SQL
+    lesson = find_lesson(cursor, point, groupp, free)
+    regular_students, new_students = split_lesson_students(
+        cursor, lesson.id if lesson else None, only_present=not is_edit
+    )
 
-        # Проверяем является ли ученик "новым"
-        if student_rowid is None or student_rowid == '' or column_d is None or column_d == '':
-            print(f"[DEBUG] ✓ Новый ученик: {name_s}")
-            new_students.append((point_val, groupp_val, name_s, is_permanent))
-        else:
-            print(f"[DEBUG] ✓ Обычный ученик: {name_s}")
-            # Преобразуем present в число (1 или 0)
-            present_value = 1 if present == '1' else 0
-            regular_students.append((point_val, groupp_val, name_s, column_d, present_value))
-    
     print(f"[DEBUG] Итого:")
     print(f"  - Обычных учеников: {len(regular_students)}")
     print(f"  - Новых учеников: {len(new_students)}")
     print(f"[DEBUG] === КОНЕЦ РАЗДЕЛЕНИЯ ===")
     
-    # ДОБАВЛЯЮ ДЕБАГ ДЛЯ ПОСТОЯННЫХ УЧЕНИКОВ
-    print(f"[DEBUG] === ПРОВЕРКА ПОСТОЯННЫХ УЧЕНИКОВ ===")
-    
-    # Проверяем всех учеников с их is_permanent
-    cursor.execute(f"""
-        SELECT id, name_s, is_permanent, present, student_rowid, column_d 
-        FROM lessons 
-        WHERE point = ? AND groupp = ? AND free = ?
-        ORDER BY id
-    """, (point, groupp, free))
-    
-    all_students_check = cursor.fetchall()
-    print(f"[DEBUG] Все ученики для проверки:")
-    for s in all_students_check:
-        print(f"  id={s[0]}, name={s[1]}, is_permanent={s[2]}, present={s[3]}, rowid={s[4]}, column_d={s[5]}")
-    
-    # Проверяем постоянных учеников отдельно
-    cursor.execute(f"""
-        SELECT id, name_s, is_permanent, present 
-        FROM lessons 
-        WHERE point = ? AND groupp = ? AND free = ? AND is_permanent = '1'
-        ORDER BY id
-    """, (point, groupp, free))
-    
-    permanent_students = cursor.fetchall()
-    print(f"[DEBUG] Постоянных учеников найдено: {len(permanent_students)}")
-    for s in permanent_students:
-        print(f"  id={s[0]}, name={s[1]}, is_permanent={s[2]}, present={s[3]}")
-    
-    print(f"[DEBUG] === КОНЕЦ ПРОВЕРКИ ПОСТОЯННЫХ ===")
-
     # 1. Отправляем обычных учеников
     if regular_students:
         print(f"[DEBUG] Отправка {len(regular_students)} обычных учеников")
         # Получаем имя преподавателя
-        cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (callback.from_user.id,))
-        teacher_name_row = cursor.fetchone()
+        teacher_name_row = get_user_directory().fields(callback.from_user.id, "name")
         teacher_name = teacher_name_row[0] if teacher_name_row else "Неизвестный"
         
         data_to_send = {
@@ -3006,13 +4171,13 @@ async def send_attendance_data(callback: CallbackQuery):
         }
         # --- Новая логика: если это изменение по /lessons (edit_lesson), отправляем на новый хук ---
         if is_edit:
-            response = requests.post(
+            response = post_webhook(
                 WEBHOOK_LESSONS_EDIT_URL,
                 json=data_to_send,
                 timeout=50
             )
         else:
-            response = requests.post(
+            response = post_webhook(
                 WEBHOOK_ATTENDANCE_URL,
                 json=data_to_send,
                 timeout=30
@@ -3025,8 +4190,7 @@ async def send_attendance_data(callback: CallbackQuery):
             except Exception:
                 resp_json = response.text
             if (isinstance(resp_json, dict) and resp_json.get("Error")) or (isinstance(resp_json, str) and "Error" in resp_json):
-                cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-                admins = cursor.fetchall()
+                admins = get_user_directory().with_roles(*ADMIN_ROLES)
                 admin_message = f"Преподаватель {teacher_name} в таблице не найден"
                 for admin in admins:
                     await bot.send_message(chat_id=admin[0], text=admin_message)
@@ -3035,8 +4199,7 @@ async def send_attendance_data(callback: CallbackQuery):
     if new_students:
         print(f"[DEBUG] Отправка {len(new_students)} новых учеников")
         # Получаем имя преподавателя
-        cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (callback.from_user.id,))
-        teacher_name_row = cursor.fetchone()
+        teacher_name_row = get_user_directory().fields(callback.from_user.id, "name")
         teacher_name = teacher_name_row[0] if teacher_name_row else "Неизвестный"
 
         new_data_to_send = {
@@ -3051,7 +4214,7 @@ async def send_attendance_data(callback: CallbackQuery):
                 for student in new_students
             ]
         }
-        response = requests.post(
+        response = post_webhook(
             WEBHOOK_NEW_STUDENTS_URL,
             json=new_data_to_send,
             timeout=30
@@ -3073,8 +4236,7 @@ async def send_attendance_data(callback: CallbackQuery):
             admin_message = f"В садике {point}, в группе {groupp}, в {free} - присутствуют {total_students} {student_word}."
             
             # Отправляем сообщение всем админам и DoubleA
-            cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-            admins = cursor.fetchall()
+            admins = get_user_directory().with_roles(*ADMIN_ROLES)
             print(f"[DEBUG] Отправка уведомления {len(admins)} админам: {admin_message}")
             
             for admin in admins:
@@ -3094,8 +4256,7 @@ async def send_attendance_data(callback: CallbackQuery):
         print(f"[DEBUG] Проверяем новых учеников для верификации админами")
         
         # Получаем всех админов и DoubleA
-        cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-        admins = cursor.fetchall()
+        admins = get_user_directory().with_roles(*ADMIN_ROLES)
         print(f"[DEBUG] Найдено админов: {len(admins)}")
         print(f"[DEBUG] ID админов: {[admin[0] for admin in admins]}")
         
@@ -3206,117 +4367,195 @@ async def send_attendance_data(callback: CallbackQuery):
 
     await callback.answer()
 
-STUDENTS_PER_PAGE = 10
-
+async def turn_roster_page(callback, build_keyboard):
+    """Листание списка учеников: по кнопке <prefix>:<lesson_id>:<prev|next>:<страница>:<id>
+    перерисовывает клавиатуру build_keyboard (create_primary_keyboard/create_edit_keyboard)"""
+    parsed = parse_roster_page_callback(callback.data)
+    if not parsed:
+        # Кнопки старых форматов (lesson_code или садик:группа:время) не разбираем
+        await callback.answer("Кнопка устарела, откройте список заново")
+        return
+    lesson_id, direction, current_page, boundary_id = parsed
 
-@dp.callback_query(lambda c: c.data.startswith('page:'))
-async def handle_pagination(callback: CallbackQuery):
+    conn = get_db_connection()
     try:
-        # Получаем все части callback_data
-        data_parts = callback.data.split(':')
-        print(f"[DEBUG] Полные данные пагинации: {data_parts}")
-
-        # Проверяем минимальное количество частей
-        if len(data_parts) < 4:
-            raise ValueError(f"Недостаточно частей в данных: {len(data_parts)}")
-
-        # Проверяем новый формат: page:lesson_code:prev/next:page
-        if len(data_parts) == 4:
-            lesson_code = data_parts[1]
-            direction = data_parts[2]
-            current_page = int(data_parts[3])
-            
-            # Получаем параметры урока по коду
-            point, groupp, free = get_lesson_by_code(lesson_code)
-            if not point:
-                raise ValueError(f"Урок с кодом {lesson_code} не найден")
-                
-            print(f"[DEBUG] Новый формат пагинации: lesson_code={lesson_code}, direction={direction}, page={current_page}")
-            print(f"[DEBUG] Параметры урока: point={point}, groupp={groupp}, free={free}")
-        else:
-            # Старый формат: page:point:groupp:free:prev/next:page
-            print(f"[DEBUG] Старый формат пагинации: {data_parts}")
-            
-            # Извлекаем основные параметры
-            point = data_parts[1].replace('_', ' ')
-            groupp = data_parts[2]
-
-            # Находим индексы направления и страницы
-            direction_index = -2
-            page_index = -1
-
-            # Проверяем, что последние два элемента - это направление и страница
-            if data_parts[direction_index] not in ['prev', 'next']:
-                # Если не нашли направление в предпоследнем элементе, ищем в другом месте
-                for i in range(3, len(data_parts) - 1):
-                    if data_parts[i] in ['prev', 'next']:
-                        direction_index = i
-                        page_index = i + 1
-                        break
-
-                if direction_index == -2:
-                    raise ValueError("Направление не найдено в данных")
-
-            direction = data_parts[direction_index]
-            current_page = int(data_parts[page_index])
-
-            # Free - это все элементы между groupp и direction
-            free_parts = data_parts[3:direction_index]
-            free = ':'.join(free_parts)
-
-        # current_page уже преобразован в int выше
+        lesson = find_lesson_by_id(conn.cursor(), lesson_id)
+    finally:
+        conn.close()
+    if not lesson:
+        await callback.answer("Урок не найден")
+        return
 
-        print(f"[DEBUG] Пагинация: point={point}, groupp={groupp}, free={free}, "
-              f"direction={direction}, current_page={current_page}")
+    await build_keyboard(
+        callback.from_user.id,
+        lesson.point,
+        lesson.groupp,
+        lesson.free,
+        page=current_page + 1 if direction == "next" else current_page - 1,
+        message_id=callback.message.message_id,
+        lesson_code=lesson.lesson_code,
+        lesson=lesson,
+        after_id=boundary_id if direction == "next" else None,
+        before_id=boundary_id if direction == "prev" else None
+    )
+    await callback.answer()
 
-        # Рассчитываем новую страницу
-        if direction == "next":
-            new_page = current_page + 1
-        elif direction == "prev":
-            new_page = max(0, current_page - 1)
-        else:
-            raise ValueError(f"Неизвестное направление: {direction}")
 
-        # Обновляем список учеников в зависимости от режима
-        global current_edit_mode
-        if current_edit_mode:
-            await create_edit_keyboard(
-                callback.from_user.id,
-                point,
-                groupp,
-                free,
-                page=new_page,
-                message_id=callback.message.message_id,
-                lesson_code=lesson_code
-            )
-        else:
-            await create_primary_keyboard(
-                callback.from_user.id,
-                point,
-                groupp,
-                free,
-                page=new_page,
-                message_id=callback.message.message_id,
-                lesson_code=lesson_code
-            )
+@dp.callback_query(lambda c: c.data.startswith('page:'))
+async def handle_pagination(callback: CallbackQuery):
+    try:
+        # Режим (первичная или повторная отправка) задается флагом current_edit_mode
+        build_keyboard = create_edit_keyboard if current_edit_mode else create_primary_keyboard
+        await turn_roster_page(callback, build_keyboard)
 
     except Exception as e:
         print(f"[ERROR] Ошибка в handle_pagination: {str(e)}")
         import traceback
         traceback.print_exc()
         await callback.answer(f"Ошибка пагинации: {str(e)}")
-    finally:
-        await callback.answer()
 
 # ============================================================================
 # ЗАПУСК БОТА
 # ============================================================================
 
+# Задачи планировщика по именам (используются в run_timed_job)
+SCHEDULED_JOBS = {
+    "send_post_request": send_post_request,
+    "send_info_report": send_info_report,
+    "clear_lessons_and_update_column": clear_lessons_and_update_column,
+    "check_upcoming_lessons": check_upcoming_lessons,
+    "check_pending_lessons": check_pending_lessons,
+    "check_lessons_10min_before": check_lessons_10min_before,
+    "check_photo_reminders": check_photo_reminders,
+    "cleanup_old_data_friday": cleanup_old_data_friday,
+}
+
+# Режим получения обновлений: "polling" (разработка) или "webhook" (продакшен).
+# В polling-режиме процесс бота может быть только один: второй getUpdates с тем же
+# токеном Telegram отклоняет (TelegramConflictError). Несколько воркеров - только webhook.
+BOT_MODE = getattr(config, "BOT_MODE", "polling")
+
+# Настройки webhook-режима. Публичный адрес — тот, на который Telegram шлет обновления
+# (например https://bot.example.com), сервер слушает BOT_WEBHOOK_HOST:BOT_WEBHOOK_PORT.
+BOT_WEBHOOK_BASE_URL = getattr(config, "BOT_WEBHOOK_BASE_URL", "")
+BOT_WEBHOOK_PATH = getattr(config, "BOT_WEBHOOK_PATH", "/telegram/webhook")
+BOT_WEBHOOK_SECRET = getattr(config, "BOT_WEBHOOK_SECRET", "")
+BOT_WEBHOOK_HOST = getattr(config, "BOT_WEBHOOK_HOST", "0.0.0.0")
+BOT_WEBHOOK_PORT = getattr(config, "BOT_WEBHOOK_PORT", 8443)
+BOT_WEBHOOK_MAX_CONNECTIONS = getattr(config, "BOT_WEBHOOK_MAX_CONNECTIONS", 40)
+# Несколько воркеров на одном порту (SO_REUSEPORT), ядро распределяет соединения между ними.
+# Каждый воркер вызывает setWebhook, поэтому BOT_WEBHOOK_SECRET у всех должен быть общим
+BOT_WEBHOOK_REUSE_PORT = getattr(config, "BOT_WEBHOOK_REUSE_PORT", False)
+
+# TLS прямо в боте (без nginx). BOT_WEBHOOK_UPLOAD_CERT = True для самоподписанного сертификата
+BOT_WEBHOOK_SSL_CERT = getattr(config, "BOT_WEBHOOK_SSL_CERT", "")
+BOT_WEBHOOK_SSL_KEY = getattr(config, "BOT_WEBHOOK_SSL_KEY", "")
+BOT_WEBHOOK_UPLOAD_CERT = getattr(config, "BOT_WEBHOOK_UPLOAD_CERT", False)
+
+# Сколько обновлений обрабатывается одновременно (в обоих режимах)
+BOT_WORKERS = getattr(config, "BOT_WORKERS", 32)
+
+update_semaphore = asyncio.Semaphore(BOT_WORKERS)
+
+
+async def update_concurrency_middleware(handler, event, data):
+    """Ограничивает количество одновременно обрабатываемых обновлений"""
+    async with update_semaphore:
+        return await handler(event, data)
+
+
+dp.update.outer_middleware(update_concurrency_middleware)
+
+
+def create_webhook_ssl_context():
+    """SSL-контекст для локального завершения TLS, None если сертификат не задан"""
+    if not (BOT_WEBHOOK_SSL_CERT and BOT_WEBHOOK_SSL_KEY):
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(BOT_WEBHOOK_SSL_CERT, BOT_WEBHOOK_SSL_KEY)
+    return context
+
+
+async def start_webhook_server():
+    """Поднимает aiohttp-сервер для приема обновлений и регистрирует webhook в Telegram"""
+    if not BOT_WEBHOOK_BASE_URL:
+        raise RuntimeError("BOT_MODE = 'webhook', но BOT_WEBHOOK_BASE_URL не задан в config.py")
+
+    secret_token = BOT_WEBHOOK_SECRET
+    if not secret_token and BOT_WEBHOOK_REUSE_PORT:
+        # Свой случайный секрет у каждого воркера: последний setWebhook перепишет секрет
+        # остальных, и они будут отвечать Telegram 401
+        raise RuntimeError("BOT_WEBHOOK_REUSE_PORT включен, но BOT_WEBHOOK_SECRET не задан в config.py: "
+                           "воркерам нужен общий секрет")
+    if not secret_token:
+        # Без секрета любой может слать поддельные обновления - генерируем на время запуска
+        secret_token = secrets.token_urlsafe(32)
+        print("[WEBHOOK] BOT_WEBHOOK_SECRET не задан, сгенерирован временный секрет")
+
+    app = web.Application()
+    # handle_in_background: Telegram сразу получает 200, обработка идет в отдельной задаче
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret_token,
+        handle_in_background=True
+    ).register(app, path=BOT_WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    ssl_context = create_webhook_ssl_context()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(
+        runner,
+        BOT_WEBHOOK_HOST,
+        BOT_WEBHOOK_PORT,
+        ssl_context=ssl_context,
+        reuse_port=BOT_WEBHOOK_REUSE_PORT or None
+    )
+    await site.start()
+    scheme = "https" if ssl_context else "http"
+    print(f"[WEBHOOK] Сервер слушает {scheme}://{BOT_WEBHOOK_HOST}:{BOT_WEBHOOK_PORT}{BOT_WEBHOOK_PATH}")
+
+    certificate = FSInputFile(BOT_WEBHOOK_SSL_CERT) if (ssl_context and BOT_WEBHOOK_UPLOAD_CERT) else None
+    webhook_url = BOT_WEBHOOK_BASE_URL.rstrip("/") + BOT_WEBHOOK_PATH
+    await bot.set_webhook(
+        url=webhook_url,
+        secret_token=secret_token,
+        certificate=certificate,
+        max_connections=BOT_WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    print(f"[WEBHOOK] Webhook зарегистрирован: {webhook_url}")
+    return runner
+
+
+async def run_webhook():
+    """Работа в webhook-режиме до остановки процесса"""
+    runner = await start_webhook_server()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 # Основная функция запуска бота и планировщика
 async def main():
     create_db()  # Создаём базу данных при запуске приложения
-    await start_scheduler()  # Запускаем планировщик задач
-    await dp.start_polling(bot)  # Запускаем Telegram-бота
+    asyncio.create_task(dedup_fotoalbum())  # Дубли файлов из старых загрузок
+    await start_metrics_server()  # Локальный эндпоинт /metrics
+    scheduler = await start_scheduler()  # Запускаем планировщик задач (на паузе)
+    election_task = asyncio.create_task(run_scheduler_election(scheduler))  # Выбор лидера
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()  # Принимаем обновления через webhook
+        else:
+            # Снимаем webhook, если бот до этого работал в webhook-режиме
+            await bot.delete_webhook()
+            await dp.start_polling(bot)  # Запускаем Telegram-бота
+    finally:
+        election_task.cancel()
+        release_scheduler_lease()
+        shutdown_export_executors()
 
 @dp.message(Command("clean_lessons"))
 async def clean_lessons_command(message: Message):
@@ -3328,12 +4567,7 @@ async def clean_lessons_command(message: Message):
     current_time = kaz_time.strftime("%H:%M")
     
     # Удаляем все записи для текущего времени
-    cursor.execute("""
-        DELETE FROM lessons 
-        WHERE free = ?
-    """, (current_time,))
-    
-    deleted_count = cursor.rowcount
+    deleted_count = delete_lessons(cursor, "free = ?", (current_time,))
     conn.commit()
     
     await message.answer(f"✅ Удалено {deleted_count} старых записей для времени {current_time}")
@@ -3372,7 +4606,7 @@ async def process_enter_count(message: Message, state: FSMContext):
         "teacher": teacher
     }
     try:
-        response = requests.post(url, json=payload)
+        response = post_webhook(url, json=payload)
         if response.status_code == 200:
             await message.answer("Информация передана!")
         else:
@@ -3415,15 +4649,11 @@ async def start_count_fsm_callback(callback: CallbackQuery, state: FSMContext):
             return
         rowid = parts[1]
         # Получаем все данные урока по rowid
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT Point, Groupp, Teacher, Time_L FROM schedule WHERE rowid = ?", (rowid,))
-        row = cursor.fetchone()
-        conn.close()
-        if not row:
+        lesson = get_schedule_snapshot().get(rowid)
+        if not lesson:
             await callback.answer("Ошибка: урок не найден")
             return
-        point, groupp, teacher, time_l = row
+        point, groupp, teacher, time_l = lesson.Point, lesson.Groupp, lesson.Teacher, lesson.Time_L
         await state.set_state(EnterCountState.waiting_for_count)
         await state.update_data(point=point, groupp=groupp, teacher=teacher, time_l=time_l)
         await callback.message.answer(f"Введите количество учеников на уроке садик {point}, группа {groupp}:")
@@ -3432,37 +4662,37 @@ async def start_count_fsm_callback(callback: CallbackQuery, state: FSMContext):
         await callback.answer(f"Ошибка: {e}")
 
 @dp.message(Command("lessons"))
-async def show_past_lessons(message: Message):
-    user_id = message.from_user.id
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # Получаем имя преподавателя
-    cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (user_id,))
-    row = cursor.fetchone()
-    if not row:
+async def show_past_lessons(message: Message, state: FSMContext, user_record=None):
+    if not user_record:
         await message.answer("Вы не зарегистрированы как преподаватель.")
-        conn.close()
         return
-    teacher_name = row[0]
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    teacher_name = user_record.name
     # Текущее время в Казахстане
-    from pytz import timezone
-    now_time = datetime.now(timezone('Asia/Ho_Chi_Minh')).strftime("%H:%M")
+    kaz_time = datetime.now(timezone('Asia/Ho_Chi_Minh'))
+    now_time = kaz_time.strftime("%H:%M")
     print(f"[DEBUG] Казахстанское время сейчас: {now_time}")
-    # Получаем все уроки для преподавателя
+    # Получаем все уроки для преподавателя вместе со временем начала из расписания
     cursor.execute("""
-        SELECT DISTINCT point, groupp, free
-        FROM lessons
-        WHERE (name_s = ? OR ? IN (SELECT Teacher FROM schedule WHERE schedule.Point = lessons.point AND schedule.Groupp = lessons.groupp AND schedule.Time_L = lessons.free))
-        ORDER BY free
+        SELECT l.point, l.groupp, l.free, MIN(s.starts_at)
+        FROM lessons l
+        LEFT JOIN schedule s ON s.Point = l.point AND s.Groupp = l.groupp AND s.Time_L = l.free
+        WHERE l.name_s = ? OR ? IN (
+            SELECT Teacher FROM schedule WHERE schedule.Point = l.point AND schedule.Groupp = l.groupp AND schedule.Time_L = l.free
+        )
+        GROUP BY l.point, l.groupp, l.free
+        ORDER BY MIN(s.starts_at), l.free
     """, (teacher_name, teacher_name))
     all_lessons = cursor.fetchall()
     print(f"[DEBUG] Всего уроков для преподавателя: {len(all_lessons)}")
-    for l in all_lessons:
-        print(f"  {l[0]}, {l[1]}, {l[2]} (длина free: {len(str(l[2]))})")
-        # Проверяем, что содержится в free
-        print(f"    free repr: {repr(l[2])}")
-    # Фильтруем только прошедшие
-    lessons = [l for l in all_lessons if l[2] < now_time]
+    # Фильтруем только прошедшие: по starts_at, а для уроков без строки расписания - по тексту времени
+    now_ts = kaz_time.timestamp()
+    lessons = [
+        (point, groupp, free)
+        for point, groupp, free, starts_at in all_lessons
+        if (starts_at <= now_ts if starts_at is not None else free < now_time)
+    ]
     print(f"[DEBUG] Прошедших уроков: {len(lessons)}")
     if not lessons:
         await message.answer("Нет прошедших уроков.")
@@ -3478,14 +4708,13 @@ async def show_past_lessons(message: Message):
             InlineKeyboardButton(text=btn_text, callback_data=callback_data)
         ])
     
-    # Сохраняем данные уроков в глобальной переменной для обработчика
-    global lessons_data
-    lessons_data = lessons
+    # Сохраняем данные уроков в FSM, чтобы их видел любой воркер
+    await state.update_data(edit_lessons=lessons)
     await message.answer("Изменить учеников на уроке:", reply_markup=keyboard)
     conn.close()
 
 @dp.callback_query(lambda c: c.data.startswith('edit_lesson:'))
-async def handle_edit_lesson(callback: CallbackQuery):
+async def handle_edit_lesson(callback: CallbackQuery, state: FSMContext):
     print(f"[DEBUG] handle_edit_lesson вызван с callback.data: {callback.data}")
     print(f"[DEBUG] Пользователь: {callback.from_user.id} ({callback.from_user.first_name})")
     
@@ -3493,7 +4722,8 @@ async def handle_edit_lesson(callback: CallbackQuery):
     lesson_index = int(callback.data.split(':')[1])
     print(f"[DEBUG] Индекс урока: {lesson_index}")
     
-    # Получаем данные урока из глобального списка
+    # Получаем данные урока из FSM
+    lessons_data = (await state.get_data()).get("edit_lessons", [])
     if lesson_index < len(lessons_data):
         point, groupp, free = lessons_data[lesson_index]
         print(f"[DEBUG] Данные урока: point={point}, groupp={groupp}, free={free}")
@@ -3633,20 +4863,13 @@ async def handle_primary_student_type_choice(callback: CallbackQuery, state: FSM
         
         print(f"[DEBUG] Подключение к БД установлено")
         
-        # SQL запрос для добавления ученика
-        sql_query = """
-            INSERT INTO lessons (point, groupp, name_s, present, free, is_permanent)
-            VALUES (?, ?, ?, '1', ?, ?)
-        """
-        params = (point, groupp, student_name, free, is_permanent)
-        
-        print(f"[DEBUG] SQL запрос:")
-        print(f"  {sql_query}")
+        # Добавляем ученика на урок (урок создается, если его еще нет)
         print(f"  Параметры: point='{point}', groupp='{groupp}', name_s='{student_name}', free='{free}', is_permanent={is_permanent}")
         
-        cursor.execute(sql_query, params)
+        lesson_id = upsert_lesson(cursor, point, groupp, free)
+        attendance_id = add_attendance(cursor, lesson_id, student_name, present=1, is_permanent=is_permanent)
         conn.commit()
-        print(f"[DEBUG] SQL выполнен, rowcount: {cursor.rowcount}")
+        print(f"[DEBUG] Ученик добавлен: lesson_id={lesson_id}, attendance_id={attendance_id}")
         print(f"[DEBUG] Транзакция зафиксирована")
         
         conn.close()
@@ -3754,20 +4977,13 @@ async def handle_edit_student_type_choice(callback: CallbackQuery, state: FSMCon
         
         print(f"[DEBUG] Подключение к БД установлено")
         
-        # SQL запрос для добавления ученика
-        sql_query = """
-            INSERT INTO lessons (point, groupp, name_s, present, free, is_permanent)
-            VALUES (?, ?, ?, '1', ?, ?)
-        """
-        params = (point, groupp, student_name, free, is_permanent)
-        
-        print(f"[DEBUG] SQL запрос:")
-        print(f"  {sql_query}")
+        # Добавляем ученика на урок (урок создается, если его еще нет)
         print(f"  Параметры: point='{point}', groupp='{groupp}', name_s='{student_name}', free='{free}', is_permanent={is_permanent}")
         
-        cursor.execute(sql_query, params)
+        lesson_id = upsert_lesson(cursor, point, groupp, free)
+        attendance_id = add_attendance(cursor, lesson_id, student_name, present=1, is_permanent=is_permanent)
         conn.commit()
-        print(f"[DEBUG] SQL выполнен, rowcount: {cursor.rowcount}")
+        print(f"[DEBUG] Ученик добавлен: lesson_id={lesson_id}, attendance_id={attendance_id}")
         print(f"[DEBUG] Транзакция зафиксирована")
         
         conn.close()
@@ -3888,18 +5104,13 @@ async def handle_student_type_choice(callback: CallbackQuery, state: FSMContext)
         cursor = conn.cursor()
 
         print(f"[DEBUG] Подключение к БД установлено")
-        print(f"[DEBUG] SQL запрос:")
-        print(f"  INSERT INTO lessons (point, groupp, name_s, present, free, is_permanent)")
-        print(f"  VALUES (?, ?, ?, '1', ?, ?)")
         print(f"  Параметры: point='{point}', groupp='{groupp}', name_s='{student_name}', free='{free}', is_permanent={is_permanent}")
 
         # Добавляем нового ученика с указанием типа
-        cursor.execute("""
-            INSERT INTO lessons (point, groupp, name_s, present, free, is_permanent)
-            VALUES (?, ?, ?, '1', ?, ?)
-        """, (point, groupp, student_name, free, is_permanent))
+        lesson_id = upsert_lesson(cursor, point, groupp, free)
+        attendance_id = add_attendance(cursor, lesson_id, student_name, present=1, is_permanent=is_permanent)
         
-        print(f"[DEBUG] SQL выполнен, rowcount: {cursor.rowcount}")
+        print(f"[DEBUG] Ученик добавлен: lesson_id={lesson_id}, attendance_id={attendance_id}")
         conn.commit()
         print(f"[DEBUG] Транзакция зафиксирована")
         conn.close()
@@ -4016,126 +5227,44 @@ async def handle_admin_student_verification(callback: CallbackQuery):
         
         print(f"[DEBUG] Разобранные данные: point='{point}', groupp='{groupp}', free='{free}', student_index={student_index}")
         
-        # Получаем список новых учеников для этого урока
+        # Получаем список новых учеников для этого урока по lesson_id
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT name_s, is_permanent FROM lessons 
-            WHERE point = ? AND groupp = ? AND free = ? 
-            AND (student_rowid IS NULL OR student_rowid = '' OR column_d IS NULL OR column_d = '')
-            AND is_send = 0
+        lesson = find_lesson(cursor, point, groupp, free)
+        if not lesson:
+            conn.close()
+            await callback.answer("Ошибка: урок не найден")
+            return
+        lesson_code = lesson.lesson_code
+
+        new_students_sql = """
+            SELECT id, name_s, is_permanent FROM lessons 
+            WHERE lesson_id = ? AND is_new AND is_send = 0
             ORDER BY id
-        """, (point, groupp, free))
-        
+        """
+        cursor.execute(new_students_sql, (lesson.id,))
         new_students = cursor.fetchall()
-        conn.close()
         
         if student_index >= len(new_students):
+            conn.close()
             await callback.answer("Ученик не найден")
             return
         
-        student_name, current_status = new_students[student_index]
+        attendance_id, student_name, current_status = new_students[student_index]
         new_status = 0 if current_status == 1 else 1
         
         # Обновляем статус в базе
-        print(f"[DEBUG] === ОБНОВЛЕНИЕ СТАТУСА В БАЗЕ ===")
-        print(f"[DEBUG] Обновляем ученика: {student_name}")
-        print(f"[DEBUG] Новый статус: {new_status}")
-        print(f"[DEBUG] Условия: point='{point}', groupp='{groupp}', free='{free}'")
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        print(f"[DEBUG] === НАЧАЛО UPDATE ===")
-        print(f"[DEBUG] Параметры UPDATE:")
-        print(f"  - new_status: {new_status}")
-        print(f"  - point: '{point}'")
-        print(f"  - groupp: '{groupp}'")
-        print(f"  - free: '{free}'")
-        print(f"  - student_name: '{student_name}'")
-        
-        # Сначала проверим, что есть в базе
-        cursor.execute("""
-            SELECT id, point, groupp, free, name_s, is_permanent 
-            FROM lessons 
-            WHERE point = ? AND groupp = ? AND free = ? AND name_s = ?
-        """, (point, groupp, free, student_name))
-        
-        existing_record = cursor.fetchone()
-        print(f"[DEBUG] Найдена запись в базе: {existing_record}")
-        
-        if existing_record:
-            print(f"[DEBUG] ✓ Запись найдена, выполняем UPDATE")
-            # Выполняем UPDATE
-            cursor.execute("""
-                UPDATE lessons 
-                SET is_permanent = ? 
-                WHERE point = ? AND groupp = ? AND free = ? AND name_s = ?
-            """, (new_status, point, groupp, free, student_name))
-            
-            rows_affected = cursor.rowcount
-            print(f"[DEBUG] UPDATE выполнен, затронуто строк: {rows_affected}")
-            
-            conn.commit()
-            print(f"[DEBUG] ✓ Изменения сохранены в базе")
-        else:
-            print(f"[ERROR] ✗ Запись НЕ найдена в базе!")
-        
-        conn.close()
-        
-        print(f"[DEBUG] === КОНЕЦ UPDATE ===")
-        
-        # Обновляем текст кнопки
-        new_button_text = f"{'✅' if new_status == 1 else '❌'} {student_name}"
-        
-        print(f"[DEBUG] Обновляем кнопку: {student_name} -> {new_button_text}")
-        
-        # Создаем новую клавиатуру с обновленной кнопкой
-        keyboard_buttons = []
+        print(f"[DEBUG] Обновляем ученика: {student_name} (attendance_id={attendance_id}), новый статус: {new_status}")
+        cursor.execute("UPDATE attendance SET is_permanent = ? WHERE id = ?", (new_status, attendance_id))
+        conn.commit()
         
         # Получаем всех новых учеников для обновления клавиатуры
-        print(f"[DEBUG] === ОБНОВЛЕНИЕ КЛАВИАТУРЫ ===")
-        print(f"[DEBUG] Ищем учеников для: point='{point}', groupp='{groupp}', free='{free}'")
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT name_s, is_permanent FROM lessons 
-            WHERE point = ? AND groupp = ? AND free = ? 
-            AND (student_rowid IS NULL OR student_rowid = '' OR column_d IS NULL OR column_d = '')
-            AND is_send = 0
-            ORDER BY id
-        """, (point, groupp, free))
-        
-        all_new_students = cursor.fetchall()
-        print(f"[DEBUG] Найдено учеников для клавиатуры: {len(all_new_students)}")
-        for i, (name_s, is_perm) in enumerate(all_new_students):
-            print(f"[DEBUG] Ученик {i}: {name_s} (is_permanent={is_perm})")
-        
+        cursor.execute(new_students_sql, (lesson.id,))
+        all_new_students = [(name_s, is_perm) for _, name_s, is_perm in cursor.fetchall()]
         conn.close()
         
-        # Получаем lesson_code для этого урока
-        lesson_code = None
-        try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT lesson_code FROM lessons 
-                WHERE point = ? AND groupp = ? AND free = ? 
-                LIMIT 1
-            """, (point, groupp, free))
-            result = cursor.fetchone()
-            if result and result[0]:
-                lesson_code = result[0]
-                print(f"[DEBUG] Найден lesson_code для обновления клавиатуры: {lesson_code}")
-            else:
-                print(f"[DEBUG] lesson_code не найден для обновления клавиатуры, используем старый формат")
-            conn.close()
-        except Exception as e:
-            print(f"[DEBUG] Ошибка при поиске lesson_code для обновления клавиатуры: {e}, используем старый формат")
-        
         # Создаем кнопки для всех учеников
+        keyboard_buttons = []
         for i, (name_s, is_perm) in enumerate(all_new_students):
             button_text = f"{'✅' if is_perm == 1 else '❌'} {name_s}"
             
@@ -4216,9 +5345,9 @@ async def handle_admin_send(callback: CallbackQuery):
             SELECT point, groupp, name_s, column_d, present, is_permanent 
             FROM lessons 
             WHERE point = ? AND groupp = ? AND free = ?
-            AND (student_rowid IS NULL OR student_rowid = '' OR column_d IS NULL OR column_d = '')
+            AND is_new
             AND is_permanent = 1
-            AND present = '1'
+            AND present = 1
             AND is_send = 0
         """, (point, groupp, free))
         
@@ -4241,8 +5370,7 @@ async def handle_admin_send(callback: CallbackQuery):
         teacher_name = "Неизвестный"
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (callback.from_user.id,))
-        teacher_name_row = cursor.fetchone()
+        teacher_name_row = get_user_directory().fields(callback.from_user.id, "name")
         if teacher_name_row:
             teacher_name = teacher_name_row[0]
         conn.close()
@@ -4257,7 +5385,7 @@ async def handle_admin_send(callback: CallbackQuery):
                     "Groupp": student[1],
                     "name": student[2],
                     "column_d": student[3] if student[3] else "",
-                    "present": student[4] if student[4] else "1",
+                    "present": str(student[4]) if student[4] else "1",
                     "teacher": teacher_name
                 }
                 for student in permanent_students
@@ -4273,7 +5401,7 @@ async def handle_admin_send(callback: CallbackQuery):
         print(f"[DEBUG] Отправка данных на webhook: {data_to_send}")
         
         # Отправляем на webhook
-        response = requests.post(
+        response = post_webhook(
             WEBHOOK_ADMIN_VERIFY_URL,
             json=data_to_send,
             timeout=30
@@ -4296,10 +5424,12 @@ async def handle_admin_send(callback: CallbackQuery):
             conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute("""
-                UPDATE lessons 
+                UPDATE attendance 
                 SET is_send = 1 
-                WHERE point = ? AND groupp = ? AND free = ? 
-                AND (student_rowid IS NULL OR student_rowid = '' OR column_d IS NULL OR column_d = '')
+                WHERE id IN (
+                    SELECT id FROM lessons
+                    WHERE point = ? AND groupp = ? AND free = ? AND is_new
+                )
                 AND is_send = 0
             """, (point, groupp, free))
             conn.commit()
@@ -4314,7 +5444,7 @@ async def handle_admin_send(callback: CallbackQuery):
 
 # Команда для загрузки фотографий
 @dp.message(Command("foto"))
-async def start_photo_upload(message: Message, state: FSMContext):
+async def start_photo_upload(message: Message, state: FSMContext, user_record=None):
     # ПРОВЕРКА ВРЕМЕНИ
     kaz_time = datetime.now(timezone("Asia/Ho_Chi_Minh"))
     current_hour = kaz_time.hour
@@ -4328,37 +5458,25 @@ async def start_photo_upload(message: Message, state: FSMContext):
     print(f"[DEBUG] user_id: {user_id}")
     print(f"[DEBUG] message.from_user.first_name: {message.from_user.first_name}")
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Получаем имя преподавателя
-    cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (user_id,))
-    row = cursor.fetchone()
-    if not row:
+    # Имя преподавателя из записи, подставленной user_context_middleware
+    if not user_record:
         print(f"[DEBUG] ✗ Пользователь не найден в users")
         await message.answer("Вы не зарегистрированы как преподаватель.")
-        conn.close()
         return
     
-    teacher_name = row[0]
+    teacher_name = user_record.name
     print(f"[DEBUG] ✓ Преподаватель найден: '{teacher_name}'")
     
     # Получаем уроки преподавателя (как преподаватель или ассистент, без проверки даты)
     print(f"[DEBUG] Ищем уроки для пользователя '{teacher_name}' (как преподаватель или ассистент)")
-    cursor.execute("""
-        SELECT Point, Groupp, Time_L, DateLL
-        FROM schedule 
-        WHERE Teacher = ? OR Assist = ?
-        ORDER BY Time_L
-    """, (teacher_name, teacher_name))
-    
-    lessons = cursor.fetchall()
+    lessons = [
+        (l.Point, l.Groupp, l.Time_L, l.DateLL)
+        for l in sorted(get_schedule_snapshot().for_person(teacher_name), key=lambda l: (l.Time_L or "", l.rowid))
+    ]
     print(f"[DEBUG] Найдено уроков: {len(lessons)}")
     for lesson in lessons:
         print(f"  - Point: '{lesson[0]}', Groupp: '{lesson[1]}', Time_L: '{lesson[2]}', DateLL: '{lesson[3]}'")
     
-    conn.close()
-    
     if not lessons:
         print(f"[DEBUG] ✗ Уроки не найдены")
         await message.answer("У вас нет уроков на сегодня.")
@@ -4378,9 +5496,9 @@ async def start_photo_upload(message: Message, state: FSMContext):
             InlineKeyboardButton(text=btn_text, callback_data=callback_data)
         ])
     
-    # Сохраняем данные уроков для конкретного пользователя
+    # Сохраняем данные уроков пользователя в FSM
     user_id = message.from_user.id
-    lessons_data_photo[user_id] = lessons
+    await state.update_data(photo_lessons=lessons)
     print(f"[DEBUG] Сохранены уроки для пользователя {user_id}: {len(lessons)} уроков")
     
     print(f"[DEBUG] Клавиатура создана: {len(keyboard.inline_keyboard)} кнопок")
@@ -4413,7 +5531,7 @@ async def handle_lesson_selection_for_photo(callback: CallbackQuery, state: FSMC
         
         # Получаем данные урока для конкретного пользователя
         user_id = callback.from_user.id
-        user_lessons = lessons_data_photo.get(user_id, [])
+        user_lessons = (await state.get_data()).get("photo_lessons", [])
 
         if not user_lessons:
             await callback.answer("Ошибка: данные уроков не найдены. Попробуйте снова команду /foto")
@@ -4430,14 +5548,27 @@ async def handle_lesson_selection_for_photo(callback: CallbackQuery, state: FSMC
         await state.clear()
         print(f"[DEBUG] Старое состояние очищено")
         
+        # Файлы урока, загруженные раньше: дальше счетчик ведется в состоянии
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT COUNT(*) FROM fotoalbum
+                WHERE kindergarten = ? AND groupp = ? AND date = ? AND time = ?
+            """, (point, groupp, date_ll, time_l))
+            photo_count = cursor.fetchone()[0]
+        finally:
+            conn.close()
+        
         # Сохраняем данные урока в состоянии
         await state.update_data(
             point=point,
             groupp=groupp,
             time_l=time_l,
-            date_ll=date_ll
+            date_ll=date_ll,
+            photo_count=photo_count
         )
-        print(f"[DEBUG] Новые данные сохранены в состоянии")
+        print(f"[DEBUG] Новые данные сохранены в состоянии (файлов уже загружено: {photo_count})")
         
         # Создаем клавиатуру с кнопкой "Завершить"
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -4466,14 +5597,164 @@ async def handle_lesson_selection_for_photo(callback: CallbackQuery, state: FSMC
         
         # Очищаем данные пользователя при ошибке
         user_id = callback.from_user.id
-        if user_id in lessons_data_photo:
-            del lessons_data_photo[user_id]
-            print(f"[DEBUG] Очищены данные уроков для пользователя {user_id} из-за ошибки")
+        await state.update_data(photo_lessons=[])
+        print(f"[DEBUG] Очищены данные уроков для пользователя {user_id} из-за ошибки")
         
         await callback.answer(f"Ошибка: {e}")
     
     print(f"[DEBUG] === КОНЕЦ ВЫБОРА УРОКА ДЛЯ ФОТО ===")
 
+# Один и тот же файл (file_unique_id) хранится для урока один раз; индекс
+# заодно ускоряет выборку файлов урока при выгрузке
+FOTOALBUM_UNIQUE_INDEX_SQL = """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_fotoalbum_lesson_file
+    ON fotoalbum (kindergarten, groupp, date, time, file_unique_id)
+"""
+
+# Сколько дублей удаляется за одну транзакцию фоновой очистки
+FOTOALBUM_DEDUP_BATCH = 500
+
+
+async def dedup_fotoalbum():
+    """Фоновая очистка дублей файлов в fotoalbum пачками и создание уникального индекса"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_fotoalbum_lesson_file'")
+        if cursor.fetchone():
+            return
+        deleted = 0
+        while True:
+            # Остается самая ранняя запись каждого файла урока
+            cursor.execute("""
+                DELETE FROM fotoalbum
+                WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (
+                            PARTITION BY kindergarten, groupp, date, time, file_unique_id ORDER BY id
+                        ) AS rn
+                        FROM fotoalbum
+                        WHERE file_unique_id IS NOT NULL
+                    )
+                    WHERE rn > 1
+                    LIMIT ?
+                )
+            """, (FOTOALBUM_DEDUP_BATCH,))
+            conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < FOTOALBUM_DEDUP_BATCH:
+                break
+            await asyncio.sleep(0)  # Не держим цикл событий между пачками
+        cursor.execute(FOTOALBUM_UNIQUE_INDEX_SQL)
+        conn.commit()
+        print(f"[DB] Удалено дублей из fotoalbum: {deleted}, уникальный индекс создан")
+    except Exception as e:
+        print(f"[ERROR] Ошибка очистки дублей fotoalbum: {e}")
+    finally:
+        conn.close()
+
+
+# Сколько секунд ждать остальные файлы альбома (media_group_id) перед сохранением
+PHOTO_ALBUM_WINDOW = getattr(config, "PHOTO_ALBUM_WINDOW", 1.5)
+
+# Альбомы, которые еще собираются: (chat_id, media_group_id) -> {"files", "last_seen", "task"}
+pending_photo_albums = {}
+
+# Сохранение файлов одного чата идет последовательно, чтобы счетчик в состоянии не терял файлы:
+# chat_id -> {"lock", "users" - сколько сохранений держат или ждут блокировку}
+photo_upload_locks = {}
+
+
+def uploaded_file_row(message):
+    """(file_id, file_unique_id, file_size, file_type) из сообщения с фото или видео"""
+    if message.photo:
+        file_obj, file_type = message.photo[-1], 'photo'  # Берем самое большое разрешение
+    else:
+        file_obj, file_type = message.video, 'video'
+    return file_obj.file_id, file_obj.file_unique_id, file_obj.file_size, file_type
+
+
+async def save_uploaded_files(message, state, files):
+    """Сохраняет файлы урока одной транзакцией и отвечает одним сообщением (дубли пропускаются)"""
+    # Повторы внутри одной пачки отбрасываем сразу, уже сохраненные - отсекает уникальный индекс
+    unique_files = list({file_row[1]: file_row for file_row in files}.values())
+    # Запись чата удаляется, когда сохранение закончили все, кто ее ждал
+    upload_lock = photo_upload_locks.setdefault(message.chat.id, {"lock": asyncio.Lock(), "users": 0})
+    upload_lock["users"] += 1
+    try:
+        async with upload_lock["lock"]:
+            data = await state.get_data()
+            point = data.get('point')
+            groupp = data.get('groupp')
+            time_l = data.get('time_l')
+            date_ll = data.get('date_ll')
+
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.executemany("""
+                    INSERT OR IGNORE INTO fotoalbum (kindergarten, groupp, teacher, date, time, file_id, file_unique_id, file_size, file_type)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(point, groupp, message.from_user.first_name, date_ll, time_l, *file_row) for file_row in unique_files])
+                saved = cursor.rowcount
+                conn.commit()
+            except Exception as e:
+                await message.answer(f"❌ Ошибка при сохранении файла: {e}")
+                print(f"[ERROR] Ошибка сохранения файлов: {e}")
+                return
+            finally:
+                conn.close()
+
+            photo_count = data.get('photo_count', 0) + saved
+            await state.update_data(photo_count=photo_count)
+    finally:
+        upload_lock["users"] -= 1
+        if not upload_lock["users"]:
+            photo_upload_locks.pop(message.chat.id, None)
+
+    duplicates = len(files) - saved
+    print(f"[PHOTO] {point}/{groupp} {date_ll} {time_l}: сохранено файлов {saved}, "
+          f"дублей {duplicates}, всего {photo_count}")
+    if saved == 0:
+        await message.answer("♻️ Этот файл уже загружен" if len(files) == 1 else f"♻️ Все файлы ({len(files)}) уже загружены")
+    elif len(files) == 1:
+        await message.answer(f"✅ Файл #{photo_count} сохранен!")
+    else:
+        summary = f"✅ Сохранено файлов: {saved} (всего по уроку: {photo_count})"
+        if duplicates:
+            summary += f"\nПропущено дубликатов: {duplicates}"
+        await message.answer(summary)
+
+
+async def flush_photo_album(key, message, state):
+    """Ждет, пока альбом перестанет пополняться, и сохраняет его целиком"""
+    album = pending_photo_albums[key]
+    try:
+        while True:
+            delay = album["last_seen"] + PHOTO_ALBUM_WINDOW - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+    finally:
+        pending_photo_albums.pop(key, None)
+    try:
+        await save_uploaded_files(message, state, album["files"])
+    except Exception as e:
+        # Задача работает в фоне: без этого ошибка всплыла бы только при нажатии "Завершить"
+        print(f"[ERROR] Ошибка сохранения альбома {key}: {e}")
+        try:
+            await message.answer(f"❌ Ошибка при сохранении альбома: {e}")
+        except Exception as answer_error:
+            print(f"[ERROR] Не удалось сообщить об ошибке альбома {key}: {answer_error}")
+
+
+async def wait_pending_photo_albums(chat_id):
+    """Дожидается сохранения альбомов чата (перед завершением загрузки)"""
+    tasks = [album["task"] for key, album in list(pending_photo_albums.items()) if key[0] == chat_id]
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 # Обработчик загрузки фото и видео
 @dp.message(StateFilter(PhotoUpload.waiting_for_photos))
 async def handle_photo_upload(message: Message, state: FSMContext):
@@ -4482,66 +5763,23 @@ async def handle_photo_upload(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, отправьте фото или видео.")
         return
     
-    data = await state.get_data()
-    point = data.get('point')
-    groupp = data.get('groupp')
-    time_l = data.get('time_l')
-    date_ll = data.get('date_ll')
-    
-    print(f"[DEBUG] === ЗАГРУЗКА ФАЙЛА ===")
-    print(f"[DEBUG] point: '{point}', groupp: '{groupp}', time_l: '{time_l}', date_ll: '{date_ll}'")
-    
-    # Получаем информацию о файле (фото или видео)
-    if message.photo:
-        file_obj = message.photo[-1]  # Берем самое большое разрешение
-        file_type = 'photo'
-        print(f"[DEBUG] Фото: file_id={file_obj.file_id}, size={file_obj.file_size}")
-    else:
-        file_obj = message.video
-        file_type = 'video'
-        print(f"[DEBUG] Видео: file_id={file_obj.file_id}, size={file_obj.file_size}")
-    
-    file_id = file_obj.file_id
-    file_unique_id = file_obj.file_unique_id
-    file_size = file_obj.file_size
-    
-    # Сохраняем файл в БД
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    file_row = uploaded_file_row(message)
     
-    try:
-        # Проверяем количество файлов ДО добавления нового
-        cursor.execute("""
-            SELECT COUNT(*) FROM fotoalbum 
-            WHERE kindergarten = ? AND groupp = ? AND date = ? AND time = ?
-        """, (point, groupp, date_ll, time_l))
-        
-        existing_file_count = cursor.fetchone()[0]
-        print(f"[DEBUG] Файлов уже в БД: {existing_file_count}")
-        
-        # Сохраняем файл в БД
-        cursor.execute("""
-            INSERT INTO fotoalbum (kindergarten, groupp, teacher, date, time, file_id, file_unique_id, file_size, file_type)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (point, groupp, message.from_user.first_name, date_ll, time_l, file_id, file_unique_id, file_size, file_type))
-        
-        conn.commit()
-        print(f"[DEBUG] Файл сохранен в БД")
-        
-        # Новое количество файлов после добавления
-        new_file_count = existing_file_count + 1
-        print(f"[DEBUG] Новое количество файлов: {new_file_count}")
-        
-        # Простое подтверждение загрузки файла
-        await message.answer(f"✅ Файл #{new_file_count} сохранен!")
-        
-    except Exception as e:
-        await message.answer(f"❌ Ошибка при сохранении файла: {e}")
-        print(f"[ERROR] Ошибка сохранения файла: {e}")
-    finally:
-        conn.close()
+    if message.media_group_id:
+        # Файлы альбома приходят отдельными сообщениями: собираем их и сохраняем вместе
+        key = (message.chat.id, message.media_group_id)
+        album = pending_photo_albums.get(key)
+        if album:
+            album["files"].append(file_row)
+            album["last_seen"] = time.monotonic()
+        else:
+            album = {"files": [file_row], "last_seen": time.monotonic()}
+            pending_photo_albums[key] = album
+            album["task"] = asyncio.create_task(flush_photo_album(key, message, state))
+        return
     
-    print(f"[DEBUG] === КОНЕЦ ЗАГРУЗКИ ФАЙЛА ===")
+    await save_uploaded_files(message, state, [file_row])
+
 
 # Обработчик кнопки "Закончить"
 @dp.callback_query(lambda c: c.data == "finish_photo_upload")
@@ -4549,6 +5787,9 @@ async def handle_finish_photo_upload(callback: CallbackQuery, state: FSMContext)
     print(f"[DEBUG] === КНОПКА ЗАКОНЧИТЬ ===")
     print(f"[DEBUG] callback.message.message_id: {callback.message.message_id}")
     
+    # Альбомы, которые еще собираются, сохраняются до очистки состояния
+    await wait_pending_photo_albums(callback.message.chat.id)
+    
     data = await state.get_data()
     print(f"[DEBUG STATE] === АНАЛИЗ FSM СОСТОЯНИЯ ===")
     print(f"[DEBUG STATE] Все данные в состоянии: {data}")
@@ -4583,13 +5824,11 @@ async def handle_finish_photo_upload(callback: CallbackQuery, state: FSMContext)
         print(f"[DEBUG] Статус в schedule обновлен")
         
         # Уведомляем DoubleA и Account
-        cursor.execute("SELECT telegram_id FROM users WHERE status IN ('DoubleA', 'Account')")
-        admins = cursor.fetchall()
+        admins = get_user_directory().with_roles('DoubleA', 'Account')
         print(f"[DEBUG] Найдено получателей уведомлений: {len(admins)}")
         
         # Получаем имя и ник преподавателя из базы данных
-        cursor.execute("SELECT name, nik_name FROM users WHERE telegram_id = ?", (callback.from_user.id,))
-        user_data = cursor.fetchone()
+        user_data = get_user_directory().fields(callback.from_user.id, "name", "nik_name")
         user_name, nik_name = user_data if user_data else ("Неизвестный", "")
         
         admin_message = f"📸 Файлы с урока загружены!\n"
@@ -4611,15 +5850,10 @@ async def handle_finish_photo_upload(callback: CallbackQuery, state: FSMContext)
         print(f"[DEBUG BUTTON] - date_ll: '{date_ll}'")
         
         try:
-            # Получаем modul и theme из таблицы schedule
-            cursor.execute("""
-                SELECT modul, theme FROM schedule 
-                WHERE Point = ? AND Groupp = ? AND Time_L = ? AND DateLL = ?
-            """, (point, groupp, time_l, date_ll))
-            
-            schedule_data = cursor.fetchone()
-            modul = schedule_data[0] if schedule_data and schedule_data[0] else ""
-            theme = schedule_data[1] if schedule_data and schedule_data[1] else ""
+            # Получаем modul и theme из снимка расписания
+            schedule_data = get_schedule_snapshot().find(point, groupp, time_l, date_ll)
+            modul = schedule_data.Modul if schedule_data and schedule_data.Modul else ""
+            theme = schedule_data.Theme if schedule_data and schedule_data.Theme else ""
             
             print(f"[DEBUG BUTTON] Получены данные из schedule: modul='{modul}', theme='{theme}'")
             
@@ -4646,7 +5880,8 @@ async def handle_finish_photo_upload(callback: CallbackQuery, state: FSMContext)
         print(f"[DEBUG BUTTON] === КОНЕЦ СОЗДАНИЯ КНОПКИ ===")
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Выгрузить файлы", callback_data=callback_data)]
+            [InlineKeyboardButton(text="Выгрузить файлы", callback_data=callback_data)],
+            [InlineKeyboardButton(text="Переслать альбомами", callback_data=f"export_album:{export_id}")]
         ])
         
         for admin in admins:
@@ -4674,12 +5909,7 @@ async def handle_finish_photo_upload(callback: CallbackQuery, state: FSMContext)
         
         await callback.message.edit_text("✅ Загрузка файлов завершена!")
         
-        # Очищаем данные уроков для этого пользователя
-        user_id = callback.from_user.id
-        if user_id in lessons_data_photo:
-            del lessons_data_photo[user_id]
-            print(f"[DEBUG] Очищены данные уроков для пользователя {user_id}")
-        
+        # Очищаем состояние вместе с данными уроков пользователя
         await state.clear()
         print(f"[DEBUG] Состояние очищено")
         
@@ -4688,140 +5918,831 @@ async def handle_finish_photo_upload(callback: CallbackQuery, state: FSMContext)
         print(f"[ERROR] Ошибка завершения загрузки: {e}")
         import traceback
         traceback.print_exc()
-        
-        # Очищаем данные пользователя при ошибке
-        user_id = callback.from_user.id
-        if user_id in lessons_data_photo:
-            del lessons_data_photo[user_id]
-            print(f"[DEBUG] Очищены данные уроков для пользователя {user_id} из-за ошибки")
     finally:
         conn.close()
     
     print(f"[DEBUG] === КОНЕЦ КНОПКИ ЗАКОНЧИТЬ ===")
 
 
-async def create_zip_parts(files, archive_name, max_size_mb=45):
+# Вебхуки, возвращающие ссылки на сообщение и имидж урока, по модулю
+EXPORT_MODUL_WEBHOOKS = {
+    "Собирай": "https://hook.eu2.make.com/qi573yyxi48wtbt7atvsw1x17sfcmy88",
+    "Конструируй": "https://hook.eu2.make.com/r1mygjngqkpusjsj2caqru900q4xxixg",
+    "Программируй": "https://hook.eu2.make.com/t0ncjfd7c29dwrwncjwbzfyegesvyxtk",
+    "Школьники": "https://hook.eu2.make.com/hj7ofzzbwpnuyfyntiqq6p3tstq6tu91",
+    "Scratch": "https://hook.eu2.make.com/3ciprue991krd9osvj5t0ppzlh7pxnmf",
+}
+WEBHOOK_NAMES.update({url: "make_export" for url in EXPORT_MODUL_WEBHOOKS.values()})
+
+# Telegram принимает в sendMediaGroup от 2 до 10 элементов
+EXPORT_ALBUM_SIZE = 10
+
+
+def get_export_links(modul, theme):
+    """
+    Ссылки на сообщение и имидж для урока (mass_link, picture_link)
+
+    При пустом модуле/теме, неизвестном модуле или ошибке вебхука
+    возвращаются пустые строки - выгрузка продолжается без ссылок.
+    """
+    if not (modul and theme):
+        print(f"[DEBUG EXPORT] Модуль или тема пустые: modul='{modul}', theme='{theme}'")
+        return "", ""
+
+    webhook_url = EXPORT_MODUL_WEBHOOKS.get(modul)
+    if not webhook_url:
+        print(f"[DEBUG EXPORT] Модуль '{modul}' не соответствует известным вебхукам")
+        return "", ""
+
+    print(f"[DEBUG EXPORT] Отправляем запрос к вебхуку: {webhook_url}, theme='{theme}'")
+    try:
+        response = post_webhook(webhook_url, json={"theme": theme}, timeout=30)
+        print(f"[DEBUG EXPORT] Статус ответа: {response.status_code}")
+        if response.status_code != 200:
+            print(f"[ERROR EXPORT] Вебхук вернул статус {response.status_code}")
+            return "", ""
+        webhook_data = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"[ERROR EXPORT] Ошибка при запросе к вебхуку: {e}")
+        return "", ""
+
+    mass_link = webhook_data.get("mass", "")
+    picture_link = webhook_data.get("picture", "")
+    print(f"[DEBUG EXPORT] Вебхук ответил: mass='{mass_link}', picture='{picture_link}'")
+    return mass_link, picture_link
+
+
+def format_export_caption(title, point, groupp, time_l, date_ll, files_count, mass_link, picture_link):
+    """Подпись выгрузки файлов урока (HTML) со ссылками на сообщение и имидж"""
+    caption = f"{title}\n"
+    caption += f"Садик: {point}\n"
+    caption += f"Группа: {groupp}\n"
+    caption += f"Время: {time_l}\n"
+    caption += f"Дата: {date_ll}\n"
+    caption += f"Всего файлов: {files_count}"
+    caption += f"\nСообщение: <a href=\"{mass_link}\">ссылка</a>" if mass_link else "\nСообщение: _"
+    caption += f"\nИмидж: <a href=\"{picture_link}\">ссылка</a>" if picture_link else "\nИмидж: _"
+    return caption
+
+
+# Пережатие фото при выгрузке ZIP: уменьшение до EXPORT_IMAGE_MAX_SIDE по большей
+# стороне и JPEG с качеством EXPORT_JPEG_QUALITY. Нужен Pillow; работа идет в пуле
+# процессов, чтобы не занимать цикл событий
+EXPORT_RECOMPRESS = getattr(config, "EXPORT_RECOMPRESS", False)
+EXPORT_IMAGE_MAX_SIDE = getattr(config, "EXPORT_IMAGE_MAX_SIDE", 2560)
+EXPORT_JPEG_QUALITY = getattr(config, "EXPORT_JPEG_QUALITY", 85)
+EXPORT_RECOMPRESS_WORKERS = getattr(config, "EXPORT_RECOMPRESS_WORKERS", None)  # None - по числу ядер
+
+# Сколько файлов скачивается (и пережимается) одновременно
+EXPORT_FETCH_CONCURRENCY = getattr(config, "EXPORT_FETCH_CONCURRENCY", 8)
+
+# Отбор похожих фото при выгрузке ZIP: из серии кадров с расстоянием Хэмминга
+# между dHash не больше EXPORT_NEAR_DUP_DISTANCE остается кадр с наибольшим разрешением
+EXPORT_NEAR_DUP_FILTER = getattr(config, "EXPORT_NEAR_DUP_FILTER", False)
+EXPORT_NEAR_DUP_DISTANCE = getattr(config, "EXPORT_NEAR_DUP_DISTANCE", 6)
+
+# Сборка ZIP идет в отдельных потоках (zlib отпускает GIL): несколько выгрузок
+# сжимаются параллельно, а цикл событий не блокируется
+EXPORT_ZIP_WORKERS = getattr(config, "EXPORT_ZIP_WORKERS", 4)
+# Сколько скачанных файлов может ждать записи в архив (ограничивает память)
+EXPORT_ZIP_QUEUE_SIZE = getattr(config, "EXPORT_ZIP_QUEUE_SIZE", 16)
+# Максимальный размер части архива: 45 MB под лимит облачного Bot API (50 MB),
+# локальный Bot API сервер принимает файлы до 2 GB
+EXPORT_PART_SIZE_MB = getattr(config, "EXPORT_PART_SIZE_MB", 1950 if TELEGRAM_API_URL else 45)
+# Облачный Bot API отдает через getFile только файлы до 20 MB
+CLOUD_API_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+# Каталог для временных файлов частей (None - системный каталог временных файлов)
+EXPORT_TMP_DIR = getattr(config, "EXPORT_TMP_DIR", None)
+
+export_process_pool = None
+export_zip_executor = None
+pillow_missing = False
+
+
+def get_export_process_pool():
+    """Пул процессов для обработки фото Pillow; None, если Pillow не установлен"""
+    global export_process_pool, pillow_missing
+    if pillow_missing:
+        return None
+    if export_process_pool is None:
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            print("[EXPORT] Pillow не установлен, пережатие и отбор похожих фото отключены")
+            pillow_missing = True
+            return None
+        export_process_pool = ProcessPoolExecutor(max_workers=EXPORT_RECOMPRESS_WORKERS)
+    return export_process_pool
+
+
+def get_export_zip_executor():
+    """Пул потоков для сборки ZIP архивов"""
+    global export_zip_executor
+    if export_zip_executor is None:
+        export_zip_executor = ThreadPoolExecutor(max_workers=EXPORT_ZIP_WORKERS, thread_name_prefix="export-zip")
+    return export_zip_executor
+
+
+def shutdown_export_executors():
+    """Останавливает пулы выгрузки (при завершении бота)"""
+    global export_process_pool, export_zip_executor
+    if export_process_pool is not None:
+        export_process_pool.shutdown(cancel_futures=True)
+        export_process_pool = None
+    if export_zip_executor is not None:
+        export_zip_executor.shutdown(cancel_futures=True)
+        export_zip_executor = None
+
+
+def remove_export_files(paths):
+    """Удаляет временные файлы частей архива (уже удаленные пропускаются)"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"[ERROR EXPORT] Не удалось удалить временный файл {path}: {e}")
+
+
+class ZipPartWriter:
+    """
+    Собирает части ZIP во временных файлах
+
+    Скачанные файлы передаются через очередь (add), new_part закрывает текущую
+    часть, close дожидается записи и возвращает пути ко всем частям. Удалять
+    файлы частей должен вызывающий (remove_export_files). Каждый файл пишется
+    в архив в пуле потоков: поток занят только на время сжатия, а не всю выгрузку.
+
+    on_sealed(part_index, part_path) вызывается в потоке пула сразу после
+    закрытия каждой части. Файлы, добавленные с temporary=True, удаляются после
+    записи в архив.
+    """
+
+    _NEW_PART = object()
+    _DONE = object()
+
+    def __init__(self, on_sealed=None):
+        self.on_sealed = on_sealed
+        # Не даем скачиванию уйти далеко вперед сжатия: add ждет, пока в очереди есть место
+        self.queue = asyncio.Queue(EXPORT_ZIP_QUEUE_SIZE)
+        self.parts = []
+        self.part_file = self.zip_file = None
+        self.error = None
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if self.error is None:
+                try:
+                    await loop.run_in_executor(get_export_zip_executor(), self._write, item)
+                except Exception as e:
+                    self.error = e
+                    self._discard()
+            elif isinstance(item, tuple) and item[2]:
+                # После ошибки очередь только разбирается, чтобы add не ждал вечно
+                remove_export_files([item[1]])
+            if item is self._DONE:
+                return
+
+    def _discard(self):
+        """Закрывает недописанную часть и удаляет файлы всех частей (после ошибки записи)"""
+        for handle in (self.zip_file, self.part_file):
+            if handle is not None:
+                try:
+                    handle.close()
+                except Exception as e:
+                    print(f"[ERROR EXPORT] Не удалось закрыть часть архива: {e}")
+        self.part_file = self.zip_file = None
+        remove_export_files(self.parts)
+
+    def _write(self, item):
+        if item is self._NEW_PART or item is self._DONE:
+            if self.zip_file is not None:
+                self.zip_file.close()
+                self.part_file.close()
+                self.part_file = self.zip_file = None
+                if self.on_sealed:
+                    self.on_sealed(len(self.parts) - 1, self.parts[-1])
+            return
+        if self.zip_file is None:
+            self.part_file = tempfile.NamedTemporaryFile(
+                prefix="export_", suffix=".zip", dir=EXPORT_TMP_DIR, delete=False
+            )
+            self.parts.append(self.part_file.name)
+            self.zip_file = zipfile.ZipFile(self.part_file, 'w', zipfile.ZIP_DEFLATED)
+        file_name, file_data, temporary = item
+        if isinstance(file_data, bytes):
+            self.zip_file.writestr(file_name, file_data)
+        else:
+            # Файл на диске (локального Bot API сервера или скачанный заранее) читается по частям
+            self.zip_file.write(file_data, file_name)
+            if temporary:
+                remove_export_files([file_data])
+
+    async def _put(self, item):
+        if self.error is not None:
+            raise self.error  # Запись упала - пробрасываем ее ошибку
+        await self.queue.put(item)
+
+    async def add(self, file_name, file_data, temporary=False):
+        await self._put((file_name, file_data, temporary))
+
+    async def new_part(self):
+        await self._put(self._NEW_PART)
+
+    async def close(self):
+        """Пути к файлам частей в порядке создания"""
+        if not self.task.done():
+            await self.queue.put(self._DONE)
+        await self.task
+        if self.error is not None:
+            raise self.error
+        return self.parts
+
+
+def file_source_size(source):
+    """Размер файла: source - содержимое (bytes) или путь на диске"""
+    return len(source) if isinstance(source, bytes) else os.path.getsize(source)
+
+
+def open_file_source(source):
+    """Объект для Image.open: содержимое оборачивается в BytesIO, путь передается как есть"""
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+def recompress_image(source, max_side, quality):
+    """
+    Уменьшает фото и пережимает его в JPEG (выполняется в пуле процессов)
+
+    source - содержимое (bytes) или путь к файлу. Если результат не меньше
+    исходного файла, возвращается None.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(open_file_source(source)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+    result = output.getvalue()
+    return result if len(result) < file_source_size(source) else None
+
+
+def photo_dhash(source):
+    """(dHash 64 бита, ширина, высота) фото (выполняется в пуле процессов)"""
+    from PIL import Image
+
+    with Image.open(open_file_source(source)) as image:
+        width, height = image.size
+        image.draft("L", (64, 64))  # JPEG декодируется сразу в уменьшенном виде
+        pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value, width, height
+
+
+class HammingBKTree:
+    """BK-дерево хешей: поиск всех хешей в пределах расстояния Хэмминга без полного перебора"""
+
+    def __init__(self):
+        self.root = None  # [хеш, элемент, {расстояние: потомок}]
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, item, {}]
+            return
+        node = self.root
+        while True:
+            distance = bin(value ^ node[0]).count("1")
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, item, {}]
+                return
+            node = child
+
+    def find(self, value, radius):
+        """Элементы с хешами на расстоянии не больше radius"""
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = bin(value ^ node[0]).count("1")
+            if distance <= radius:
+                found.append(node[1])
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+async def get_file_source(file_id, file_size=None):
+    """
+    Файл Telegram для обработки: путь на диске локального Bot API сервера
+    (без копирования) или скачанное содержимое (bytes)
+    """
+    api = bot.session.api
+    if not api.is_local and file_size and file_size > CLOUD_API_DOWNLOAD_LIMIT:
+        raise ValueError(f"файл {file_size / (1024*1024):.1f} MB больше лимита облачного Bot API (20 MB), "
+                         f"нужен локальный сервер (TELEGRAM_API_URL)")
+    file_info = await bot.get_file(file_id)
+    if api.is_local:
+        # Локальный сервер не отдает файлы по HTTP: bot.download_file открыл бы тот же путь
+        local_path = api.wrap_local_file.to_local(file_info.file_path)
+        if not os.path.isfile(local_path):
+            raise RuntimeError(f"файл {file_info.file_path} не найден по пути {local_path}: проверьте "
+                               f"TELEGRAM_API_SERVER_DIR/TELEGRAM_API_LOCAL_DIR (каталог данных telegram-bot-api, "
+                               f"как его видят сервер и бот)")
+        return str(local_path)
+    return (await bot.download_file(file_info.file_path)).read()
+
+
+def save_prefetched_source(source):
+    """Путь к скачанному содержимому во временном файле (выполняется в потоке)"""
+    with tempfile.NamedTemporaryFile(prefix="export_src_", dir=EXPORT_TMP_DIR, delete=False) as temp_file:
+        temp_file.write(source)
+    return temp_file.name
+
+
+def remove_prefetched_files(prefetched):
+    """Удаляет временные файлы, скачанные при отборе похожих фото и не попавшие в архив"""
+    remove_export_files([source for source, temporary in prefetched.values() if temporary])
+    prefetched.clear()
+
+
+async def filter_near_duplicate_photos(files, prefetched=None):
+    """
+    Убирает из выгрузки похожие фото (серии кадров)
+
+    Хеши берутся из photo_hashes, недостающие считаются в пуле процессов и
+    сохраняются. Видео и фото без хеша остаются. Возвращает (files, число отброшенных).
+
+    Если передан prefetched, скачанные для хеша фото остаются в нем для сборки
+    архива (build_zip_parts), чтобы не скачивать их второй раз: file_id ->
+    (путь, temporary). Содержимое из облачного Bot API лежит во временном файле
+    (temporary=True), его удаляет сборка архива или remove_prefetched_files.
+    """
+    pool = get_export_process_pool()
+    if pool is None:
+        return files, 0
+
+    photos = [f for f in files if f[3] == 'photo' and f[1]]
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT file_unique_id, dhash, width, height FROM photo_hashes WHERE file_unique_id IN (SELECT value FROM json_each(?))",
+            (json.dumps([f[1] for f in photos]),)
+        )
+        hashes = {row[0]: (int(row[1], 16), row[2], row[3]) for row in cursor.fetchall()}
+
+        missing = [f for f in photos if f[1] not in hashes]
+        loop = asyncio.get_running_loop()
+
+        async def compute(file_row):
+            source = await get_file_source(file_row[0], file_row[2])
+            if prefetched is not None:
+                temporary = isinstance(source, bytes)
+                if temporary:
+                    source = await loop.run_in_executor(None, save_prefetched_source, source)
+                prefetched[file_row[0]] = (source, temporary)
+            return await loop.run_in_executor(pool, photo_dhash, source)
+
+        computed = []
+        for start in range(0, len(missing), EXPORT_FETCH_CONCURRENCY):
+            batch = missing[start:start + EXPORT_FETCH_CONCURRENCY]
+            results = await asyncio.gather(*(compute(f) for f in batch), return_exceptions=True)
+            for file_row, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    print(f"[ERROR EXPORT] Не удалось посчитать хеш фото {file_row[1]}: {result}")
+                    continue
+                hashes[file_row[1]] = result
+                computed.append((file_row[1], f"{result[0]:016x}", result[1], result[2]))
+        if computed:
+            cursor.executemany("INSERT OR REPLACE INTO photo_hashes VALUES (?, ?, ?, ?)", computed)
+            conn.commit()
+    finally:
+        conn.close()
+
+    # Сначала кадры с большим разрешением: первый в группе похожих становится ее представителем
+    ranked = sorted(
+        (f for f in photos if f[1] in hashes),
+        key=lambda f: (hashes[f[1]][1] * hashes[f[1]][2], f[2] or 0),
+        reverse=True
+    )
+    tree = HammingBKTree()
+    dropped = set()
+    for file_row in ranked:
+        value = hashes[file_row[1]][0]
+        if tree.find(value, EXPORT_NEAR_DUP_DISTANCE):
+            dropped.add(file_row[1])
+        else:
+            tree.add(value, file_row[1])
+
+    if prefetched is not None:
+        remove_prefetched_files({f[0]: prefetched.pop(f[0]) for f in photos if f[1] in dropped and f[0] in prefetched})
+
+    print(f"[EXPORT] Отбор похожих фото: хешей из кэша {len(photos) - len(missing)}, "
+          f"посчитано {len(computed)}, отброшено {len(dropped)}")
+    return [f for f in files if f[1] not in dropped], len(dropped)
+
+
+async def fetch_export_file(file_id, file_type, stats, file_size=None, source=None):
+    """
+    Файл урока для архива (bytes или путь на диске); фото пережимаются, если
+    включен EXPORT_RECOMPRESS. source - уже скачанный файл (см. filter_near_duplicate_photos)
+    """
+    if source is None:
+        source = await get_file_source(file_id, file_size)
+    stats["original_bytes"] += file_source_size(source)
+
+    pool = get_export_process_pool() if EXPORT_RECOMPRESS and file_type == 'photo' else None
+    if pool is not None:
+        try:
+            compressed = await asyncio.get_running_loop().run_in_executor(
+                pool, recompress_image, source, EXPORT_IMAGE_MAX_SIDE, EXPORT_JPEG_QUALITY
+            )
+            if compressed is not None:
+                source = compressed
+        except Exception as e:
+            print(f"[ERROR EXPORT] Не удалось пережать фото {file_id}: {e}")
+    stats["export_bytes"] += file_source_size(source)
+    return source
+
+
+def export_file_name(file_type, number):
+    """Имя файла урока в архиве: photo_001.jpg, video_002.mp4"""
+    # Определяем расширение файла на основе типа
+    file_extension = '.jpg' if file_type == 'photo' else '.mp4'
+    return f"{file_type}_{number:03d}{file_extension}"
+
+
+async def build_zip_parts(entries, archive_name, max_size_mb=None, stats=None, extra_files=(), checkpoint=None,
+                          prefetched=None):
     """
-    Создает ZIP архивы, разбивая файлы на части по размеру
+    Создает ZIP архивы во временных файлах, разбивая файлы на части по размеру
     
     Args:
-        files: Список файлов для архивирования
-        archive_name: Базовое имя архива
-        max_size_mb: Максимальный размер части в МБ (по умолчанию 45MB)
+        entries: Список (имя в архиве, file_id, file_size, file_type)
+        archive_name: Имя архива (части получают суффикс _N)
+        max_size_mb: Максимальный размер части в МБ (по умолчанию EXPORT_PART_SIZE_MB)
+        stats: Словарь, куда записываются original_bytes/export_bytes (размер до и после
+            пережатия) и failed (файлы, которые не удалось добавить)
+        extra_files: Список (имя в архиве, bytes), добавляется в первую часть
+        checkpoint: ExportCheckpoint - куда записываются закрытые части и неудачные файлы;
+            закрытые части при ошибке не удаляются (по ним продолжится выгрузка)
+        prefetched: Файлы, уже скачанные при отборе похожих фото (file_id -> (путь, temporary));
+            временные файлы удаляются после записи в архив, оставшиеся удаляет вызывающий
+            (remove_prefetched_files)
     
     Returns:
-        list: Список кортежей (part_data, part_filename, part_number, total_parts)
+        list: Список кортежей (part_path, part_filename, part_number, total_parts);
+        файлы частей удаляет вызывающий (remove_export_files)
     """
+    max_size_mb = max_size_mb or EXPORT_PART_SIZE_MB
     max_size_bytes = max_size_mb * 1024 * 1024  # Конвертируем в байты
+    if stats is None:
+        stats = {}
+    stats.update(original_bytes=0, export_bytes=0, failed=0)
     
     print(f"[DEBUG ZIP SPLIT] Создаем архивы с максимальным размером {max_size_mb} MB")
-    print(f"[DEBUG ZIP SPLIT] Всего файлов для архивирования: {len(files)}")
+    print(f"[DEBUG ZIP SPLIT] Всего файлов для архивирования: {len(entries)}")
+    
+    # Части набираются по фактическому размеру скачанных (и пережатых) файлов;
+    # сжатие идет в потоке ZipPartWriter параллельно со скачиванием следующих
+    # Индексы entries по частям; часть закрывается в потоке уже после того,
+    # как все ее файлы сюда записаны (new_part идет в очередь следом за ними)
+    part_entries = [[]]
+    on_sealed = None
+    if checkpoint is not None:
+        on_sealed = lambda index, path: checkpoint.part_sealed(index, path, part_entries[index])
+    writer = ZipPartWriter(on_sealed)
+    part_files = []
+    current_files = 0
+    current_size = 0
     
-    # Если файлов мало, создаем один архив
-    if len(files) <= 10:  # Эвристика: если файлов мало, скорее всего поместится в один архив
-        print(f"[DEBUG ZIP SPLIT] Мало файлов, создаем один архив")
-        zip_buffer = io.BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for i, (file_id, file_unique_id, file_size, file_type) in enumerate(files, 1):
-                try:
-                    # Получаем файл по file_id
-                    file_info = await bot.get_file(file_id)
-                    file_data = await bot.download_file(file_info.file_path)
-                    
-                    # Определяем расширение файла на основе типа
-                    file_extension = '.jpg' if file_type == 'photo' else '.mp4'
-                    
-                    # Создаем имя файла в архиве
-                    file_name = f"{file_type}_{i:03d}{file_extension}"
-                    
-                    # Добавляем файл в архив
-                    zip_file.writestr(file_name, file_data.read())
-                    
-                except Exception as e:
-                    print(f"[ERROR ZIP SPLIT] Ошибка при обработке файла {i}: {e}")
+    try:
+        for name, data in extra_files:
+            await writer.add(name, data)
+            current_size += len(data)
+        for start in range(0, len(entries), EXPORT_FETCH_CONCURRENCY):
+            batch = entries[start:start + EXPORT_FETCH_CONCURRENCY]
+            prefetched_batch = [prefetched.get(file_id, (None, False)) if prefetched else (None, False)
+                                for _, file_id, _, _ in batch]
+            results = await asyncio.gather(
+                *(fetch_export_file(file_id, file_type, stats, file_size, source)
+                  for (_, file_id, file_size, file_type), (source, _) in zip(batch, prefetched_batch)),
+                return_exceptions=True
+            )
+            for index, ((name, file_id, file_size, file_type), file_data, (source, temporary)) in enumerate(
+                    zip(batch, results, prefetched_batch), start):
+                # Временный файл уходит в архив как есть или больше не нужен (пережат, ошибка)
+                temporary = temporary and file_data == source
+                if source is not None and not temporary:
+                    remove_prefetched_files({file_id: prefetched_batch[index - start]})
+                if isinstance(file_data, Exception):
+                    print(f"[ERROR ZIP SPLIT] Ошибка при обработке файла {name}: {file_data}")
+                    stats["failed"] += 1
+                    if checkpoint is not None:
+                        checkpoint.file_failed(index)
                     continue
-        
-        zip_buffer.seek(0)
-        zip_data = zip_buffer.getvalue()
-        
-        # Проверяем размер
-        if len(zip_data) <= max_size_bytes:
-            print(f"[DEBUG ZIP SPLIT] Один архив помещается: {len(zip_data) / (1024*1024):.2f} MB")
-            return [(zip_data, archive_name, 1, 1)]
-        else:
-            print(f"[DEBUG ZIP SPLIT] Один архив слишком большой: {len(zip_data) / (1024*1024):.2f} MB, разбиваем")
-    
-    # Разбиваем файлы на группы для создания нескольких архивов
+                data_size = file_source_size(file_data)
+                if current_files and current_size + data_size > max_size_bytes:
+                    part_entries.append([])
+                    await writer.new_part()
+                    part_files.append(current_files)
+                    current_files = 0
+                    current_size = 0
+                await writer.add(name, file_data, temporary)
+                part_entries[-1].append(index)
+                current_files += 1
+                current_size += data_size
+        if current_files or extra_files:
+            part_files.append(current_files)
+    except BaseException:
+        part_paths = await writer.close()
+        if checkpoint is not None:
+            part_paths = [path for path in part_paths if path not in checkpoint.sealed_paths]
+        remove_export_files(part_paths)
+        raise
+    part_paths = await writer.close()
+    
+    total_parts = len(part_paths)
+    stem = archive_name[:-4] if archive_name.endswith(".zip") else archive_name
     parts = []
-    current_part = 1
-    current_files = []
-    current_size = 0
-    
-    for i, (file_id, file_unique_id, file_size, file_type) in enumerate(files):
-        # Проверяем, поместится ли файл в текущую часть
-        if current_size + file_size > max_size_bytes and current_files:
-            # Создаем архив из текущих файлов (БЕЗ текущего файла)
-            part_data = await create_zip_from_files(current_files, current_part)
-            part_filename = f"{archive_name}_{current_part}.zip"
-            parts.append((part_data, part_filename, current_part, 0))  # total_parts будет обновлен позже
-            
-            print(f"[DEBUG ZIP SPLIT] Создан архив {current_part}: {len(part_data) / (1024*1024):.2f} MB, файлов: {len(current_files)}")
-            
-            # Начинаем новую часть с текущим файлом
-            current_part += 1
-            current_files = [(file_id, file_unique_id, file_size, file_type)]
-            current_size = file_size
-        else:
-            # Добавляем файл в текущую часть
-            current_files.append((file_id, file_unique_id, file_size, file_type))
-            current_size += file_size
-    
-    # Создаем последний архив
-    if current_files:
-        part_data = await create_zip_from_files(current_files, current_part)
-        part_filename = f"{archive_name}_{current_part}.zip"
-        parts.append((part_data, part_filename, current_part, 0))
-        
-        print(f"[DEBUG ZIP SPLIT] Создан архив {current_part}: {len(part_data) / (1024*1024):.2f} MB, файлов: {len(current_files)}")
-    
-    # Обновляем total_parts для всех частей
-    total_parts = len(parts)
-    for i in range(len(parts)):
-        parts[i] = (parts[i][0], parts[i][1], parts[i][2], total_parts)
-    
-    print(f"[DEBUG ZIP SPLIT] Создано {total_parts} частей")
+    for part_number, (part_path, files_in_part) in enumerate(zip(part_paths, part_files), 1):
+        part_filename = f"{stem}.zip" if total_parts == 1 else f"{stem}_{part_number}.zip"
+        parts.append((part_path, part_filename, part_number, total_parts))
+        print(f"[DEBUG ZIP SPLIT] Создан архив {part_number}: "
+              f"{os.path.getsize(part_path) / (1024*1024):.2f} MB, файлов: {files_in_part}")
+    
+    saved_mb = (stats["original_bytes"] - stats["export_bytes"]) / (1024 * 1024)
+    print(f"[DEBUG ZIP SPLIT] Создано {total_parts} частей, пережатие сэкономило {saved_mb:.2f} MB")
     return parts
 
 
-async def create_zip_from_files(files, part_number):
+async def send_zip_parts(chat_id, parts, base_caption, progress=None, on_sent=None):
     """
-    Создает ZIP архив из списка файлов
+    Отправляет части архива документами и удаляет их файлы; возвращает число отправленных частей
+
+    progress(part_number, total_parts) вызывается перед отправкой каждой части, если частей несколько.
+    on_sent(part_path, message) вызывается после отправки части (его ошибки только
+    логируются); если он задан, файлы неотправленных частей остаются на диске для
+    повторной отправки. Файл отправленной части удаляется всегда.
     """
-    zip_buffer = io.BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for i, (file_id, file_unique_id, file_size, file_type) in enumerate(files, 1):
+    sent_parts = 0
+    try:
+        for part_path, part_filename, part_number, total_parts in parts:
             try:
-                # Получаем файл по file_id
-                file_info = await bot.get_file(file_id)
-                file_data = await bot.download_file(file_info.file_path)
-                
-                # Определяем расширение файла на основе типа
-                file_extension = '.jpg' if file_type == 'photo' else '.mp4'
+                # Обновляем прогресс отправки
+                if total_parts > 1 and progress:
+                    await progress(part_number, total_parts)
                 
-                # Создаем имя файла в архиве
-                file_name = f"{file_type}_{i:03d}{file_extension}"
+                # Формируем подпись для архива
+                if total_parts > 1:
+                    part_caption = f"{base_caption}\n\n📦 Архив {part_number} из {total_parts}"
+                else:
+                    part_caption = base_caption
                 
-                # Добавляем файл в архив
-                zip_file.writestr(file_name, file_data.read())
+                # Отправляем архив с диска (читается частями при загрузке)
+                sent_message = await bot.send_document(
+                    chat_id=chat_id,
+                    document=FSInputFile(part_path, filename=part_filename),
+                    caption=part_caption,
+                    parse_mode='HTML'
+                )
                 
             except Exception as e:
-                print(f"[ERROR ZIP CREATE] Ошибка при обработке файла {i} в части {part_number}: {e}")
+                print(f"[ERROR ZIP SEND] Ошибка отправки части {part_number}: {e}")
+                # Продолжаем отправку остальных частей
                 continue
-    
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue()
+            
+            # Часть доставлена: она отправлена и ее файл не нужен, даже если отметка не записалась
+            sent_parts += 1
+            if on_sent:
+                try:
+                    on_sent(part_path, sent_message)
+                except Exception as e:
+                    print(f"[ERROR ZIP SEND] Не удалось записать отправку части {part_number}: {e}")
+            remove_export_files([part_path])
+            print(f"[DEBUG ZIP SEND] Отправлена часть {part_number}/{total_parts}: {part_filename}")
+    finally:
+        # Части, которые не удалось отправить, тоже удаляются (кроме выгрузок с контрольными точками)
+        if on_sent is None:
+            remove_export_files(part[0] for part in parts)
+    return sent_parts
+
+
+# ============================================================================
+# ВОЗОБНОВЛЯЕМЫЕ ВЫГРУЗКИ (КОНТРОЛЬНЫЕ ТОЧКИ)
+# ============================================================================
+
+# job_key выгрузок, которые сейчас идут в этом процессе
+active_export_jobs = set()
+
+
+class ExportCheckpoint:
+    """
+    Запись состояния выгрузки в export_files/export_parts во время сборки архива
+
+    part_sealed вызывается из потока ZipPartWriter: часть сохраняется как
+    'sealed' с путем к файлу, ее файлы - как 'packed'. entries, которые
+    получает build_zip_parts, соответствуют positions по индексу.
+    """
+
+    def __init__(self, job_id, positions, first_part):
+        self.job_id = job_id
+        self.positions = positions
+        self.first_part = first_part
+        self.sealed_paths = set()
+
+    def part_sealed(self, part_index, part_path, entry_indexes):
+        part_number = self.first_part + part_index
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO export_parts (job_id, part_number, path, state) VALUES (?, ?, ?, 'sealed')",
+                (self.job_id, part_number, part_path)
+            )
+            cursor.executemany(
+                "UPDATE export_files SET state = 'packed', part_number = ? WHERE job_id = ? AND position = ?",
+                [(part_number, self.job_id, self.positions[index]) for index in entry_indexes]
+            )
+            cursor.execute("UPDATE export_jobs SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (self.job_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        self.sealed_paths.add(part_path)
+
+    def file_failed(self, entry_index):
+        conn = get_db_connection()
+        try:
+            conn.execute(
+                "UPDATE export_files SET state = 'failed' WHERE job_id = ? AND position = ?",
+                (self.job_id, self.positions[entry_index])
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def load_export_job(job_key, chat_id, entries, archive_name):
+    """
+    Незавершенная выгрузка job_key или новая по entries
+
+    Части, файлы которых пропали с диска (например, после перезапуска с очисткой
+    временной папки), забываются, а их файлы снова ждут скачивания.
+    Возвращает (job_id, archive_name, pending, resumed), pending - список
+    (position, arcname, file_id, file_size, file_type) неупакованных файлов.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, status, archive_name FROM export_jobs WHERE job_key = ?", (job_key,))
+        job = cursor.fetchone()
+        if job and job[1] != 'done':
+            job_id, _, archive_name = job
+            cursor.execute(
+                "SELECT part_number, path FROM export_parts WHERE job_id = ? AND state = 'sealed'", (job_id,)
+            )
+            lost = [(job_id, part_number) for part_number, path in cursor.fetchall() if not os.path.exists(path)]
+            if lost:
+                print(f"[EXPORT RESUME] {job_key}: частей без файла на диске: {len(lost)}")
+                cursor.executemany("DELETE FROM export_parts WHERE job_id = ? AND part_number = ?", lost)
+                cursor.executemany(
+                    "UPDATE export_files SET state = 'pending', part_number = NULL WHERE job_id = ? AND part_number = ?",
+                    lost
+                )
+            resumed = True
+        else:
+            if job:
+                # Завершенная выгрузка запускается заново
+                for table in ("export_parts", "export_files"):
+                    cursor.execute(f"DELETE FROM {table} WHERE job_id = ?", (job[0],))
+                cursor.execute("DELETE FROM export_jobs WHERE id = ?", (job[0],))
+            cursor.execute(
+                "INSERT INTO export_jobs (job_key, chat_id, archive_name) VALUES (?, ?, ?)",
+                (job_key, chat_id, archive_name)
+            )
+            job_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT INTO export_files (job_id, position, arcname, file_id, file_size, file_type) VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, position, *entry) for position, entry in enumerate(entries)]
+            )
+            resumed = False
+        cursor.execute("""
+            SELECT position, arcname, file_id, file_size, file_type
+            FROM export_files
+            WHERE job_id = ? AND state != 'packed'
+            ORDER BY position
+        """, (job_id,))
+        pending = cursor.fetchall()
+        conn.commit()
+        return job_id, archive_name, pending, resumed
+    finally:
+        conn.close()
+
+
+def mark_export_part_sent(job_id, part_path, document_id):
+    """Часть отправлена: файл больше не нужен, запоминаем file_id документа"""
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            "UPDATE export_parts SET state = 'sent', document_id = ?, path = NULL WHERE job_id = ? AND path = ?",
+            (document_id, job_id, part_path)
+        )
+        conn.execute("UPDATE export_jobs SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def run_export_job(job_key, chat_id, entries, archive_name, base_caption,
+                         stats=None, progress=None, extra_files=(), prefetched=None):
+    """
+    Выгрузка архивов с контрольными точками в БД
+
+    Каждая закрытая часть и каждая отправленная часть записываются сразу, поэтому
+    повторный запуск с тем же job_key (после ошибки отправки или перезапуска бота)
+    досылает закрытые части с диска и скачивает только неупакованные файлы.
+    entries - как в build_zip_parts; у незавершенной выгрузки используется
+    сохраненный план. Выгрузка завершена, когда отправлены все части.
+    prefetched передается в build_zip_parts; неиспользованные файлы удаляет вызывающий.
+
+    Returns:
+        tuple: (отправлено частей всего, всего частей, было ли продолжение)
+    """
+    if job_key in active_export_jobs:
+        raise RuntimeError(f"Выгрузка {job_key} уже выполняется")
+    active_export_jobs.add(job_key)
+    try:
+        job_id, archive_name, pending, resumed = load_export_job(job_key, chat_id, entries, archive_name)
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COALESCE(MAX(part_number), 0) FROM export_parts WHERE job_id = ?", (job_id,))
+            last_part = cursor.fetchone()[0]
+        finally:
+            conn.close()
+        if resumed:
+            print(f"[EXPORT RESUME] {job_key}: продолжаем, частей уже есть {last_part}, "
+                  f"файлов к упаковке {len(pending)}")
+
+        if pending:
+            checkpoint = ExportCheckpoint(job_id, [row[0] for row in pending], last_part + 1)
+            await build_zip_parts(
+                [row[1:] for row in pending], archive_name, stats=stats,
+                extra_files=extra_files if last_part == 0 else (), checkpoint=checkpoint,
+                prefetched=prefetched
+            )
+
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT part_number, path, state FROM export_parts WHERE job_id = ? ORDER BY part_number", (job_id,)
+            )
+            all_parts = cursor.fetchall()
+        finally:
+            conn.close()
+
+        # Номера и имена частей считаются по всем частям выгрузки, включая отправленные раньше
+        total_parts = len(all_parts)
+        stem = archive_name[:-4] if archive_name.endswith(".zip") else archive_name
+        to_send = [
+            (path, f"{stem}.zip" if total_parts == 1 else f"{stem}_{number}.zip", number, total_parts)
+            for number, (_, path, state) in enumerate(all_parts, 1)
+            if state == 'sealed'
+        ]
+        sent_before = total_parts - len(to_send)
+        sent_now = await send_zip_parts(
+            chat_id, to_send, base_caption, progress,
+            on_sent=lambda path, message: mark_export_part_sent(
+                job_id, path, message.document.file_id if message.document else None
+            )
+        )
+
+        sent_parts = sent_before + sent_now
+        if total_parts and sent_parts == total_parts:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("UPDATE export_jobs SET status = 'done', updated_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+                cursor.execute("DELETE FROM export_files WHERE job_id = ?", (job_id,))
+                conn.commit()
+            finally:
+                conn.close()
+        print(f"[EXPORT RESUME] {job_key}: отправлено частей {sent_parts}/{total_parts} (сейчас {sent_now})")
+        return sent_parts, total_parts, resumed
+    finally:
+        active_export_jobs.discard(job_key)
 
 
 # Обработчик экспорта фото для админа
@@ -4899,64 +6820,24 @@ async def handle_export_photos(callback: CallbackQuery):
         
         print(f"[DEBUG EXPORT] === КОНЕЦ ОБРАБОТКИ КНОПКИ ===")
         
+        if f"lesson:{export_id}:{callback.from_user.id}" in active_export_jobs:
+            await callback.answer("⏳ Эта выгрузка уже выполняется", show_alert=True)
+            return
+        
         # Создаем заблокированную клавиатуру для прогресса
         keyboard_blocked = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⏳ Обрабатываю...", callback_data="processing")]
-        ])
-        
-        # Получаем ссылки через вебхук на основе модуля
-        mass_link = ""
-        picture_link = ""
-        
-        if modul and theme:
-            try:
-                # Обновляем прогресс - запрос к вебхуку
-                await callback.message.edit_text(
-                    "🔄 Получаю ссылки через вебхук...\n"
-                    "Пожалуйста, подождите.",
-                    reply_markup=keyboard_blocked
-                )
-                
-                webhook_url = None
-                if modul == "Собирай":
-                    webhook_url = "https://hook.eu2.make.com/qi573yyxi48wtbt7atvsw1x17sfcmy88"
-                elif modul == "Конструируй":
-                    webhook_url = "https://hook.eu2.make.com/r1mygjngqkpusjsj2caqru900q4xxixg"
-                elif modul == "Программируй":
-                    webhook_url = "https://hook.eu2.make.com/t0ncjfd7c29dwrwncjwbzfyegesvyxtk"
-                elif modul == "Школьники":
-                    webhook_url = "https://hook.eu2.make.com/hj7ofzzbwpnuyfyntiqq6p3tstq6tu91"
-                elif modul == "Scratch":
-                    webhook_url = "https://hook.eu2.make.com/3ciprue991krd9osvj5t0ppzlh7pxnmf"
-                
-                if webhook_url:
-                    print(f"[DEBUG EXPORT] Отправляем запрос к вебхуку: {webhook_url}")
-                    print(f"[DEBUG EXPORT] Данные запроса: theme='{theme}'")
-                    try:
-                        response = requests.post(webhook_url, json={"theme": theme}, timeout=30)
-                        print(f"[DEBUG EXPORT] Статус ответа: {response.status_code}")
-                        print(f"[DEBUG EXPORT] Содержимое ответа: '{response.text[:200]}...'")
-                        
-                        if response.status_code == 200:
-                            webhook_data = response.json()
-                            mass_link = webhook_data.get("mass", "")
-                            picture_link = webhook_data.get("picture", "")
-                            print(f"[DEBUG EXPORT] Вебхук ответил: mass='{mass_link}', picture='{picture_link}'")
-                        else:
-                            print(f"[ERROR EXPORT] Вебхук вернул статус {response.status_code}")
-                    except requests.exceptions.RequestException as req_e:
-                        print(f"[ERROR EXPORT] Ошибка сети при запросе к вебхуку: {req_e}")
-                        raise req_e
-                    except ValueError as json_e:
-                        print(f"[ERROR EXPORT] Ошибка парсинга JSON: {json_e}")
-                        print(f"[ERROR EXPORT] Ответ вебхука: '{response.text}'")
-                        raise json_e
-                else:
-                    print(f"[DEBUG EXPORT] Модуль '{modul}' не соответствует известным вебхукам")
-            except Exception as e:
-                print(f"[ERROR EXPORT] Ошибка при запросе к вебхуку: {e}")
-        else:
-            print(f"[DEBUG EXPORT] Модуль или тема пустые: modul='{modul}', theme='{theme}'")
+            [InlineKeyboardButton(text="⏳ Обрабатываю...", callback_data="processing")]
+        ])
+        
+        # Получаем ссылки через вебхук на основе модуля
+        if modul and theme:
+            # Обновляем прогресс - запрос к вебхуку
+            await callback.message.edit_text(
+                "🔄 Получаю ссылки через вебхук...\n"
+                "Пожалуйста, подождите.",
+                reply_markup=keyboard_blocked
+            )
+        mass_link, picture_link = get_export_links(modul, theme)
         
         # Получаем все файлы с урока
         
@@ -4980,170 +6861,94 @@ async def handle_export_photos(callback: CallbackQuery):
             reply_markup=keyboard_blocked
         )
         
+        # Фото, скачанные для отбора похожих, повторно используются при сборке архива
+        prefetched = {}
+        # Выгрузка с контрольными точками: повторное нажатие продолжает ее, а не начинает заново
+        keyboard_retry = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔁 Дослать архивы", callback_data=f"export_photos:{export_id}")]
+        ])
         try:
+            # Похожие кадры из серий убираются до упаковки
+            near_duplicates = 0
+            if EXPORT_NEAR_DUP_FILTER:
+                await callback.message.edit_text(
+                    "🔄 Отбираю непохожие фото...\n"
+                    "Пожалуйста, подождите.",
+                    reply_markup=keyboard_blocked
+                )
+                files, near_duplicates = await filter_near_duplicate_photos(files, prefetched)
+            
             # Создаем название архива (с временем)
             archive_name = f"{point}_{groupp}_{date_ll}_{time_l}.zip"
             # Заменяем недопустимые символы в имени файла
             archive_name = "".join(c for c in archive_name if c.isalnum() or c in (' ', '-', '_', '.')).rstrip()
             
-            # Пытаемся использовать новую логику с разбивкой
-            try:
-                # Создаем архивы, разбивая файлы на части если нужно
-                archive_parts = await create_zip_parts(files, archive_name)
-                
-                # Формируем базовую подпись архива с ссылками
-                base_caption = f"📸 ZIP архив с файлами\n"
-                base_caption += f"Садик: {point}\n"
-                base_caption += f"Группа: {groupp}\n"
-                base_caption += f"Время: {time_l}\n"
-                base_caption += f"Дата: {date_ll}\n"
-                base_caption += f"Всего файлов: {len(files)}"
-                
-                # Добавляем ссылки на сообщение и изображение
-                if mass_link:
-                    base_caption += f"\nСообщение: <a href=\"{mass_link}\">ссылка</a>"
-                else:
-                    base_caption += f"\nСообщение: _"
-                
-                if picture_link:
-                    base_caption += f"\nИмидж: <a href=\"{picture_link}\">ссылка</a>"
-                else:
-                    base_caption += f"\nИмидж: _"
-                
-                # Отправляем части архива
-                total_parts = len(archive_parts)
-                sent_parts = 0
-                
-                for i, (part_data, part_filename, part_number, total_parts) in enumerate(archive_parts):
-                    try:
-                        # Обновляем прогресс отправки
-                        if total_parts > 1:
-                            await callback.message.edit_text(
-                                f"📤 Отправляю архив {part_number} из {total_parts}...\n"
-                                f"Пожалуйста, подождите.",
-                                reply_markup=keyboard_blocked
-                            )
-                        
-                        # Формируем подпись для архива
-                        if total_parts > 1:
-                            part_caption = f"{base_caption}\n\n📦 Архив {part_number} из {total_parts}"
-                        else:
-                            part_caption = base_caption
-                        
-                        # Отправляем архив
-                        await bot.send_document(
-                            chat_id=callback.from_user.id,
-                            document=BufferedInputFile(part_data, filename=part_filename),
-                            caption=part_caption,
-                            parse_mode='HTML'
-                        )
-                        
-                        sent_parts += 1
-                        print(f"[DEBUG ZIP SEND] Отправлена часть {part_number}/{total_parts}: {part_filename}")
-                        
-                    except Exception as e:
-                        print(f"[ERROR ZIP SEND] Ошибка отправки части {part_number}: {e}")
-                        # Продолжаем отправку остальных частей
-                        continue
-                
-                # Проверяем, что хотя бы одна часть была отправлена
-                if sent_parts == 0:
-                    raise Exception("Не удалось отправить ни одной части архива")
-                
-                # Финальное сообщение
-                if total_parts > 1:
-                    await callback.message.edit_text(f"✅ ZIP архивы созданы и отправлены!\n"
-                                                   f"Базовое название: {archive_name}\n"
-                                                   f"Всего файлов: {len(files)}\n"
-                                                   f"Архивов: {sent_parts}/{total_parts}")
-                else:
-                    await callback.message.edit_text(f"✅ ZIP архив создан и отправлен!\n"
-                                                   f"Название: {archive_name}\n"
-                                                   f"Файлов: {len(files)}")
-                
-            except Exception as split_error:
-                print(f"[ERROR ZIP SPLIT] Ошибка при разбивке архива: {split_error}")
-                print(f"[ERROR ZIP SPLIT] Fallback на старый метод отправки")
-                
-                # Fallback на старый метод - создаем один ZIP архив
-                try:
-                    print(f"[DEBUG ZIP FALLBACK] Создаем один ZIP архив (старый метод)")
-                    
-                    # Создаем ZIP архив в памяти (старый метод)
-                    zip_buffer = io.BytesIO()
-                    
-                    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                        # Скачиваем и добавляем каждый файл в архив
-                        for i, (file_id, file_unique_id, file_size, file_type) in enumerate(files, 1):
-                            try:
-                                # Получаем файл по file_id
-                                file_info = await bot.get_file(file_id)
-                                file_data = await bot.download_file(file_info.file_path)
-                                
-                                # Определяем расширение файла на основе типа
-                                file_extension = '.jpg' if file_type == 'photo' else '.mp4'
-                                
-                                # Создаем имя файла в архиве
-                                file_name = f"{file_type}_{i:03d}{file_extension}"
-                                
-                                # Добавляем файл в архив
-                                zip_file.writestr(file_name, file_data.read())
-                                
-                                # Обновляем прогресс каждые 5 файлов
-                                if i % 5 == 0:
-                                    await callback.message.edit_text(
-                                        f"🔄 Обработано {i} из {len(files)} файлов...\n"
-                                        "Пожалуйста, подождите.",
-                                        reply_markup=keyboard_blocked
-                                    )
-                                
-                            except Exception as e:
-                                print(f"[ERROR FALLBACK] Ошибка при обработке файла {i}: {e}")
-                                # Продолжаем со следующим файлом
-                                continue
-                    
-                    # Перемещаем указатель в начало буфера
-                    zip_buffer.seek(0)
-                    
-                    # Формируем подпись архива с ссылками (старый формат)
-                    caption = f"📸 ZIP архив с файлами\n"
-                    caption += f"Садик: {point}\n"
-                    caption += f"Группа: {groupp}\n"
-                    caption += f"Время: {time_l}\n"
-                    caption += f"Дата: {date_ll}\n"
-                    caption += f"Всего файлов: {len(files)}"
-                    
-                    # Добавляем ссылки на сообщение и изображение
-                    if mass_link:
-                        caption += f"\nСообщение: <a href=\"{mass_link}\">ссылка</a>"
-                    else:
-                        caption += f"\nСообщение: _"
-                    
-                    if picture_link:
-                        caption += f"\nИмидж: <a href=\"{picture_link}\">ссылка</a>"
-                    else:
-                        caption += f"\nИмидж: _"
-                    
-                    # Отправляем ZIP архив (старый метод)
-                    await bot.send_document(
-                        chat_id=callback.from_user.id,
-                        document=BufferedInputFile(zip_buffer.getvalue(), filename=archive_name),
-                        caption=caption,
-                        parse_mode='HTML'
-                    )
-                    
-                    await callback.message.edit_text(f"✅ ZIP архив создан и отправлен!\n"
-                                                   f"Название: {archive_name}\n"
-                                                   f"Файлов: {len(files)}\n"
-                                                   f"⚠️ Использован старый метод отправки")
-                    
-                except Exception as fallback_error:
-                    print(f"[ERROR ZIP FALLBACK] Ошибка при fallback отправке: {fallback_error}")
-                    raise fallback_error
+            # Формируем базовую подпись архива с ссылками
+            base_caption = format_export_caption(
+                "📸 ZIP архив с файлами", point, groupp, time_l, date_ll, len(files), mass_link, picture_link
+            )
             
+            async def show_part_progress(part_number, total_parts):
+                await callback.message.edit_text(
+                    f"📤 Отправляю архив {part_number} из {total_parts}...\n"
+                    f"Пожалуйста, подождите.",
+                    reply_markup=keyboard_blocked
+                )
+            
+            # Создаем и отправляем части архива; при повторном нажатии после сбоя
+            # выгрузка продолжится с неотправленных частей
+            export_stats = {"original_bytes": 0, "export_bytes": 0, "failed": 0}
+            entries = [
+                (export_file_name(file_type, i), file_id, file_size, file_type)
+                for i, (file_id, file_unique_id, file_size, file_type) in enumerate(files, 1)
+            ]
+            sent_parts, total_parts, resumed = await run_export_job(
+                f"lesson:{export_id}:{callback.from_user.id}", callback.from_user.id, entries,
+                archive_name, base_caption, stats=export_stats, progress=show_part_progress,
+                prefetched=prefetched
+            )
+            
+            # Проверяем, что хотя бы одна часть была создана
+            if total_parts == 0:
+                raise Exception("Не удалось создать ни одной части архива")
+            
+            if sent_parts < total_parts:
+                # Закрытые части остались на диске - повторное нажатие дошлет их
+                await callback.message.edit_text(f"⚠️ Отправлено архивов: {sent_parts} из {total_parts}\n"
+                                                 f"Нажмите кнопку, чтобы дослать остальные без повторного скачивания.",
+                                                 reply_markup=keyboard_retry)
+                return
+            
+            # Финальное сообщение
+            saved_bytes = export_stats["original_bytes"] - export_stats["export_bytes"]
+            saved_info = ""
+            if saved_bytes > 0:
+                saved_info = (f"\nПережатие фото: {export_stats['original_bytes'] / (1024*1024):.1f} → "
+                              f"{export_stats['export_bytes'] / (1024*1024):.1f} MB")
+            if near_duplicates:
+                saved_info += f"\nПохожих фото отброшено: {near_duplicates}"
+            if export_stats["failed"]:
+                saved_info += f"\n⚠️ Не удалось добавить файлов: {export_stats['failed']} (подробности в логе)"
+            if resumed:
+                saved_info += "\nВыгрузка продолжена с неотправленных частей"
+            if total_parts > 1:
+                await callback.message.edit_text(f"✅ ZIP архивы созданы и отправлены!\n"
+                                               f"Базовое название: {archive_name}\n"
+                                               f"Всего файлов: {len(files)}\n"
+                                               f"Архивов: {sent_parts}/{total_parts}{saved_info}")
+            else:
+                await callback.message.edit_text(f"✅ ZIP архив создан и отправлен!\n"
+                                               f"Название: {archive_name}\n"
+                                               f"Файлов: {len(files)}{saved_info}")
+
         except Exception as e:
-            await callback.message.edit_text(f"❌ Ошибка при создании ZIP архива: {e}")
+            # Старый способ (один архив заново) не используется: он выгрузил бы все файлы
+            # повторно, а незавершенная выгрузка продолжится повторным нажатием
+            await callback.message.edit_text(f"❌ Ошибка при создании ZIP архива: {e}",
+                                             reply_markup=keyboard_retry)
             print(f"[ERROR] Ошибка создания ZIP: {e}")
+        finally:
+            remove_prefetched_files(prefetched)
         
         await callback.answer("ZIP архив готов!")
         
@@ -5151,6 +6956,276 @@ async def handle_export_photos(callback: CallbackQuery):
         await callback.answer(f"❌ Ошибка: {e}")
         print(f"[ERROR] Ошибка экспорта файлов: {e}")
 
+async def send_media_group_with_retry(chat_id, media):
+    """sendMediaGroup с одним повтором после паузы, которую требует Telegram при флуд-контроле"""
+    try:
+        return await bot.send_media_group(chat_id=chat_id, media=media)
+    except TelegramRetryAfter as e:
+        print(f"[EXPORT ALBUM] Флуд-контроль, ждем {e.retry_after} с")
+        await asyncio.sleep(e.retry_after)
+        return await bot.send_media_group(chat_id=chat_id, media=media)
+
+
+# Пересылка файлов урока альбомами по сохраненным file_id (без скачивания и ZIP)
+@dp.callback_query(lambda c: c.data.startswith('export_album:'))
+async def handle_export_album(callback: CallbackQuery):
+    try:
+        export_id = int(callback.data.split(':')[1])
+    except (IndexError, ValueError):
+        await callback.answer("Ошибка: неверный формат данных")
+        return
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT point, groupp, time_l, date_ll, modul, theme
+            FROM export_lessons
+            WHERE id = ?
+        """, (export_id,))
+        lesson_data = cursor.fetchone()
+        if not lesson_data:
+            await callback.answer("Данные урока не найдены")
+            return
+        point, groupp, time_l, date_ll, modul, theme = lesson_data
+
+        cursor.execute("""
+            SELECT file_id, file_type
+            FROM fotoalbum
+            WHERE kindergarten = ? AND groupp = ? AND date = ? AND time = ?
+            ORDER BY id
+        """, (point, groupp, date_ll, time_l))
+        files = cursor.fetchall()
+    finally:
+        conn.close()
+
+    if not files:
+        await callback.answer("Файлы не найдены")
+        return
+
+    await callback.answer()
+    keyboard_blocked = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏳ Обрабатываю...", callback_data="processing")]
+    ])
+    await callback.message.edit_text(
+        "🔄 Пересылаю файлы альбомами...\n"
+        "Пожалуйста, не нажимайте кнопку повторно.",
+        reply_markup=keyboard_blocked
+    )
+
+    # Вебхук ссылок вызывается вне цикла событий
+    mass_link, picture_link = await asyncio.get_running_loop().run_in_executor(None, get_export_links, modul, theme)
+    caption = format_export_caption(
+        "📸 Файлы с урока", point, groupp, time_l, date_ll, len(files), mass_link, picture_link
+    )
+
+    batches = [files[i:i + EXPORT_ALBUM_SIZE] for i in range(0, len(files), EXPORT_ALBUM_SIZE)]
+    started = time.perf_counter()
+    sent_files = 0
+    for number, batch in enumerate(batches, 1):
+        # Подпись - у первого элемента каждого альбома, чтобы части можно было различить
+        batch_caption = caption if len(batches) == 1 else f"{caption}\n\n📦 Альбом {number} из {len(batches)}"
+        media = []
+        for index, (file_id, file_type) in enumerate(batch):
+            media_class = InputMediaVideo if file_type == 'video' else InputMediaPhoto
+            if index == 0:
+                media.append(media_class(media=file_id, caption=batch_caption, parse_mode='HTML'))
+            else:
+                media.append(media_class(media=file_id))
+        try:
+            if len(media) == 1:
+                # Альбом из одного элемента Telegram не принимает
+                send_single = bot.send_video if batch[0][1] == 'video' else bot.send_photo
+                await send_single(callback.from_user.id, batch[0][0], caption=batch_caption, parse_mode='HTML')
+            else:
+                await send_media_group_with_retry(callback.from_user.id, media)
+            sent_files += len(batch)
+        except Exception as e:
+            print(f"[ERROR EXPORT ALBUM] Ошибка отправки альбома {number}/{len(batches)}: {e}")
+
+    print(f"[EXPORT ALBUM] export_id={export_id}: отправлено {sent_files}/{len(files)} файлов, "
+          f"альбомов {len(batches)} за {time.perf_counter() - started:.2f} с")
+    if sent_files == len(files):
+        await callback.message.edit_text(f"✅ Файлы пересланы альбомами!\n"
+                                         f"Файлов: {sent_files}\n"
+                                         f"Альбомов: {len(batches)}")
+    else:
+        await callback.message.edit_text(f"⚠️ Переслано файлов: {sent_files} из {len(files)}\n"
+                                         f"Для остальных используйте кнопку \"Выгрузить файлы\"")
+
+
+# ============================================================================
+# МАССОВАЯ ВЫГРУЗКА: ОДНО ЗАДАНИЕ НА САДИК И ДЕНЬ
+# ============================================================================
+
+# Файлы уроков за период; modul/theme - из export_lessons (строк на урок может быть несколько)
+BULK_EXPORT_SQL = """
+    SELECT f.kindergarten, f.date, f.time, f.groupp,
+           f.file_id, f.file_unique_id, f.file_size, f.file_type,
+           e.modul, e.theme
+    FROM fotoalbum f
+    LEFT JOIN (
+        SELECT point, groupp, time_l, date_ll, MAX(modul) AS modul, MAX(theme) AS theme
+        FROM export_lessons
+        GROUP BY point, groupp, time_l, date_ll
+    ) e ON e.point = f.kindergarten AND e.groupp = f.groupp AND e.time_l = f.time AND e.date_ll = f.date
+    WHERE f.date BETWEEN ? AND ?{filter}
+    ORDER BY f.kindergarten, f.date, f.time, f.groupp, f.id
+"""
+
+
+def safe_export_name(value):
+    """Имя файла/папки в архиве без недопустимых символов (10:30 -> 10-30)"""
+    value = str(value or "").replace(":", "-")
+    return "".join(c for c in value if c.isalnum() or c in (' ', '-', '_', '.')).strip()
+
+
+def plan_bulk_export(date_from, date_to, target=None):
+    """
+    Задания массовой выгрузки по fotoalbum за период [date_from, date_to] (ISO-даты)
+
+    target - садик или модуль (None - все). Возвращает список заданий
+    {"point", "date", "lessons"} по садику и дню; lessons - словарь
+    (groupp, time) -> {"modul", "theme", "files"}, files - (file_id, file_unique_id, file_size, file_type).
+    """
+    params = [date_from, date_to]
+    where = ""
+    if target:
+        where = " AND (f.kindergarten = ? OR e.modul = ?)"
+        params += [target, target]
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(BULK_EXPORT_SQL.format(filter=where), params)
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    jobs = {}
+    for point, date_ll, time_l, groupp, file_id, file_unique_id, file_size, file_type, modul, theme in rows:
+        job = jobs.setdefault((point, date_ll), {"point": point, "date": date_ll, "lessons": {}})
+        lesson = job["lessons"].setdefault((groupp, time_l), {"modul": modul, "theme": theme, "files": []})
+        lesson["files"].append((file_id, file_unique_id, file_size, file_type))
+    return list(jobs.values())
+
+
+@dp.message(Command("export_bulk"), RoleFilter(*ADMIN_ROLES))
+async def handle_export_bulk(message: Message):
+    """
+    /export_bulk <дата с> [дата по] [садик или модуль]
+
+    Выгружает все уроки за период: по одному заданию на садик и день, внутри
+    архива - папка на каждый урок (группа_время) и уроки.txt со ссылками.
+    Файлы задания скачиваются параллельно один раз, архивы режутся по EXPORT_PART_SIZE_MB.
+    """
+    parts = message.text.split(maxsplit=3)
+    date_from = parse_lesson_date(parts[1]) if len(parts) > 1 else None
+    date_to = parse_lesson_date(parts[2]) if len(parts) > 2 else None
+    target = None
+    if len(parts) > 2 and date_to is None:
+        # Второй аргумент - не дата, значит это садик/модуль за один день
+        target = " ".join(parts[2:])
+    elif len(parts) > 3:
+        target = parts[3]
+    if date_from is None:
+        await message.answer("Формат: /export_bulk <дата с> [дата по] [садик или модуль]\n"
+                             "Например: /export_bulk 2024-09-02 2024-09-06 Садик1")
+        return
+    date_to = date_to or date_from
+    if date_to < date_from:
+        date_from, date_to = date_to, date_from
+
+    jobs = plan_bulk_export(date_from.isoformat(), date_to.isoformat(), target)
+    if not jobs:
+        await message.answer("Файлы за этот период не найдены")
+        return
+
+    total_lessons = sum(len(job["lessons"]) for job in jobs)
+    total_files = sum(len(lesson["files"]) for job in jobs for lesson in job["lessons"].values())
+    print(f"[EXPORT BULK] {date_from}..{date_to} target={target!r}: заданий {len(jobs)}, "
+          f"уроков {total_lessons}, файлов {total_files}")
+    status = await message.answer(f"🔄 Массовая выгрузка: заданий {len(jobs)}, уроков {total_lessons}, "
+                                  f"файлов {total_files}\nПожалуйста, подождите.")
+
+    # Ссылки запрашиваются один раз на пару (модуль, тема), вебхук вызывается вне цикла событий
+    links = {}
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    sent_jobs = 0
+    sent_files = 0
+    near_duplicates = 0
+    failed = 0
+
+    for job_number, job in enumerate(jobs, 1):
+        point, date_ll = job["point"], job["date"]
+        prefetched = {}
+        try:
+            await status.edit_text(f"🔄 Задание {job_number} из {len(jobs)}: {point}, {date_ll}\n"
+                                   f"Уроков: {len(job['lessons'])}. Пожалуйста, подождите.")
+
+            entries = []
+            lesson_lines = []
+            for (groupp, time_l), lesson in job["lessons"].items():
+                files = lesson["files"]
+                if EXPORT_NEAR_DUP_FILTER:
+                    files, dropped = await filter_near_duplicate_photos(files, prefetched)
+                    near_duplicates += dropped
+
+                key = (lesson["modul"], lesson["theme"])
+                if key not in links:
+                    links[key] = await loop.run_in_executor(None, get_export_links, *key)
+                mass_link, picture_link = links[key]
+
+                folder = safe_export_name(f"{groupp}_{time_l}")
+                entries += [
+                    (f"{folder}/{export_file_name(file_type, i)}", file_id, file_size, file_type)
+                    for i, (file_id, file_unique_id, file_size, file_type) in enumerate(files, 1)
+                ]
+                lesson_lines.append(f"{folder}: группа {groupp}, {time_l}, файлов {len(files)}\n"
+                                    f"  Модуль: {lesson['modul'] or '-'}, тема: {lesson['theme'] or '-'}\n"
+                                    f"  Сообщение: {mass_link or '-'}\n"
+                                    f"  Имидж: {picture_link or '-'}")
+
+            index_text = f"{point}, {date_ll}\n\n" + "\n\n".join(lesson_lines) + "\n"
+            archive_name = safe_export_name(f"{point}_{date_ll}")
+            export_stats = {"original_bytes": 0, "export_bytes": 0, "failed": 0}
+
+            base_caption = (f"📸 Выгрузка за день\n"
+                            f"📍 Садик: {point}\n"
+                            f"📅 Дата: {date_ll}\n"
+                            f"👥 Уроков: {len(job['lessons'])}\n"
+                            f"📁 Файлов: {len(entries)}")
+            # Повтор команды с тем же периодом и фильтром дошлет незавершенные задания
+            sent_parts, total_parts, resumed = await run_export_job(
+                f"bulk:{message.chat.id}:{point}:{date_ll}:{target or ''}", message.chat.id, entries,
+                archive_name, base_caption, stats=export_stats,
+                extra_files=[("уроки.txt", index_text.encode("utf-8"))], prefetched=prefetched
+            )
+            failed += export_stats["failed"]
+            if total_parts and sent_parts == total_parts:
+                sent_jobs += 1
+                sent_files += len(entries) - export_stats["failed"]
+        except Exception as e:
+            print(f"[ERROR EXPORT BULK] Задание {point}, {date_ll}: {e}")
+        finally:
+            remove_prefetched_files(prefetched)
+
+    print(f"[EXPORT BULK] Отправлено заданий {sent_jobs}/{len(jobs)}, файлов {sent_files}/{total_files} "
+          f"за {time.perf_counter() - started:.2f} с")
+    summary = (f"✅ Массовая выгрузка завершена\n"
+               f"Период: {date_from.isoformat()} - {date_to.isoformat()}\n"
+               f"Заданий отправлено: {sent_jobs}/{len(jobs)}\n"
+               f"Файлов: {sent_files}/{total_files}")
+    if near_duplicates:
+        summary += f"\nПохожих фото отброшено: {near_duplicates}"
+    if failed:
+        summary += f"\n⚠️ Не удалось добавить файлов: {failed} (подробности в логе)"
+    if sent_jobs < len(jobs):
+        summary += "\n🔁 Повторите команду - незавершенные задания продолжатся с неотправленных архивов"
+    await status.edit_text(summary)
+
+
 # Обработчик заблокированной кнопки (показывает, что идет обработка)
 @dp.callback_query(lambda c: c.data == "processing")
 async def handle_processing_button(callback: CallbackQuery):
@@ -5159,21 +7234,12 @@ async def handle_processing_button(callback: CallbackQuery):
 # Команда для добавления полей modul и theme в таблицу export_lessons
 
 # Команда для обновления структуры БД
-@dp.message(Command("update_db_structure"))
+@dp.message(Command("update_db_structure"), RoleFilter("Admin"))
 async def update_db_structure(message: Message):
-    user_id = message.from_user.id
     conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # Проверяем, является ли пользователь администратором
-        cursor.execute("SELECT status FROM users WHERE telegram_id = ?", (user_id,))
-        user = cursor.fetchone()
-        
-        if not user or user[0] != "Admin":
-            await message.answer("❌ У вас нет прав для выполнения этой команды")
-            return
-        
         await message.answer("🔄 Начинаю обновление структуры БД...")
         
         # 1. Добавляем колонку foto в таблицу schedule (если её нет)
@@ -5214,22 +7280,9 @@ async def update_db_structure(message: Message):
         conn.close()
 
 
-@dp.message(Command("add_is_send_column"))
+@dp.message(Command("add_is_send_column"), RoleFilter("Admin"))
 async def add_is_send_column_command(message: Message):
     """Команда для добавления колонки is_send в таблицу lessons"""
-    # Проверяем, является ли пользователь администратором
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT status FROM users WHERE telegram_id = ?", (message.from_user.id,))
-    user = cursor.fetchone()
-    
-    if not user or user[0] != "Admin":
-        await message.answer("У вас нет прав для выполнения этой команды")
-        conn.close()
-        return
-    
-    conn.close()
-    
     add_is_send_column()
     await message.answer("✅ Колонка is_send добавлена в таблицу lessons")
 
@@ -5238,7 +7291,8 @@ async def add_is_send_column_command(message: Message):
 # ФУНКЦИИ ДЛЯ ПЕРВИЧНОЙ ОТПРАВКИ (автоматическая за 10 минут до урока)
 # ============================================================================
 
-async def create_primary_keyboard(teacher_id, point, groupp, free, page=0, message_id=None, lesson_code=None):
+async def create_primary_keyboard(teacher_id, point, groupp, free, page=0, message_id=None, lesson_code=None,
+                                 lesson=None, after_id=None, before_id=None):
     """Создает клавиатуру для первичной отправки (автоматическая за 10 минут до урока)"""
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -5250,25 +7304,20 @@ async def create_primary_keyboard(teacher_id, point, groupp, free, page=0, messa
     print(f"  - page: {page}")
     print(f"  - lesson_code: {lesson_code}")
     
-    # Получаем всех учеников
-    cursor.execute("""
-        SELECT id, name_s, present 
-        FROM lessons 
-        WHERE point = ? AND groupp = ? AND free = ?
-        ORDER BY name_s
-    """, (point, groupp, free))
-    all_students = cursor.fetchall()
+    # Урок ищется один раз (при листании он уже передан), из attendance читается только страница
+    lesson = lesson or find_lesson(cursor, point, groupp, free)
+    if lesson and not lesson_code:
+        lesson_code = lesson.lesson_code
+    roster = fetch_roster_page(cursor, lesson.id, page, after_id, before_id) if lesson else None
     
-    if not all_students:
+    if not roster or not roster.rows:
         await bot.send_message(teacher_id, f"Нет учеников для группы {groupp} ({point})")
         conn.close()
         return
     
-    # Пагинация
-    start_index = page * STUDENTS_PER_PAGE
-    end_index = start_index + STUDENTS_PER_PAGE
-    students_page = all_students[start_index:end_index]
-    total_pages = (len(all_students) + STUDENTS_PER_PAGE - 1) // STUDENTS_PER_PAGE
+    page = roster.page
+    students_page = roster.rows
+    total_pages = roster.total_pages
     
     # Создаем клавиатуру
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
@@ -5276,7 +7325,7 @@ async def create_primary_keyboard(teacher_id, point, groupp, free, page=0, messa
     # Добавляем учеников текущей страницы
     for student in students_page:
         student_id, name_s, present = student
-        is_present = present == "1"
+        is_present = present == 1
         
         callback_data = f"primary_student:{student_id}:{page}"
         button_text = f"✅ {name_s}" if is_present else name_s
@@ -5300,11 +7349,11 @@ async def create_primary_keyboard(teacher_id, point, groupp, free, page=0, messa
     
     # Добавляем кнопки навигации
     if page > 0:
-        callback_data = f"primary_page:{lesson_code}:prev:{page}" if lesson_code else f"primary_page:{point}:{groupp}:{free}:prev:{page}"
+        callback_data = roster_page_callback("primary_page", lesson.id, "prev", page, students_page[0][0])
         keyboard.inline_keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=callback_data)])
     
-    if end_index < len(all_students):
-        callback_data = f"primary_page:{lesson_code}:next:{page}" if lesson_code else f"primary_page:{point}:{groupp}:{free}:next:{page}"
+    if page < total_pages - 1:
+        callback_data = roster_page_callback("primary_page", lesson.id, "next", page, students_page[-1][0])
         keyboard.inline_keyboard.append([InlineKeyboardButton(text="➡️ Вперед", callback_data=callback_data)])
     
     # Кнопка добавления ученика
@@ -5319,8 +7368,7 @@ async def create_primary_keyboard(teacher_id, point, groupp, free, page=0, messa
     )])
     
     # Кнопка отправки данных
-    present_count = sum(1 for _, _, present in all_students if present == "1")
-    total_count = len(all_students)
+    total_count, present_count = roster.total_count, roster.present_count
     
     if lesson_code:
         send_callback = f"primary_send:{lesson_code}"
@@ -5374,43 +7422,24 @@ async def handle_primary_student(callback: CallbackQuery):
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Получаем данные ученика
-        cursor.execute("SELECT point, groupp, free FROM lessons WHERE id = ?", (student_id,))
-        student_data = cursor.fetchone()
+        # Получаем урок ученика (вместе с lesson_code)
+        lesson = find_lesson_of_attendance(cursor, student_id)
         
-        if not student_data:
+        if not lesson:
             await callback.answer("Ученик не найден")
             conn.close()
             return
         
-        point, groupp, free = student_data
+        point, groupp, free, lesson_code = lesson.point, lesson.groupp, lesson.free, lesson.lesson_code
         
         # Переключаем статус присутствия
         cursor.execute("""
-            UPDATE lessons 
-            SET present = CASE WHEN present = '1' THEN '0' ELSE '1' END 
+            UPDATE attendance 
+            SET present = 1 - present
             WHERE id = ?
         """, (student_id,))
         conn.commit()
         
-        # Получаем lesson_code для этого урока
-        lesson_code = None
-        try:
-            cursor.execute("""
-                SELECT lesson_code FROM lessons 
-                WHERE point = ? AND groupp = ? AND free = ? 
-                AND lesson_code IS NOT NULL 
-                LIMIT 1
-            """, (point, groupp, free))
-            result = cursor.fetchone()
-            if result and result[0]:
-                lesson_code = result[0]
-                print(f"[DEBUG] Найден lesson_code для handle_primary_student: {lesson_code}")
-            else:
-                print(f"[DEBUG] lesson_code не найден для handle_primary_student, используем старый формат")
-        except Exception as e:
-            print(f"[DEBUG] Ошибка при поиске lesson_code для handle_primary_student: {e}, используем старый формат")
-        
         # Обновляем список учеников
         await create_primary_keyboard(
             callback.from_user.id,
@@ -5433,37 +7462,7 @@ async def handle_primary_student(callback: CallbackQuery):
 async def handle_primary_pagination(callback: CallbackQuery):
     """Обработка навигации в первичной отправке"""
     try:
-        data_parts = callback.data.split(':')
-        
-        if len(data_parts) == 4:  # Новый формат: primary_page:lesson_code:prev/next:page
-            lesson_code = data_parts[1]
-            direction = data_parts[2]
-            current_page = int(data_parts[3])
-            
-            point, groupp, free = get_lesson_by_code(lesson_code)
-            if not point:
-                await callback.answer("Урок не найден")
-                return
-        else:  # Старый формат: primary_page:point:groupp:free:prev/next:page
-            point = data_parts[1].replace('_', ' ')
-            groupp = data_parts[2]
-            free = ':'.join(data_parts[3:-2])
-            direction = data_parts[-2]
-            current_page = int(data_parts[-1])
-        
-        new_page = current_page - 1 if direction == "prev" else current_page + 1
-        
-        await create_primary_keyboard(
-            callback.from_user.id,
-            point,
-            groupp,
-            free,
-            page=new_page,
-            message_id=callback.message.message_id,
-            lesson_code=lesson_code
-        )
-        
-        await callback.answer()
+        await turn_roster_page(callback, create_primary_keyboard)
         
     except Exception as e:
         print(f"[ERROR PRIMARY] Ошибка в handle_primary_pagination: {e}")
@@ -5501,37 +7500,21 @@ async def handle_primary_send(callback: CallbackQuery):
         print(f"  - groupp: {groupp}")
         print(f"  - free: {free}")
         
-        # Получаем всех учеников (только присутствующих)
-        cursor.execute("""
-            SELECT point, groupp, name_s, student_rowid, column_d, is_permanent, present 
-            FROM lessons 
-            WHERE point = ? AND groupp = ? AND free = ? AND present = '1'
-        """, (point, groupp, free))
-        all_present_students = cursor.fetchall()
+        # Присутствующие ученики урока, разделенные на обычных и новых
+        lesson = find_lesson(cursor, point, groupp, free)
+        regular_students, new_students = split_lesson_students(
+            cursor, lesson.id if lesson else None, only_present=True
+        )
         
-        if not all_present_students:
+        if not regular_students and not new_students:
             await callback.answer("Нет данных для отправки")
             conn.close()
             return
         
-        # Разделяем на обычных и новых учеников
-        regular_students = []
-        new_students = []
-        
-        for student in all_present_students:
-            point_val, groupp_val, name_s, student_rowid, column_d, is_permanent, present = student
-            
-            if student_rowid is None or student_rowid == '' or column_d is None or column_d == '':
-                new_students.append((point_val, groupp_val, name_s, is_permanent))
-            else:
-                present_value = 1 if present == '1' else 0
-                regular_students.append((point_val, groupp_val, name_s, column_d, present_value))
-        
         # Отправляем webhook для обычных учеников (WEBHOOK_ATTENDANCE_URL)
         if regular_students:
             # Получаем имя преподавателя
-            cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (callback.from_user.id,))
-            teacher_name_row = cursor.fetchone()
+            teacher_name_row = get_user_directory().fields(callback.from_user.id, "name")
             teacher_name = teacher_name_row[0] if teacher_name_row else "Неизвестный"
             
             # Используем ту же структуру данных, что и в старой функции
@@ -5550,7 +7533,7 @@ async def handle_primary_send(callback: CallbackQuery):
             }
             
             try:
-                response = requests.post(WEBHOOK_ATTENDANCE_URL, json=data_to_send, timeout=30)
+                response = post_webhook(WEBHOOK_ATTENDANCE_URL, json=data_to_send, timeout=30)
                 print(f"[DEBUG PRIMARY] Webhook отправлен: {response.status_code}")
             except Exception as e:
                 print(f"[ERROR PRIMARY] Ошибка отправки webhook: {e}")
@@ -5559,8 +7542,7 @@ async def handle_primary_send(callback: CallbackQuery):
         if new_students:
             # Получаем имя преподавателя (если еще не получено)
             if 'teacher_name' not in locals():
-                cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (callback.from_user.id,))
-                teacher_name_row = cursor.fetchone()
+                teacher_name_row = get_user_directory().fields(callback.from_user.id, "name")
                 teacher_name = teacher_name_row[0] if teacher_name_row else "Неизвестный"
             
             # Используем ту же структуру данных, что и в старой функции
@@ -5578,30 +7560,18 @@ async def handle_primary_send(callback: CallbackQuery):
             }
             
             try:
-                response = requests.post(WEBHOOK_NEW_STUDENTS_URL, json=new_data_to_send, timeout=30)
+                response = post_webhook(WEBHOOK_NEW_STUDENTS_URL, json=new_data_to_send, timeout=30)
                 print(f"[DEBUG PRIMARY] Webhook новых учеников отправлен: {response.status_code}")
             except Exception as e:
                 print(f"[ERROR PRIMARY] Ошибка отправки webhook новых учеников: {e}")
         
         # Отправляем новых учеников админам для верификации
         if new_students:
-            cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-            admins = cursor.fetchall()
+            admins = get_user_directory().with_roles(*ADMIN_ROLES)
             
             if admins:
-                # Получаем lesson_code для кнопок
-                lesson_code = None
-                try:
-                    cursor.execute("""
-                        SELECT lesson_code FROM lessons 
-                        WHERE point = ? AND groupp = ? AND free = ? AND lesson_code IS NOT NULL
-                        LIMIT 1
-                    """, (point, groupp, free))
-                    result = cursor.fetchone()
-                    if result and result[0]:
-                        lesson_code = result[0]
-                except Exception as e:
-                    print(f"[DEBUG PRIMARY] Ошибка при поиске lesson_code: {e}")
+                # lesson_code для кнопок берется из урока
+                lesson_code = lesson.lesson_code
                 
                 # Создаем клавиатуру с новыми учениками
                 keyboard_buttons = []
@@ -5646,8 +7616,7 @@ async def handle_primary_send(callback: CallbackQuery):
         # Уведомляем админов, если учеников менее 3
         total_students = len(regular_students) + len(new_students)
         if total_students < 3:
-            cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-            admins = cursor.fetchall()
+            admins = get_user_directory().with_roles(*ADMIN_ROLES)
             
             if admins:
                 # Определяем правильное окончание для числа
@@ -5683,7 +7652,8 @@ async def handle_primary_send(callback: CallbackQuery):
 # ФУНКЦИИ ДЛЯ ПОВТОРНОЙ ОТПРАВКИ (команда /lessons)
 # ============================================================================
 
-async def create_edit_keyboard(teacher_id, point, groupp, free, page=0, message_id=None, lesson_code=None):
+async def create_edit_keyboard(teacher_id, point, groupp, free, page=0, message_id=None, lesson_code=None,
+                                 lesson=None, after_id=None, before_id=None):
     """Создает клавиатуру для повторной отправки (команда /lessons)"""
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -5695,25 +7665,20 @@ async def create_edit_keyboard(teacher_id, point, groupp, free, page=0, message_
     print(f"  - page: {page}")
     print(f"  - lesson_code: {lesson_code}")
     
-    # Получаем всех учеников
-    cursor.execute("""
-        SELECT id, name_s, present 
-        FROM lessons 
-        WHERE point = ? AND groupp = ? AND free = ?
-        ORDER BY name_s
-    """, (point, groupp, free))
-    all_students = cursor.fetchall()
+    # Урок ищется один раз (при листании он уже передан), из attendance читается только страница
+    lesson = lesson or find_lesson(cursor, point, groupp, free)
+    if lesson and not lesson_code:
+        lesson_code = lesson.lesson_code
+    roster = fetch_roster_page(cursor, lesson.id, page, after_id, before_id) if lesson else None
     
-    if not all_students:
+    if not roster or not roster.rows:
         await bot.send_message(teacher_id, f"Нет учеников для группы {groupp} ({point})")
         conn.close()
         return
     
-    # Пагинация
-    start_index = page * STUDENTS_PER_PAGE
-    end_index = start_index + STUDENTS_PER_PAGE
-    students_page = all_students[start_index:end_index]
-    total_pages = (len(all_students) + STUDENTS_PER_PAGE - 1) // STUDENTS_PER_PAGE
+    page = roster.page
+    students_page = roster.rows
+    total_pages = roster.total_pages
     
     # Создаем клавиатуру
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
@@ -5721,7 +7686,7 @@ async def create_edit_keyboard(teacher_id, point, groupp, free, page=0, message_
     # Добавляем учеников текущей страницы
     for student in students_page:
         student_id, name_s, present = student
-        is_present = present == "1"
+        is_present = present == 1
         
         callback_data = f"edit_student:{student_id}:{page}"
         button_text = f"✅ {name_s}" if is_present else name_s
@@ -5736,11 +7701,11 @@ async def create_edit_keyboard(teacher_id, point, groupp, free, page=0, message_
     
     # Добавляем кнопки навигации
     if page > 0:
-        callback_data = f"edit_page:{lesson_code}:prev:{page}" if lesson_code else f"edit_page:{point}:{groupp}:{free}:prev:{page}"
+        callback_data = roster_page_callback("edit_page", lesson.id, "prev", page, students_page[0][0])
         keyboard.inline_keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=callback_data)])
     
-    if end_index < len(all_students):
-        callback_data = f"edit_page:{lesson_code}:next:{page}" if lesson_code else f"edit_page:{point}:{groupp}:{free}:next:{page}"
+    if page < total_pages - 1:
+        callback_data = roster_page_callback("edit_page", lesson.id, "next", page, students_page[-1][0])
         keyboard.inline_keyboard.append([InlineKeyboardButton(text="➡️ Вперед", callback_data=callback_data)])
     
     # Кнопка добавления ученика
@@ -5755,8 +7720,7 @@ async def create_edit_keyboard(teacher_id, point, groupp, free, page=0, message_
     )])
     
     # Кнопка отправки данных
-    present_count = sum(1 for _, _, present in all_students if present == "1")
-    total_count = len(all_students)
+    total_count, present_count = roster.total_count, roster.present_count
     
     if lesson_code:
         send_callback = f"edit_send:{lesson_code}"
@@ -5795,43 +7759,24 @@ async def handle_edit_student(callback: CallbackQuery):
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Получаем данные ученика
-        cursor.execute("SELECT point, groupp, free FROM lessons WHERE id = ?", (student_id,))
-        student_data = cursor.fetchone()
+        # Получаем урок ученика (вместе с lesson_code)
+        lesson = find_lesson_of_attendance(cursor, student_id)
         
-        if not student_data:
+        if not lesson:
             await callback.answer("Ученик не найден")
             conn.close()
             return
         
-        point, groupp, free = student_data
+        point, groupp, free, lesson_code = lesson.point, lesson.groupp, lesson.free, lesson.lesson_code
         
         # Переключаем статус присутствия
         cursor.execute("""
-            UPDATE lessons 
-            SET present = CASE WHEN present = '1' THEN '0' ELSE '1' END 
+            UPDATE attendance 
+            SET present = 1 - present
             WHERE id = ?
         """, (student_id,))
         conn.commit()
         
-        # Получаем lesson_code для этого урока
-        lesson_code = None
-        try:
-            cursor.execute("""
-                SELECT lesson_code FROM lessons 
-                WHERE point = ? AND groupp = ? AND free = ? 
-                AND lesson_code IS NOT NULL 
-                LIMIT 1
-            """, (point, groupp, free))
-            result = cursor.fetchone()
-            if result and result[0]:
-                lesson_code = result[0]
-                print(f"[DEBUG] Найден lesson_code для handle_edit_student: {lesson_code}")
-            else:
-                print(f"[DEBUG] lesson_code не найден для handle_edit_student, используем старый формат")
-        except Exception as e:
-            print(f"[DEBUG] Ошибка при поиске lesson_code для handle_edit_student: {e}, используем старый формат")
-        
         # Обновляем список учеников
         await create_edit_keyboard(
             callback.from_user.id,
@@ -5854,37 +7799,7 @@ async def handle_edit_student(callback: CallbackQuery):
 async def handle_edit_pagination(callback: CallbackQuery):
     """Обработка навигации в повторной отправке"""
     try:
-        data_parts = callback.data.split(':')
-        
-        if len(data_parts) == 4:  # Новый формат: edit_page:lesson_code:prev/next:page
-            lesson_code = data_parts[1]
-            direction = data_parts[2]
-            current_page = int(data_parts[3])
-            
-            point, groupp, free = get_lesson_by_code(lesson_code)
-            if not point:
-                await callback.answer("Урок не найден")
-                return
-        else:  # Старый формат: edit_page:point:groupp:free:prev/next:page
-            point = data_parts[1].replace('_', ' ')
-            groupp = data_parts[2]
-            free = ':'.join(data_parts[3:-2])
-            direction = data_parts[-2]
-            current_page = int(data_parts[-1])
-        
-        new_page = current_page - 1 if direction == "prev" else current_page + 1
-        
-        await create_edit_keyboard(
-            callback.from_user.id,
-            point,
-            groupp,
-            free,
-            page=new_page,
-            message_id=callback.message.message_id,
-            lesson_code=lesson_code
-        )
-        
-        await callback.answer()
+        await turn_roster_page(callback, create_edit_keyboard)
         
     except Exception as e:
         print(f"[ERROR EDIT] Ошибка в handle_edit_pagination: {e}")
@@ -5922,49 +7837,23 @@ async def handle_edit_send(callback: CallbackQuery):
         print(f"  - groupp: {groupp}")
         print(f"  - free: {free}")
         
-        # Получаем всех учеников
-        cursor.execute("""
-            SELECT point, groupp, name_s, student_rowid, column_d, is_permanent, present, is_send
-            FROM lessons 
-            WHERE point = ? AND groupp = ? AND free = ?
-        """, (point, groupp, free))
-        all_present_students = cursor.fetchall()
+        # Все ученики урока: обычные отправляются целиком, новые - только еще не отправленные
+        lesson = find_lesson(cursor, point, groupp, free)
+        total_count, _ = lesson_attendance_counts(cursor, lesson.id if lesson else None)
         
-        if not all_present_students:
+        if not total_count:
             await callback.answer("Нет данных для отправки")
             conn.close()
             return
         
-        # Разделяем на обычных и новых учеников
-        regular_students = []
-        new_students = []
-        
-        for student in all_present_students:
-            point_val, groupp_val, name_s, student_rowid, column_d, is_permanent, present, is_send = student
-            
-            if student_rowid is None or student_rowid == '' or column_d is None or column_d == '':
-                # Новый ученик - проверяем, не отправлялся ли уже
-                if is_send is None or is_send != 1:
-                    new_students.append((point_val, groupp_val, name_s, is_permanent))
-                    print(f"[DEBUG EDIT] Новый ученик {name_s} будет отправлен (is_send = {is_send})")
-                else:
-                    print(f"[DEBUG EDIT] Новый ученик {name_s} уже отправлялся (is_send = {is_send})")
-            else:
-                present_value = 1 if present == '1' else 0
-                regular_students.append((point_val, groupp_val, name_s, column_d, present_value))
+        regular_students, new_students = split_lesson_students(cursor, lesson.id, skip_sent_new=True)
         
         # Отправляем webhook для всех учеников (WEBHOOK_LESSONS_EDIT_URL)
-        all_students_data = []
-        for student in all_present_students:
-            point_val, groupp_val, name_s, student_rowid, column_d, is_permanent, present, is_send = student
-            if student_rowid is not None and student_rowid != '' and column_d is not None and column_d != '':
-                present_value = 1 if present == '1' else 0
-                all_students_data.append((point_val, groupp_val, name_s, column_d, present_value))
+        all_students_data = regular_students
         
         if all_students_data:
             # Получаем имя преподавателя
-            cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (callback.from_user.id,))
-            teacher_name_row = cursor.fetchone()
+            teacher_name_row = get_user_directory().fields(callback.from_user.id, "name")
             teacher_name = teacher_name_row[0] if teacher_name_row else "Неизвестный"
             
             # Используем ту же структуру данных, что и в старой функции
@@ -5983,7 +7872,7 @@ async def handle_edit_send(callback: CallbackQuery):
             }
             
             try:
-                response = requests.post(WEBHOOK_LESSONS_EDIT_URL, json=data_to_send, timeout=50)
+                response = post_webhook(WEBHOOK_LESSONS_EDIT_URL, json=data_to_send, timeout=50)
                 print(f"[DEBUG EDIT] Webhook отправлен: {response.status_code}")
             except Exception as e:
                 print(f"[ERROR EDIT] Ошибка отправки webhook: {e}")
@@ -5992,8 +7881,7 @@ async def handle_edit_send(callback: CallbackQuery):
         if new_students:
             # Получаем имя преподавателя (если еще не получено)
             if 'teacher_name' not in locals():
-                cursor.execute("SELECT name FROM users WHERE telegram_id = ?", (callback.from_user.id,))
-                teacher_name_row = cursor.fetchone()
+                teacher_name_row = get_user_directory().fields(callback.from_user.id, "name")
                 teacher_name = teacher_name_row[0] if teacher_name_row else "Неизвестный"
             
             # Используем ту же структуру данных, что и в старой функции
@@ -6011,15 +7899,14 @@ async def handle_edit_send(callback: CallbackQuery):
             }
             
             try:
-                response = requests.post(WEBHOOK_NEW_STUDENTS_URL, json=new_data_to_send, timeout=30)
+                response = post_webhook(WEBHOOK_NEW_STUDENTS_URL, json=new_data_to_send, timeout=30)
                 print(f"[DEBUG EDIT] Webhook новых учеников отправлен: {response.status_code}")
             except Exception as e:
                 print(f"[ERROR EDIT] Ошибка отправки webhook новых учеников: {e}")
         
         # Отправляем новых учеников админам для верификации
         if new_students:
-            cursor.execute("SELECT telegram_id FROM users WHERE status IN ('Admin', 'DoubleA')")
-            admins = cursor.fetchall()
+            admins = get_user_directory().with_roles(*ADMIN_ROLES)
             
             if admins:
                 # Получаем lesson_code для кнопок
@@ -6131,5 +8018,21 @@ async def handle_edit_send_callback(callback: CallbackQuery):
     await handle_edit_send(callback)
 
 
+# ============================================================================
+# ОТКАЗ В ДОСТУПЕ
+# ============================================================================
+
+# Регистрируются последними: срабатывают, только если RoleFilter не пропустил
+# пользователя ни в один обработчик этих команд
+@dp.message(Command("help", "helps", "retable", "update_db_structure", "add_is_send_column", "export_bulk"))
+async def handle_command_forbidden(message: Message):
+    await message.answer("У вас нет прав для выполнения этой команды")
+
+
+@dp.callback_query(lambda c: c.data in ["retable_today", "retable_tomorrow"])
+async def handle_callback_forbidden(callback: CallbackQuery):
+    await callback.answer("Нет прав", show_alert=True)
+
+
 if __name__ == "__main__":
     asyncio.run(main())